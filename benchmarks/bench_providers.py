@@ -0,0 +1,155 @@
+"""Benchmark độ trễ của các LLMProvider với server giả lập chạy trên localhost.
+
+Đo time-to-first-token, số chunk/giây ổn định, tổng thời gian và overhead phía Python
+mỗi chunk cho từng provider, từng lớp bọc (raw, governor, retry) và từng mức đồng thời.
+
+Chạy từ thư mục gốc của repo:
+
+    python -m benchmarks.bench_providers --concurrency 1 8 64 --output bench.json
+"""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.stub_servers import AnthropicHandler, GeminiHandler, OpenAIHandler, StreamProfile, StubServer
+from utils.governor import GovernedProvider, ProviderGovernor
+from utils.llm import AnthropicProvider, DeepSeekProvider, GoogleProvider, OpenAIProvider
+from utils.resilience import ResilienceStats, ResilientProvider
+
+MESSAGES = [{"role": "user", "content": "Xin chào, hãy kể một câu chuyện ngắn."}]
+SYSTEM_PROMPT = "Bạn là một trợ lý AI hữu ích."
+
+def make_provider(name, url):
+    """Tạo provider trỏ tới server giả lập, giữ nguyên tên lớp để khóa pool/governor như thật."""
+    if name == "OpenAI":
+        cls = type("OpenAIProvider", (OpenAIProvider,), {"base_url": f"{url}/v1"})
+    elif name == "DeepSeek":
+        cls = type("DeepSeekProvider", (DeepSeekProvider,), {"base_url": f"{url}/v1"})
+    elif name == "Anthropic":
+        cls = type("AnthropicProvider", (AnthropicProvider,), {"base_url": url})
+    elif name == "Google":
+        cls = type("GoogleProvider", (GoogleProvider,), {"api_endpoint": url, "transport": "rest"})
+    else:
+        raise ValueError(name)
+    # Key riêng cho benchmark để không dùng chung client với provider thật trong pool
+    return cls(f"bench-{name}-{url}"), next(iter(cls.context_windows))
+
+def wrap(provider, layer):
+    """Bọc provider theo lớp cần đo, với hạn mức đủ lớn để governor không làm chậm."""
+    if layer in ("governed", "resilient"):
+        provider = GovernedProvider(provider, ProviderGovernor(rpm=10**9, tpm=10**12, max_in_flight=10**6))
+    if layer == "resilient":
+        provider = ResilientProvider(provider, ResilienceStats())
+    return provider
+
+def run_stream(provider, model, profile):
+    started = time.perf_counter()
+    first = None
+    chunks = 0
+    for _ in provider.chat_stream(MESSAGES, model, 0.0, 1024, SYSTEM_PROMPT):
+        if first is None:
+            first = time.perf_counter()
+        chunks += 1
+    finished = time.perf_counter()
+    total = finished - started
+    ttft = (first or finished) - started
+    steady = finished - (first or finished)
+    return {
+        "ttft": ttft,
+        "total": total,
+        "chunks": chunks,
+        "chunks_per_s": (chunks - 1) / steady if chunks > 1 and steady > 0 else 0.0,
+        # Phần thời gian vượt quá độ trễ server cố ý tạo ra, chia đều cho mỗi chunk
+        "overhead_per_chunk": max(total - profile.expected_duration(), 0.0) / chunks if chunks else 0.0,
+    }
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(samples):
+    ttft = [s["ttft"] for s in samples]
+    total = [s["total"] for s in samples]
+    return {
+        "streams": len(samples),
+        "ttft_ms": {"p50": percentile(ttft, 50) * 1000, "p95": percentile(ttft, 95) * 1000},
+        "total_ms": {"p50": percentile(total, 50) * 1000, "p95": percentile(total, 95) * 1000},
+        "chunks_per_s": statistics.mean(s["chunks_per_s"] for s in samples),
+        "overhead_per_chunk_us": statistics.mean(s["overhead_per_chunk"] for s in samples) * 1e6,
+    }
+
+def bench(provider_name, handler, layers, concurrencies, rounds, profile):
+    results = []
+    with StubServer(handler, profile) as server:
+        base, model = make_provider(provider_name, server.url)
+        # Làm nóng kết nối và các cache trước khi đo
+        run_stream(base, model, profile)
+        for layer in layers:
+            provider = wrap(base, layer)
+            for concurrency in concurrencies:
+                samples = []
+                with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                    for _ in range(rounds):
+                        futures = [executor.submit(run_stream, provider, model, profile) for _ in range(concurrency)]
+                        samples.extend(f.result() for f in futures)
+                result = {"provider": provider_name, "layer": layer, "concurrency": concurrency}
+                result.update(summarize(samples))
+                results.append(result)
+                print(f"{provider_name:<10} {layer:<10} x{concurrency:<3} "
+                      f"ttft p50 {result['ttft_ms']['p50']:.1f}ms  total p50 {result['total_ms']['p50']:.1f}ms  "
+                      f"{result['chunks_per_s']:.0f} chunks/s  overhead {result['overhead_per_chunk_us']:.0f}us/chunk",
+                      file=sys.stderr)
+    return results
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+HANDLERS = {
+    "OpenAI": OpenAIHandler,
+    "DeepSeek": OpenAIHandler,
+    "Anthropic": AnthropicHandler,
+    "Google": GeminiHandler,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--providers", nargs="+", default=list(HANDLERS), choices=list(HANDLERS))
+    parser.add_argument("--layers", nargs="+", default=["raw", "governed", "resilient"],
+                        choices=["raw", "governed", "resilient"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 64])
+    parser.add_argument("--rounds", type=int, default=3, help="Số lượt chạy cho mỗi mức đồng thời")
+    parser.add_argument("--chunks", type=int, default=200)
+    parser.add_argument("--ttft", type=float, default=0.05, help="Độ trễ chunk đầu của server (giây)")
+    parser.add_argument("--inter-chunk", type=float, default=0.005, help="Độ trễ giữa các chunk của server (giây)")
+    parser.add_argument("--output", help="File JSON kết quả (mặc định in ra stdout)")
+    args = parser.parse_args(argv)
+
+    profile = StreamProfile(chunks=args.chunks, ttft=args.ttft, inter_chunk=args.inter_chunk)
+    report = {
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "profile": vars(profile),
+        "results": [],
+    }
+    for provider_name in args.providers:
+        report["results"].extend(bench(provider_name, HANDLERS[provider_name], args.layers,
+                                       args.concurrency, args.rounds, profile))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
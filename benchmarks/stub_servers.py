@@ -0,0 +1,148 @@
+"""Server HTTP giả lập wire format streaming của OpenAI, Anthropic và Gemini (REST) để benchmark offline."""
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StreamProfile:
+    """Hình dạng stream server trả về: số chunk, độ trễ chunk đầu và giữa các chunk (giây)."""
+    def __init__(self, chunks=200, ttft=0.05, inter_chunk=0.005, text="token "):
+        self.chunks = chunks
+        self.ttft = ttft
+        self.inter_chunk = inter_chunk
+        self.text = text
+
+    def expected_duration(self):
+        return self.ttft + max(self.chunks - 1, 0) * self.inter_chunk
+
+class _StreamingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    profile = StreamProfile()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _start(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+    def _write(self, data):
+        raw = data.encode("utf-8")
+        self.wfile.write(f"{len(raw):x}\r\n".encode("ascii") + raw + b"\r\n")
+        self.wfile.flush()
+
+    def _finish(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _paced(self):
+        """Lần lượt trả về chỉ số chunk, ngủ đúng độ trễ của profile trước mỗi chunk."""
+        profile = self.profile
+        for i in range(profile.chunks):
+            time.sleep(profile.ttft if i == 0 else profile.inter_chunk)
+            yield i
+
+class OpenAIHandler(_StreamingHandler):
+    """POST /v1/chat/completions với stream=True (server-sent events)."""
+    def do_POST(self):
+        body = self._read_body()
+        self._start("text/event-stream")
+        for i in self._paced():
+            chunk = {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "bench"),
+                "choices": [{"index": 0, "delta": {"content": self.profile.text}, "finish_reason": None}],
+            }
+            self._write(f"data: {json.dumps(chunk)}\n\n")
+        final = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model", "bench"),
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }
+        self._write(f"data: {json.dumps(final)}\n\n")
+        self._write("data: [DONE]\n\n")
+        self._finish()
+
+class AnthropicHandler(_StreamingHandler):
+    """POST /v1/messages với stream=true (các event message_start ... message_stop)."""
+    def _event(self, name, data):
+        self._write(f"event: {name}\ndata: {json.dumps(data)}\n\n")
+
+    def do_POST(self):
+        body = self._read_body()
+        self._start("text/event-stream")
+        self._event("message_start", {"type": "message_start", "message": {
+            "id": "msg_bench", "type": "message", "role": "assistant", "content": [],
+            "model": body.get("model", "bench"), "stop_reason": None, "stop_sequence": None,
+            "usage": {"input_tokens": 10, "output_tokens": 1},
+        }})
+        self._event("content_block_start", {"type": "content_block_start", "index": 0,
+                                            "content_block": {"type": "text", "text": ""}})
+        for i in self._paced():
+            self._event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                "delta": {"type": "text_delta", "text": self.profile.text}})
+        self._event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        self._event("message_delta", {"type": "message_delta",
+                                      "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                      "usage": {"output_tokens": self.profile.chunks}})
+        self._event("message_stop", {"type": "message_stop"})
+        self._finish()
+
+class GeminiHandler(_StreamingHandler):
+    """POST /v1beta/models/{model}:streamGenerateContent (REST transport, mảng JSON được stream)."""
+    def do_POST(self):
+        self._read_body()
+        self._start("application/json")
+        self._write("[")
+        for i in self._paced():
+            chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": self.profile.text}]}, "index": 0}]}
+            if i == self.profile.chunks - 1:
+                chunk["candidates"][0]["finishReason"] = "STOP"
+                chunk["usageMetadata"] = {"promptTokenCount": 10, "candidatesTokenCount": self.profile.chunks,
+                                          "totalTokenCount": 10 + self.profile.chunks}
+            self._write(("," if i else "") + json.dumps(chunk) + "\r\n")
+        self._write("]")
+        self._finish()
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Đủ chỗ cho 64 stream đồng thời kết nối cùng lúc
+    request_queue_size = 256
+
+    def handle_error(self, request, client_address):
+        # Client đóng stream giữa chừng (hủy, timeout, stall) là chuyện bình thường khi benchmark
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+class StubServer:
+    """Chạy một handler trên cổng ngẫu nhiên của localhost trong background thread."""
+    def __init__(self, handler_class, profile):
+        handler = type(handler_class.__name__, (handler_class,), {"profile": profile})
+        self.httpd = _Server(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
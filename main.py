@@ -1,5 +1,6 @@
 import streamlit as st
 from utils.config import initialize_session_state, setup_sidebar
+from utils.db import get_index_report
 
 # Thiết lập cấu hình trang
 st.set_page_config(
@@ -44,6 +45,12 @@ def home_page():
 
     st.info("💡 **Mẹo:** Bạn có thể chuyển đổi giữa các công cụ bằng cách sử dụng thanh điều hướng bên trái.")
 
+    # Kiểm tra index MongoDB có được các truy vấn chính sử dụng hay không
+    if st.session_state.get("user_group") == "ADMIN":
+        with st.expander("🗂️ Index MongoDB"):
+            if st.button("Kiểm tra index và query plan"):
+                st.json(get_index_report())
+
 # Define navigation pages
 pages = [
     st.Page(home_page, title="Home", icon="🏠", default=True),
@@ -1,9 +1,13 @@
 import streamlit as st
 import datetime
 import json
-from utils.config import initialize_session_state, setup_sidebar, check_configuration
-from utils.llm import get_llm_provider
-from utils.db import get_all_prompts, save_chat_session, get_all_chat_sessions, get_chat_session, delete_chat_session
+from utils.config import initialize_session_state, setup_sidebar, check_configuration, get_provider_api_keys
+from utils.llm import get_llm_provider, describe_prompt_cache
+from utils.context import get_context_manager
+from utils.compaction import get_compactor, build_compacted_messages
+from utils.streaming import StreamRenderer
+from utils.jobs import get_job_manager, get_session_key, follow_job, follow_jobs, mark_truncated
+from utils.db import get_all_prompts, save_chat_session, list_chat_sessions, count_chat_sessions, get_chat_session, get_chat_messages, delete_chat_session, MESSAGE_PAGE_SIZE
 
 # --- Cấu hình trang ---
 st.set_page_config(page_title="Chat AI", layout="wide")
@@ -13,18 +17,84 @@ check_configuration()
 
 st.title("💬 Chat AI")
 
+# Số phiên chat mỗi trang trong tab lịch sử
+SESSION_PAGE_SIZE = 20
+
+def job_response(job):
+    """Nội dung câu trả lời của job chat: text đã sinh hoặc thông báo lỗi."""
+    if job.error:
+        return f"Lỗi: {job.error}"
+    return mark_truncated(job.text) if job.cancelled else job.text
+
+def compare_candidates(api_keys):
+    """Các cặp (nhà cung cấp, model) có thể so sánh, chỉ gồm nhà cung cấp đã có API key."""
+    candidates = []
+    for provider_name, api_key in api_keys.items():
+        try:
+            provider = get_llm_provider(provider_name, api_key, page="chat")
+        except Exception:
+            continue
+        if provider:
+            candidates.extend((provider_name, model) for model in provider.get_models())
+    return candidates
+
+def compare_result(job, api_provider, model):
+    """Kết quả và số liệu của một model trong chế độ so sánh."""
+    if job is None:
+        return {"api_provider": api_provider, "model": model, "content": "Lỗi: không tìm thấy câu trả lời",
+                "error": True, "ttft": None, "latency": None, "chars": 0}
+    return {
+        "api_provider": api_provider,
+        "model": model,
+        "content": job_response(job),
+        "error": job.error is not None,
+        "ttft": job.ttft,
+        "latency": job.latency,
+        "chars": len(job.text)
+    }
+
+def pick_compare_result(compare_run, index):
+    """Đưa câu trả lời được chọn vào lịch sử chat, lưu phiên chat kèm số liệu so sánh. Trả về id phiên chat."""
+    results = compare_run["results"]
+    chosen = results[index]
+    st.session_state.chat_history.append({"role": "assistant", "content": chosen["content"]})
+    comparison = {
+        "turn": len(st.session_state.chat_history) - 2,
+        "chosen": index,
+        "candidates": [{k: v for k, v in result.items() if k != "content"} for result in results]
+    }
+    st.session_state.chat_comparisons = st.session_state.chat_comparisons + [comparison]
+    session_to_save = dict(
+        compare_run["session_to_save"],
+        api_provider=chosen["api_provider"],
+        model=chosen["model"],
+        history=list(st.session_state.chat_history),
+        comparisons=st.session_state.chat_comparisons
+    )
+    session_id = save_chat_session(session_to_save)
+    if session_id:
+        st.session_state.current_chat_session_id = session_id
+    st.session_state.compare_run = None
+    return session_id
+
 # --- Tạo tabs ---
 tab1, tab2, tab3 = st.tabs(["💬 Chat", "📚 Lịch sử Chat", "📊 Xuất & Tóm tắt"])
 
 with tab1:
     # --- Lấy provider và models ---
     try:
-        llm_provider = get_llm_provider(st.session_state.api_provider, st.session_state.api_key)
+        llm_provider = get_llm_provider(st.session_state.api_provider, st.session_state.api_key, page="chat")
         available_models = llm_provider.get_models() if llm_provider else []
     except (ValueError, Exception) as e:
         st.error(e)
         st.stop()
 
+    # --- Nhận bản tóm tắt hội thoại đã được tạo (và lưu) trong background ---
+    compactor = get_compactor()
+    compacted = compactor.collect(st.session_state.current_chat_session_id)
+    if compacted and compacted[1] > st.session_state.chat_summary_upto:
+        st.session_state.chat_summary, st.session_state.chat_summary_upto = compacted
+
     # --- Cài đặt cho phiên chat ---
     col1, col2 = st.columns(2)
     with col1:
@@ -49,38 +119,57 @@ with tab1:
         if use_max_tokens:
             max_tokens = st.number_input("Max Tokens:", min_value=50, max_value=8192, value=2048)
 
+        # Gửi cùng một câu hỏi tới nhiều model và hiển thị song song
+        compare_mode = st.checkbox("🆚 So sánh nhiều model", value=False)
+
+    compare_targets = []
+    if compare_mode:
+        api_keys = get_provider_api_keys()
+        compare_labels = {f"{p} · {m}": (p, m) for p, m in compare_candidates(api_keys)}
+        default_label = f"{st.session_state.api_provider} · {selected_model}"
+        selected_labels = st.multiselect(
+            "Model so sánh:",
+            list(compare_labels),
+            default=[default_label] if default_label in compare_labels else [],
+            help="Nhà cung cấp khác cần API key trong mục [API_KEYS] của secrets (chỉ dành cho ADMIN)"
+        )
+        compare_targets = [compare_labels[label] for label in selected_labels]
+        if len(compare_targets) < 2:
+            st.info("Chọn ít nhất 2 model để so sánh.")
+
     # --- Hiển thị lịch sử chat ---
     for message in st.session_state.chat_history:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
 
     # --- Xử lý input của người dùng ---
-    if user_prompt := st.chat_input("Nhập câu hỏi của bạn..."):
+    job_manager = get_job_manager()
+    session_key = get_session_key()
+    # Không nhận câu hỏi mới khi câu trả lời trước vẫn đang được sinh
+    running_job = job_manager.get(session_key, "chat")
+    # Lượt so sánh phải được chọn câu trả lời trước khi hỏi tiếp
+    input_locked = (running_job is not None and not running_job.done) or st.session_state.get("compare_run") is not None
+    if user_prompt := st.chat_input("Nhập câu hỏi của bạn...", disabled=input_locked):
         st.session_state.chat_history.append({"role": "user", "content": user_prompt})
         with st.chat_message("user"):
             st.markdown(user_prompt)
 
-        with st.chat_message("assistant"):
-            message_placeholder = st.empty()
-            full_response = ""
-
-            try:
-                response_stream = llm_provider.chat_stream(
-                    messages=st.session_state.chat_history,
-                    model=selected_model,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                    system_prompt=system_prompt
-                )
-                for chunk in response_stream:
-                    full_response += chunk
-                    message_placeholder.markdown(full_response + "▌")
-                message_placeholder.markdown(full_response)
-            except Exception as e:
-                full_response = f"Lỗi: {e}"
-                message_placeholder.error(full_response)
-
-        st.session_state.chat_history.append({"role": "assistant", "content": full_response})
+        # Chỉ gửi các tin nhắn mới nhất vừa với context window của model
+        # Các lượt cũ đã được tóm tắt thì gửi bản tóm tắt thay cho nguyên văn
+        compacted_history = build_compacted_messages(
+            st.session_state.chat_history,
+            st.session_state.chat_summary,
+            st.session_state.chat_summary_upto
+        )
+        context_manager = get_context_manager()
+        messages_to_send = context_manager.select(
+            compacted_history,
+            llm_provider.get_context_window(selected_model),
+            system_prompt,
+            max_tokens
+        )
+        if context_manager.last_trimmed_messages:
+            st.caption(f"✂️ Đã bỏ {context_manager.last_trimmed_messages} tin nhắn cũ (~{context_manager.last_trimmed_tokens:,} tokens) để vừa context window.")
 
         session_to_save = {
             "_id": st.session_state.get("current_chat_session_id"),
@@ -88,27 +177,171 @@ with tab1:
             "api_provider": st.session_state.api_provider,
             "model": selected_model,
             "system_prompt": system_prompt,
-            "history": st.session_state.chat_history
+            "history": list(st.session_state.chat_history),
+            "summary": st.session_state.chat_summary,
+            "summary_upto": st.session_state.chat_summary_upto
         }
-        new_id = save_chat_session(session_to_save)
-        if new_id:
-            st.session_state.current_chat_session_id = new_id
+
+        def persist_chat(job, session_to_save=session_to_save):
+            # Chạy trong worker: lưu phiên chat kể cả khi người dùng đã rời trang
+            # Usage đi theo cancel_token của job, không lấy từ provider dùng chung giữa các job
+            job.usage = job.cancel_token.usage
+            session_to_save["history"] = session_to_save["history"] + [{"role": "assistant", "content": job_response(job)}]
+            return save_chat_session(session_to_save)
+
+        if len(compare_targets) >= 2:
+            # Mỗi model chạy trong một job riêng nên các stream song song với nhau
+            for i, (target_provider, target_model) in enumerate(compare_targets):
+                target_llm = get_llm_provider(target_provider, api_keys[target_provider], page="chat")
+                target_messages = context_manager.select(
+                    compacted_history,
+                    target_llm.get_context_window(target_model),
+                    system_prompt,
+                    max_tokens
+                )
+                job_manager.start(
+                    session_key, f"compare_{i}",
+                    lambda cancel_token, target_llm=target_llm, target_model=target_model, target_messages=target_messages: target_llm.chat_stream(
+                        messages=target_messages,
+                        model=target_model,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        system_prompt=system_prompt,
+                        cancel_token=cancel_token
+                    )
+                )
+            st.session_state.compare_run = {
+                "targets": compare_targets,
+                "session_to_save": session_to_save,
+                "results": None
+            }
+        else:
+            # Sinh câu trả lời trong background để không bị hủy khi rerun hoặc chuyển trang
+            job_manager.start(
+                session_key, "chat",
+                lambda cancel_token: llm_provider.chat_stream(
+                    messages=messages_to_send,
+                    model=selected_model,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    system_prompt=system_prompt,
+                    cancel_token=cancel_token
+                ),
+                on_complete=persist_chat
+            )
+
+    # --- Hiển thị câu trả lời đang được sinh (tiếp tục từ lần rerun trước) ---
+    chat_job = job_manager.get(session_key, "chat")
+    if chat_job is not None:
+        # Dừng stream, giữ lại phần câu trả lời đã nhận
+        if not chat_job.done and st.button("⏹️ Dừng", key="stop_chat"):
+            chat_job.cancel()
+        with st.chat_message("assistant"):
+            message_placeholder = st.empty()
+            heartbeat = st.empty()
+            follow_job(chat_job, StreamRenderer(message_placeholder), heartbeat)
+            if chat_job.error:
+                message_placeholder.error(job_response(chat_job))
+            else:
+                message_placeholder.markdown(job_response(chat_job))
+                if cache_info := describe_prompt_cache(chat_job.usage):
+                    st.caption(cache_info)
+
+        # Job đã được lưu trong worker, chỉ cần cập nhật session_state
+        if job_manager.pop(session_key, "chat", chat_job.id):
+            st.session_state.chat_history.append({"role": "assistant", "content": job_response(chat_job)})
+            if chat_job.result:
+                st.session_state.current_chat_session_id = chat_job.result
+                # Tóm tắt các lượt cũ trong background khi phiên chat đủ dài
+                compactor.schedule(
+                    chat_job.result,
+                    st.session_state.chat_history,
+                    st.session_state.chat_summary,
+                    st.session_state.chat_summary_upto,
+                    llm_provider.for_task("summarize"),
+                    selected_model
+                )
+            if input_locked:
+                st.rerun()
+
+    # --- Chế độ so sánh: hiển thị song song câu trả lời của các model ---
+    compare_run = st.session_state.get("compare_run")
+    if compare_run is not None:
+        targets = compare_run["targets"]
+        columns = st.columns(len(targets))
+        placeholders = []
+        for column, (target_provider, target_model) in zip(columns, targets):
+            with column:
+                st.markdown(f"**{target_provider} · {target_model}**")
+                placeholders.append(st.empty())
+
+        if compare_run["results"] is None:
+            compare_jobs = [job_manager.get(session_key, f"compare_{i}") for i in range(len(targets))]
+            if any(job is not None and not job.done for job in compare_jobs) and st.button("⏹️ Dừng", key="stop_compare"):
+                for job in compare_jobs:
+                    if job is not None:
+                        job.cancel()
+            live = [(job, StreamRenderer(placeholder)) for job, placeholder in zip(compare_jobs, placeholders) if job is not None]
+            follow_jobs([job for job, _ in live], [renderer for _, renderer in live], st.empty())
+            compare_run["results"] = [
+                compare_result(job, target_provider, target_model)
+                for job, (target_provider, target_model) in zip(compare_jobs, targets)
+            ]
+            for i, job in enumerate(compare_jobs):
+                if job is not None:
+                    job_manager.pop(session_key, f"compare_{i}", job.id)
+
+        for i, (column, placeholder, result) in enumerate(zip(columns, placeholders, compare_run["results"])):
+            with column:
+                if result["error"]:
+                    placeholder.error(result["content"])
+                else:
+                    placeholder.markdown(result["content"])
+                ttft = f"{result['ttft']:.2f}s" if result["ttft"] is not None else "-"
+                latency = f"{result['latency']:.2f}s" if result["latency"] is not None else "-"
+                st.caption(f"⏱️ TTFT {ttft} · Tổng {latency} · {result['chars']:,} ký tự")
+                if st.button("✅ Dùng câu trả lời này", key=f"pick_compare_{i}", disabled=result["error"]):
+                    session_id = pick_compare_result(compare_run, i)
+                    if session_id:
+                        compactor.schedule(
+                            session_id,
+                            st.session_state.chat_history,
+                            st.session_state.chat_summary,
+                            st.session_state.chat_summary_upto,
+                            llm_provider.for_task("summarize"),
+                            selected_model
+                        )
+                    st.rerun()
 
     # --- Nút chức năng ---
     if st.button("🆕 Bắt đầu phiên chat mới"):
+        abandoned_job = job_manager.pop(session_key, "chat")
+        if abandoned_job is not None:
+            abandoned_job.cancel()
+        if st.session_state.get("compare_run") is not None:
+            for i in range(len(st.session_state.compare_run["targets"])):
+                abandoned_job = job_manager.pop(session_key, f"compare_{i}")
+                if abandoned_job is not None:
+                    abandoned_job.cancel()
+            st.session_state.compare_run = None
         st.session_state.chat_history = []
         st.session_state.current_chat_session_id = None
+        st.session_state.chat_summary = None
+        st.session_state.chat_summary_upto = 0
+        st.session_state.chat_comparisons = []
         st.rerun()
 
 with tab2:
     st.subheader("📚 Lịch sử các phiên chat")
     
-    chat_sessions = get_all_chat_sessions()
+    # Danh sách chỉ chứa các trường tóm tắt; history được tải khi mở hoặc xem phiên chat
+    session_cursors = st.session_state.session_page_cursors
+    chat_sessions, next_cursor = list_chat_sessions(SESSION_PAGE_SIZE, session_cursors[-1])
     
     if not chat_sessions:
         st.info("Chưa có phiên chat nào được lưu. Hãy bắt đầu chat ở tab bên cạnh!")
     else:
-        st.write(f"Tìm thấy {len(chat_sessions)} phiên chat đã lưu:")
+        st.write(f"Tìm thấy {count_chat_sessions()} phiên chat đã lưu (trang {len(session_cursors)}):")
         
         for i, session in enumerate(chat_sessions):
             with st.container():
@@ -126,20 +359,24 @@ with tab2:
                     st.write(f"🤖 {session.get('api_provider', 'N/A')} - {session.get('model', 'N/A')}")
                     
                     # Hiển thị preview của tin nhắn cuối
-                    history = session.get('history', [])
-                    if history:
-                        last_msg = history[-1]
-                        preview = last_msg['content'][:100] + "..." if len(last_msg['content']) > 100 else last_msg['content']
-                        st.write(f"💬 Tin nhắn cuối: {preview}")
-                        st.write(f"📊 Tổng: {len(history)} tin nhắn")
+                    if session.get('message_count'):
+                        st.write(f"💬 Tin nhắn cuối: {session.get('last_message_preview')}")
+                        st.write(f"📊 Tổng: {session['message_count']} tin nhắn")
                 
                 with col2:
                     if st.button("📂 Tải lại", key=f"load_{i}"):
                         # Load session vào chat hiện tại
-                        st.session_state.chat_history = session.get('history', [])
-                        st.session_state.current_chat_session_id = session['_id']
-                        st.success(f"Đã tải phiên chat: {session.get('session_name')}")
-                        st.rerun()
+                        full_session = get_chat_session(str(session['_id']))
+                        if full_session:
+                            st.session_state.chat_history = full_session.get('history', [])
+                            st.session_state.current_chat_session_id = full_session['_id']
+                            st.session_state.chat_summary = full_session.get('summary')
+                            st.session_state.chat_summary_upto = full_session.get('summary_upto', 0)
+                            st.session_state.chat_comparisons = full_session.get('comparisons', [])
+                            st.success(f"Đã tải phiên chat: {full_session.get('session_name')}")
+                            st.rerun()
+                        else:
+                            st.error("Không tìm thấy phiên chat.")
                 
                 with col3:
                     if st.button("📋 Xem", key=f"view_{i}"):
@@ -154,17 +391,26 @@ with tab2:
                 # Hiển thị chi tiết session khi nhấn "Xem"
                 if st.session_state.get(f"viewing_{session['_id']}", False):
                     with st.expander(f"👁️ Chi tiết: {session.get('session_name')}", expanded=True):
-                        st.write(f"**System Prompt:** {session.get('system_prompt', 'N/A')}")
+                        full_session = get_chat_session(str(session['_id']), include_history=False) or {}
+                        st.write(f"**System Prompt:** {full_session.get('system_prompt', 'N/A')}")
                         st.write("**Lịch sử chat:**")
                         
-                        for msg in session.get('history', []):
+                        # Chỉ đọc số tin nhắn đang hiển thị, "Xem thêm" đọc thêm một trang
+                        view_limit = st.session_state.get(f"view_limit_{session['_id']}", MESSAGE_PAGE_SIZE)
+                        messages, has_more = get_chat_messages(full_session, 0, view_limit) if full_session else ([], False)
+                        for msg in messages:
                             role_icon = "🧑" if msg['role'] == 'user' else "🤖"
                             st.write(f"{role_icon} **{msg['role'].upper()}:**")
                             st.write(msg['content'])
                             st.write("---")
                         
+                        if has_more and st.button("⬇️ Xem thêm", key=f"more_view_{i}"):
+                            st.session_state[f"view_limit_{session['_id']}"] = view_limit + MESSAGE_PAGE_SIZE
+                            st.rerun()
+                        
                         if st.button("❌ Đóng", key=f"close_view_{i}"):
                             st.session_state[f"viewing_{session['_id']}"] = False
+                            st.session_state.pop(f"view_limit_{session['_id']}", None)
                             st.rerun()
                 
                 # Xác nhận xóa session
@@ -188,11 +434,23 @@ with tab2:
                 
                 st.divider()
 
+    # Điều hướng trang: giữ cursor của các trang đã qua để quay lại
+    if len(session_cursors) > 1 or next_cursor is not None:
+        col_prev, col_next = st.columns(2)
+        with col_prev:
+            if len(session_cursors) > 1 and st.button("⬅️ Trang trước"):
+                st.session_state.session_page_cursors = session_cursors[:-1]
+                st.rerun()
+        with col_next:
+            if next_cursor is not None and st.button("Trang sau ➡️"):
+                st.session_state.session_page_cursors = session_cursors + [next_cursor]
+                st.rerun()
+
 with tab3:
     st.subheader("📊 Xuất dữ liệu & Tóm tắt")
     
     # Chọn session để xuất hoặc tóm tắt
-    export_sessions = get_all_chat_sessions()
+    export_sessions, _ = list_chat_sessions(limit=None)
     
     if not export_sessions:
         st.info("Chưa có phiên chat nào để xuất hoặc tóm tắt.")
@@ -289,11 +547,11 @@ with tab3:
                             summary_prompt += "\nTóm tắt:"
                             
                             # Sử dụng LLM hiện tại để tạo tóm tắt
-                            llm_provider = get_llm_provider(st.session_state.api_provider, st.session_state.api_key)
+                            llm_provider = get_llm_provider(st.session_state.api_provider, st.session_state.api_key, page="chat")
                             
                             with st.spinner("Đang tạo tóm tắt..."):
                                 summary_response = ""
-                                response_stream = llm_provider.chat_stream(
+                                response_stream = llm_provider.for_task("summarize").chat_stream(
                                     messages=[{"role": "user", "content": summary_prompt}],
                                     model=available_models[0] if available_models else "gpt-3.5-turbo",
                                     temperature=0.3,
@@ -1,10 +1,10 @@
 import streamlit as st
 import asyncio
 import threading
-from concurrent.futures import ThreadPoolExecutor
 from utils.config import initialize_session_state, setup_sidebar, check_configuration
 from utils.llm import get_llm_provider
 from utils.db import get_all_prompts
+from utils.jobs import get_job_manager, get_session_key, follow_job, mark_truncated
 
 # --- Cấu hình trang ---
 st.set_page_config(page_title="Translation Tool", layout="wide")
@@ -17,7 +17,7 @@ st.write("Sử dụng AI để dịch, tóm tắt và rút ra những điểm ch
 
 # --- Lấy provider và models ---
 try:
-    llm_provider = get_llm_provider(st.session_state.api_provider, st.session_state.api_key)
+    llm_provider = get_llm_provider(st.session_state.api_provider, st.session_state.api_key, page="translation")
     available_models = llm_provider.get_models() if llm_provider else []
 except (ValueError, Exception) as e:
     st.error(f"Lỗi khởi tạo LLM provider: {e}")
@@ -112,7 +112,7 @@ st.subheader("📄 Văn bản cần xử lý")
 input_text = st.text_area("Dán văn bản gốc vào đây:", height=200, key="input_text")
 
 # --- Processing Functions ---
-def process_task(prompt_template, input_text, task_name):
+def process_task(prompt_template, input_text, task_name, cancel_token=None, task="chat"):
     """Xử lý một task riêng lẻ với LLM provider"""
     try:
         # Format prompt với input text
@@ -120,12 +120,14 @@ def process_task(prompt_template, input_text, task_name):
         messages = [{"role": "user", "content": formatted_prompt}]
         
         # Tạo response từ LLM
-        response_stream = llm_provider.chat_stream(
+        # task giúp model "auto" chọn model phù hợp với loại tác vụ
+        response_stream = llm_provider.for_task(task).chat_stream(
             messages=messages,
             model=selected_model,
             temperature=temperature,
             max_tokens=None,  # Để LLM provider tự quyết định giới hạn token
-            system_prompt=f"Bạn là một chuyên gia {task_name}. Hãy thực hiện nhiệm vụ một cách chính xác và chi tiết."
+            system_prompt=f"Bạn là một chuyên gia {task_name}. Hãy thực hiện nhiệm vụ một cách chính xác và chi tiết.",
+            cancel_token=cancel_token
         )
         
         # Collect full response
@@ -133,6 +135,10 @@ def process_task(prompt_template, input_text, task_name):
         for chunk in response_stream:
             if chunk:  # Check if chunk is not empty
                 full_response += chunk
+
+        # Người dùng bấm Dừng: giữ phần đã nhận và đánh dấu bị cắt ngắn
+        if cancel_token is not None and cancel_token.cancelled:
+            return mark_truncated(full_response.strip()) if full_response.strip() else f"⏹️ Đã dừng {task_name}."
         
         # Check if response is empty or contains error messages
         if not full_response.strip():
@@ -149,88 +155,127 @@ def process_task(prompt_template, input_text, task_name):
         return f"❌ Lỗi xử lý {task_name}: {error_message}"
 
 # --- Main Processing ---
-if st.button("🚀 Phân tích ngay", type="primary", use_container_width=True):
+job_manager = get_job_manager()
+session_key = get_session_key()
+# Mỗi tác vụ là một job nền riêng: (tên job, prompt, tên tác vụ, loại tác vụ cho routing)
+translation_tasks = {
+    "translate": ("translation_translate", translate_prompt, "dịch thuật", "translate"),
+    "summary": ("translation_summary", summary_prompt, "tóm tắt", "summarize"),
+    "vocab": ("translation_vocab", vocab_prompt, "trích xuất từ vựng", "translate"),
+}
+translation_jobs = {key: job_manager.get(session_key, job_name) for key, (job_name, _, _, _) in translation_tasks.items()}
+translation_running = any(job is not None and not job.done for job in translation_jobs.values())
+
+if st.button("🚀 Phân tích ngay", type="primary", use_container_width=True, disabled=translation_running):
     if not input_text.strip():
         st.error("Vui lòng nhập văn bản để phân tích.")
     else:
-        # Process all tasks in parallel using ThreadPoolExecutor
-        with st.spinner("AI đang xử lý tất cả các tác vụ, vui lòng chờ..."):
-            with ThreadPoolExecutor(max_workers=3) as executor:
-                # Submit all tasks
-                future_translate = executor.submit(process_task, translate_prompt, input_text, "dịch thuật")
-                future_summary = executor.submit(process_task, summary_prompt, input_text, "tóm tắt")
-                future_vocab = executor.submit(process_task, vocab_prompt, input_text, "trích xuất từ vựng")
+        # Chạy song song cả 3 tác vụ trong background
+        for key, (job_name, prompt_template, task_name, task) in translation_tasks.items():
+            translation_jobs[key] = job_manager.start(
+                session_key, job_name,
+                lambda cancel_token, prompt_template=prompt_template, task_name=task_name, task=task:
+                    [process_task(prompt_template, input_text, task_name, cancel_token, task)]
+            )
+        st.session_state.translation_input = input_text
+        st.session_state.translation_results = None
+
+if any(job is not None for job in translation_jobs.values()):
+    if any(job is not None and not job.done for job in translation_jobs.values()):
+        if st.button("⏹️ Dừng", key="stop_translation"):
+            for job in translation_jobs.values():
+                if job is not None:
+                    job.cancel()
+    heartbeat = st.empty()
+    with st.spinner("AI đang xử lý tất cả các tác vụ, vui lòng chờ..."):
+        for job in translation_jobs.values():
+            if job is not None:
+                follow_job(job, heartbeat=heartbeat)
+    results = {}
+    for key, (job_name, _, task_name, _) in translation_tasks.items():
+        job = translation_jobs[key]
+        if job is None:
+            results[key] = f"❌ Lỗi xử lý {task_name}: không tìm thấy kết quả"
+            continue
+        job_manager.pop(session_key, job_name, job.id)
+        if job.error:
+            results[key] = f"❌ Lỗi xử lý {task_name}: {job.error}"
+        else:
+            results[key] = job.text
+    # Giữ kết quả qua các lần rerun (ví dụ khi bấm nút Copy)
+    st.session_state.translation_results = results
+
+if st.session_state.get("translation_results"):
+    translate_result = st.session_state.translation_results["translate"]
+    summary_result = st.session_state.translation_results["summary"]
+    vocab_result = st.session_state.translation_results["vocab"]
+    input_text = st.session_state.get("translation_input", input_text)
+
+    # Display results in 2 columns
+    col_results, col_original = st.columns([0.6, 0.4])
+    
+    with col_results:
+        st.subheader("📊 Kết quả phân tích")
+        # Create tabs for results
+        tab1, tab2, tab3 = st.tabs(["🌐 Bản dịch", "📋 Tóm tắt", "📚 Từ vựng hay"])
+        
+        with tab1:
+            st.write(f"**Bản dịch sang {target_language}:**")
+            if translate_result.startswith("Lỗi"):
+                st.error(translate_result)
+            else:
+                st.success("✅ Dịch thuật hoàn tất!")
+                st.markdown(translate_result)
                 
-                # Get results
-                translate_result = future_translate.result()
-                summary_result = future_summary.result()
-                vocab_result = future_vocab.result()
+                # Copy button
+                if st.button("📋 Copy bản dịch", key="copy_translate"):
+                    st.code(translate_result)
         
-        # Display results in 2 columns
-        col_results, col_original = st.columns([0.6, 0.4])
+        with tab2:
+            st.write("**Tóm tắt nội dung:**")
+            if summary_result.startswith("Lỗi"):
+                st.error(summary_result)
+            else:
+                st.success("✅ Tóm tắt hoàn tất!")
+                st.info(summary_result)
+                
+                # Copy button
+                if st.button("📋 Copy tóm tắt", key="copy_summary"):
+                    st.code(summary_result)
         
-        with col_results:
-            st.subheader("📊 Kết quả phân tích")
-            # Create tabs for results
-            tab1, tab2, tab3 = st.tabs(["🌐 Bản dịch", "📋 Tóm tắt", "📚 Từ vựng hay"])
-            
-            with tab1:
-                st.write(f"**Bản dịch sang {target_language}:**")
-                if translate_result.startswith("Lỗi"):
-                    st.error(translate_result)
-                else:
-                    st.success("✅ Dịch thuật hoàn tất!")
-                    st.markdown(translate_result)
-                    
-                    # Copy button
-                    if st.button("📋 Copy bản dịch", key="copy_translate"):
-                        st.code(translate_result)
-            
-            with tab2:
-                st.write("**Tóm tắt nội dung:**")
-                if summary_result.startswith("Lỗi"):
-                    st.error(summary_result)
-                else:
-                    st.success("✅ Tóm tắt hoàn tất!")
-                    st.info(summary_result)
-                    
-                    # Copy button
-                    if st.button("📋 Copy tóm tắt", key="copy_summary"):
-                        st.code(summary_result)
-            
-            with tab3:
-                st.write("**Từ/Cụm từ đáng chú ý:**")
-                if vocab_result.startswith("Lỗi"):
-                    st.error(vocab_result)
-                else:
-                    st.success("✅ Trích xuất từ vựng hoàn tất!")
-                    st.markdown(vocab_result)
-                    
-                    # Copy button
-                    if st.button("📋 Copy từ vựng", key="copy_vocab"):
-                        st.code(vocab_result)
+        with tab3:
+            st.write("**Từ/Cụm từ đáng chú ý:**")
+            if vocab_result.startswith("Lỗi"):
+                st.error(vocab_result)
+            else:
+                st.success("✅ Trích xuất từ vựng hoàn tất!")
+                st.markdown(vocab_result)
+                
+                # Copy button
+                if st.button("📋 Copy từ vựng", key="copy_vocab"):
+                    st.code(vocab_result)
+    
+    with col_original:
+        st.subheader("📄 Văn bản gốc")
+        st.write("*Được format để tiện so sánh:*")
         
-        with col_original:
-            st.subheader("📄 Văn bản gốc")
-            st.write("*Được format để tiện so sánh:*")
+        # Try to render as markdown first, fallback to plain text
+        try:
+            # Display as markdown for better formatting
+            st.markdown("---")
+            st.markdown(input_text)
+            st.markdown("---")
             
-            # Try to render as markdown first, fallback to plain text
-            try:
-                # Display as markdown for better formatting
-                st.markdown("---")
-                st.markdown(input_text)
-                st.markdown("---")
-                
-                # Show text stats
-                word_count = len(input_text.split())
-                char_count = len(input_text)
-                st.caption(f"📈 Thống kê: {word_count} từ, {char_count} ký tự")
+            # Show text stats
+            word_count = len(input_text.split())
+            char_count = len(input_text)
+            st.caption(f"📈 Thống kê: {word_count} từ, {char_count} ký tự")
+            
+          
                 
-              
-                    
-            except Exception as e:
-                # If markdown rendering fails, show as plain text
-                st.text_area("Văn bản gốc:", input_text, height=300, disabled=True, key="original_text_display")
+        except Exception as e:
+            # If markdown rendering fails, show as plain text
+            st.text_area("Văn bản gốc:", input_text, height=300, disabled=True, key="original_text_display")
 
 # --- Additional Features ---
 with st.expander("💡 Hướng dẫn sử dụng"):
@@ -1,10 +1,8 @@
 import streamlit as st
 import pandas as pd
 import re
-from datetime import datetime
 from utils.config import initialize_session_state, setup_sidebar, check_configuration
-from utils.db import get_collection
-from bson import ObjectId
+from utils.db import delete_template, get_all_templates, increment_template_usage, save_template, update_template
 
 # --- Cấu hình trang ---
 st.set_page_config(page_title="Prompt Template Manager", layout="wide")
@@ -15,57 +13,6 @@ check_configuration()
 st.title("🎨 Quản lý Prompt Template")
 st.write("Tạo, quản lý và render các prompt template với biến động.")
 
-# --- Hàm database cho templates ---
-def get_all_templates():
-    """Lấy tất cả prompt templates từ DB."""
-    templates_coll = get_collection("prompt_templates")
-    if templates_coll is not None:
-        return list(templates_coll.find().sort("created_at", -1))
-    return []
-
-def save_template(name, template_content, variables, description=""):
-    """Lưu một template mới."""
-    templates_coll = get_collection("prompt_templates")
-    if templates_coll is not None:
-        doc = {
-            "name": name,
-            "template_content": template_content,
-            "variables": variables,
-            "description": description,
-            "created_at": datetime.now(),
-            "updated_at": datetime.now(),
-            "used_count": 0
-        }
-        result = templates_coll.insert_one(doc)
-        return result.inserted_id
-    return None
-
-def update_template(template_id, data):
-    """Cập nhật một template."""
-    templates_coll = get_collection("prompt_templates")
-    if templates_coll is not None:
-        data["updated_at"] = datetime.now()
-        templates_coll.update_one({"_id": ObjectId(template_id)}, {"$set": data})
-        return True
-    return False
-
-def delete_template(template_id):
-    """Xóa một template."""
-    templates_coll = get_collection("prompt_templates")
-    if templates_coll is not None:
-        templates_coll.delete_one({"_id": ObjectId(template_id)})
-        return True
-    return False
-
-def increment_usage_count(template_id):
-    """Tăng số lần sử dụng template."""
-    templates_coll = get_collection("prompt_templates")
-    if templates_coll is not None:
-        templates_coll.update_one(
-            {"_id": ObjectId(template_id)}, 
-            {"$inc": {"used_count": 1}}
-        )
-
 # --- Hàm tiện ích ---
 def extract_variables(template_content):
     """Trích xuất các biến từ template content (định dạng {variable_name})."""
@@ -485,7 +432,7 @@ with tab3:
                             st.markdown("---")
                             
                             # Tăng số lần sử dụng
-                            increment_usage_count(selected_template_id)
+                            increment_template_usage(selected_template_id)
                             
                             # Lưu vào session state để có thể sử dụng ở tab khác
                             st.session_state['last_rendered_prompt'] = rendered_prompt
@@ -2,8 +2,10 @@ import streamlit as st
 import io
 import PyPDF2
 from utils.config import initialize_session_state, setup_sidebar, check_configuration
-from utils.llm import get_llm_provider
+from utils.llm import get_llm_provider, describe_prompt_cache
 from utils.db import get_all_prompts
+from utils.streaming import StreamRenderer
+from utils.jobs import get_job_manager, get_session_key, follow_job
 
 # --- Cấu hình trang ---
 st.set_page_config(page_title="Markmap Generator", layout="wide")
@@ -33,7 +35,7 @@ with st.expander("ℹ️ Thông tin về Markmap"):
 
 # --- Lấy provider và models ---
 try:
-    llm_provider = get_llm_provider(st.session_state.api_provider, st.session_state.api_key)
+    llm_provider = get_llm_provider(st.session_state.api_provider, st.session_state.api_key, page="markmap")
     available_models = llm_provider.get_models() if llm_provider else []
 except (ValueError, Exception) as e:
     st.error(f"Lỗi khởi tạo LLM provider: {e}")
@@ -202,73 +204,102 @@ markmap:
     if uploaded_content.strip() and manual_content.strip():
         st.info("📂 Files được upload sẽ dùng làm ngữ cảnh tham khảo. Chỉ nội dung nhập thủ công sẽ được chuyển thành markmap.")
     
-    if st.button("🚀 Generate Markmap", type="primary", disabled=not all_content.strip()):
+    job_manager = get_job_manager()
+    session_key = get_session_key()
+    markmap_job = job_manager.get(session_key, "markmap")
+
+    if st.button("🚀 Generate Markmap", type="primary",
+                 disabled=not all_content.strip() or (markmap_job is not None and not markmap_job.done)):
         if all_content.strip():
-            with st.spinner("Đang tạo markmap..."):
-                try:
-                    # Sử dụng custom base prompt hoặc default
-                    if use_custom_prompt and custom_base_prompt.strip():
-                        base_prompt = custom_base_prompt
-                    else:
-                        base_prompt = default_prompt
+            # Sử dụng custom base prompt hoặc default
+            if use_custom_prompt and custom_base_prompt.strip():
+                base_prompt = custom_base_prompt
+            else:
+                base_prompt = default_prompt
 
-                    # Thêm context từ files nếu có
-                    if context_content.strip():
-                        base_prompt += f"\n\n=== NGỮ CẢNH THAM KHẢO (từ files đã upload) ===\n{context_content}\n=== HẾT NGỮ CẢNH THAM KHẢO ===\n"
-                    
-                    if custom_requirements.strip():
-                        base_prompt += f"\n\nYêu cầu bổ sung: {custom_requirements}"
-                    
-                    base_prompt += f"\n\nNội dung cần chuyển đổi thành markmap:\n{all_content}"
-                    
-                    # Generate với LLM
-                    messages = [{"role": "user", "content": base_prompt}]
-                    
-                    # Stream response
-                    response_text = ""
-                    response_container = st.empty()
-                    
-                    system_prompt_text = "Bạn là chuyên gia tạo mindmap chuyên nghiệp. Luôn trả về format Markdown hoàn hảo cho markmap." if language == "Tiếng Việt" else "You are a professional mindmap expert. Always return perfect Markdown format for markmap."
-                    
-                    for chunk in llm_provider.chat_stream(
-                        messages=messages,
-                        model=selected_model,
-                        temperature=temperature,
-                        max_tokens=None,
-                        system_prompt=system_prompt_text
-                    ):
-                        response_text += chunk
-                        # Combine config with response for preview
-                        full_markmap = f"{markmap_config.strip()}\n\n{response_text}"
-                        response_container.markdown(f"**Markmap Result:**\n```markdown\n{full_markmap}\n```")
-                    
-                    # Final result with config
-                    final_markmap = f"{markmap_config.strip()}\n\n{response_text}"
-                    
-                    # Hiển thị kết quả cuối cùng
-                    st.success("✅ Đã tạo markmap thành công!")
-                    
-                  
-                    
-                    # Thông tin hướng dẫn sử dụng
-                    with st.expander("💡 Cách sử dụng Markmap"):
-                        st.write("""
-                        **Cách sử dụng kết quả:**
-                        1. Copy nội dung markmap ở trên
-                        2. Vào [markmap.js.org/try](https://markmap.js.org/try)
-                        3. Paste nội dung vào editor
-                        4. Xem mindmap tương tác được tạo
-                        
-                        **Hoặc sử dụng trong VSCode:**
-                        - Cài extension "Markmap for VSCode"
-                        - Tạo file .md với nội dung trên
-                        - Sử dụng command "Markmap: Open"
-                        """)
-                        
-                except Exception as e:
-                    st.error(f"Lỗi khi tạo markmap: {e}")
+            system_prompt_text = "Bạn là chuyên gia tạo mindmap chuyên nghiệp. Luôn trả về format Markdown hoàn hảo cho markmap." if language == "Tiếng Việt" else "You are a professional mindmap expert. Always return perfect Markdown format for markmap."
+
+            # Phần cố định (hướng dẫn + ngữ cảnh từ files) nằm trong system prompt để
+            # giữ nguyên từng byte giữa các lần tạo, provider có thể cache lại prefix này
+            system_prompt_text += f"\n\n{base_prompt}"
+            if context_content.strip():
+                system_prompt_text += f"\n\n=== NGỮ CẢNH THAM KHẢO (từ files đã upload) ===\n{context_content}\n=== HẾT NGỮ CẢNH THAM KHẢO ===\n"
+
+            # Phần thay đổi mỗi lần tạo nằm trong tin nhắn của người dùng
+            user_content = ""
+            if custom_requirements.strip():
+                user_content += f"Yêu cầu bổ sung: {custom_requirements}\n\n"
+            user_content += f"Nội dung cần chuyển đổi thành markmap:\n{all_content}"
+
+            # Generate với LLM
+            messages = [{"role": "user", "content": user_content}]
+            markmap_provider = llm_provider.for_task("markmap")
+
+            def record_usage(job):
+                job.usage = job.cancel_token.usage
+
+            # Sinh trong background để nút Dừng có thể ngắt stream
+            markmap_job = job_manager.start(
+                session_key, "markmap",
+                lambda cancel_token: markmap_provider.chat_stream(
+                    messages=messages,
+                    model=selected_model,
+                    temperature=temperature,
+                    max_tokens=None,
+                    system_prompt=system_prompt_text,
+                    cancel_token=cancel_token
+                ),
+                on_complete=record_usage
+            )
         else:
             st.warning("Vui lòng nhập nội dung hoặc upload file trước khi tạo markmap.")
+
+    if markmap_job is not None:
+        if not markmap_job.done and st.button("⏹️ Dừng", key="stop_markmap"):
+            markmap_job.cancel()
+
+        # Stream response
+        response_container = st.empty()
+        heartbeat = st.empty()
+        config_header = markmap_config.strip()
+        # Combine config with response for preview
+        renderer = StreamRenderer(
+            response_container,
+            format_fn=lambda text: f"**Markmap Result:**\n```markdown\n{config_header}\n\n{text}\n```",
+            cursor=""
+        )
+        follow_job(markmap_job, renderer, heartbeat)
+        response_text = renderer.close()
+        if cache_info := describe_prompt_cache(markmap_job.usage):
+            st.caption(cache_info)
+        job_manager.pop(session_key, "markmap", markmap_job.id)
+
+        if markmap_job.error:
+            st.error(f"Lỗi khi tạo markmap: {markmap_job.error}")
+        else:
+            # Final result with config
+            final_markmap = f"{markmap_config.strip()}\n\n{response_text}"
+            
+            # Hiển thị kết quả cuối cùng
+            if markmap_job.cancelled:
+                st.warning("⏹️ Đã dừng - markmap bị cắt ngắn, chỉ gồm phần đã sinh.")
+            else:
+                st.success("✅ Đã tạo markmap thành công!")
+            
+            # Thông tin hướng dẫn sử dụng
+            with st.expander("💡 Cách sử dụng Markmap"):
+                st.write("""
+                **Cách sử dụng kết quả:**
+                1. Copy nội dung markmap ở trên
+                2. Vào [markmap.js.org/try](https://markmap.js.org/try)
+                3. Paste nội dung vào editor
+                4. Xem mindmap tương tác được tạo
+                
+                **Hoặc sử dụng trong VSCode:**
+                - Cài extension "Markmap for VSCode"
+                - Tạo file .md với nội dung trên
+                - Sử dụng command "Markmap: Open"
+                """)
     
     # Preview section nếu có nội dung
     if all_content.strip():
@@ -0,0 +1,155 @@
+import os
+import sqlite3
+import threading
+import time
+import streamlit as st
+from utils.llm import ProviderWrapper, canonical_request_hash, is_cancelled, is_error_response
+
+# Cấu hình mặc định cho cache response, có thể ghi đè bằng biến môi trường
+DEFAULT_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", os.path.join(".cache", "llm_responses.sqlite3"))
+DEFAULT_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+DEFAULT_TTL_SECONDS = int(os.environ.get("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+# Kích thước mỗi chunk khi phát lại response từ cache
+REPLAY_CHUNK_SIZE = 200
+
+class ResponseCache:
+    """Cache response hoàn chỉnh trong file SQLite với TTL và LRU eviction theo dung lượng."""
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " response TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+        self._conn.commit()
+
+    def get(self, key):
+        """Trả về response đã cache hoặc None nếu không có/đã hết hạn."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, response):
+        """Lưu response, bỏ qua response rỗng hoặc thông báo lỗi của provider."""
+        if not response.strip() or is_error_response(response):
+            with self._lock:
+                self.skipped += 1
+            return False
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, now, now)
+            )
+            self.stores += 1
+            self._evict(now)
+            self._conn.commit()
+        return True
+
+    def _evict(self, now):
+        # Xóa bản ghi hết hạn, sau đó xóa bản ghi ít dùng nhất cho tới khi dưới giới hạn dung lượng
+        self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "skipped": self.skipped,
+                "entries": entries,
+                "bytes": total,
+            }
+
+def replay_chunks(text, chunk_size=REPLAY_CHUNK_SIZE):
+    """Chia response đã cache thành các chunk để phát lại qua giao diện generator."""
+    for start in range(0, len(text), chunk_size):
+        yield text[start:start + chunk_size]
+
+class CachedProvider(ProviderWrapper):
+    """Bọc một LLMProvider, trả response từ cache khi request giống hệt request trước đó."""
+    def __init__(self, inner, cache):
+        super().__init__(inner)
+        self.cache = cache
+
+    def _key(self, messages, model, temperature, max_tokens, system_prompt):
+        return canonical_request_hash(self.provider_name, messages, model, temperature, max_tokens, system_prompt)
+
+    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        key = self._key(messages, model, temperature, max_tokens, system_prompt)
+        cached = self.cache.get(key)
+        if cached is not None:
+            yield from replay_chunks(cached)
+            return
+        chunks = []
+        for chunk in self.inner.chat_stream(messages, model, temperature, max_tokens, system_prompt, cancel_token):
+            chunks.append(chunk)
+            yield chunk
+        # Chỉ lưu khi stream đã chạy hết (không bị lỗi, dừng giữa chừng hoặc bị hủy)
+        if not is_cancelled(cancel_token):
+            self.cache.put(key, "".join(chunks))
+
+    async def achat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        key = self._key(messages, model, temperature, max_tokens, system_prompt)
+        cached = self.cache.get(key)
+        if cached is not None:
+            for chunk in replay_chunks(cached):
+                yield chunk
+            return
+        chunks = []
+        async for chunk in self.inner.achat_stream(messages, model, temperature, max_tokens, system_prompt, cancel_token):
+            chunks.append(chunk)
+            yield chunk
+        if not is_cancelled(cancel_token):
+            self.cache.put(key, "".join(chunks))
+
+@st.cache_resource
+def get_response_cache():
+    """Trả về ResponseCache dùng chung cho toàn bộ process."""
+    return ResponseCache()
@@ -0,0 +1,415 @@
+import asyncio
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import httpx
+from google.api_core import exceptions as core_exceptions
+
+# Chế độ cassette: "record" ghi lại stream thật, "replay" phát lại không cần mạng
+CASSETTE_MODE = os.environ.get("LLM_CASSETTE_MODE", "")
+CASSETTE_DIR = os.environ.get("LLM_CASSETTE_DIR", os.path.join(".cache", "cassettes"))
+# Hệ số thời gian khi phát lại: 1 = như lúc ghi, 0.1 = nhanh gấp 10 lần, 0 = không chờ
+CASSETTE_TIME_SCALE = float(os.environ.get("LLM_CASSETTE_TIME_SCALE", "1"))
+CASSETTE_MODES = ("record", "replay")
+
+class CassetteNotFoundError(LookupError):
+    """Không có cassette nào cho request cần phát lại."""
+
+class ReplayedStreamError(RuntimeError):
+    """Lỗi không thể thử lại được ghi trong cassette."""
+
+class ReplayedConnectionError(ConnectionError):
+    """Lỗi tạm thời (có thể thử lại) được ghi trong cassette."""
+
+def cassette_path(directory, request_hash):
+    return os.path.join(directory, f"{request_hash}.jsonl.gz")
+
+def write_cassette(directory, request_hash, header, events):
+    """Ghi cassette dạng JSONL nén gzip: dòng đầu là header, mỗi dòng sau là một event."""
+    os.makedirs(directory, exist_ok=True)
+    path = cassette_path(directory, request_hash)
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        f.write(json.dumps(header, ensure_ascii=False) + "\n")
+        for event in events:
+            f.write(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
+    os.replace(tmp_path, path)
+    return path
+
+def read_cassette(directory, request_hash):
+    """Đọc cassette, trả về (header, events)."""
+    path = cassette_path(directory, request_hash)
+    if not os.path.exists(path):
+        raise CassetteNotFoundError(f"Không có cassette cho request {request_hash}")
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    return lines[0], lines[1:]
+
+def _canonical_body(body):
+    """Body JSON được sắp khóa để hai request giống nhau luôn cho cùng một hash."""
+    try:
+        return json.dumps(json.loads(body), sort_keys=True, ensure_ascii=False)
+    except (TypeError, ValueError):
+        return body.decode("latin-1") if isinstance(body, bytes) else str(body)
+
+def http_request_hash(request):
+    """Khóa cassette của một request HTTP: method, path và body (không gồm host, header hay API key)."""
+    raw = f"{request.method} {request.url.path}\n{_canonical_body(request.content)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def gapic_request_hash(method, request):
+    """Khóa cassette của một lời gọi GAPIC (Gemini) theo tên method và proto request."""
+    to_json = getattr(type(request), "to_json", None)
+    body = to_json(request, sort_keys=True) if to_json else json.dumps(request, sort_keys=True, default=str)
+    raw = f"{method}\n{_canonical_body(body)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class CassetteRecorder:
+    """Ghi lại từng chunk dữ liệu thô của SDK cùng khoảng thời gian giữa các chunk."""
+    def __init__(self, directory, request_hash, **header):
+        self.directory = directory
+        self.request_hash = request_hash
+        self.header = {
+            "request_hash": request_hash,
+            "recorded_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            **header,
+        }
+        self.events = []
+        self._last = time.perf_counter()
+
+    def _dt(self):
+        now = time.perf_counter()
+        dt = round(now - self._last, 6)
+        self._last = now
+        return dt
+
+    def chunk(self, **data):
+        self.events.append({"dt": self._dt(), **data})
+
+    def error(self, e):
+        from utils.llm import is_retryable_error
+        event = {"dt": self._dt(), "error": type(e).__name__, "message": str(e), "retryable": is_retryable_error(e)}
+        # Mã HTTP của lỗi google.api_core để phát lại đúng loại exception
+        if isinstance(getattr(e, "code", None), int):
+            event["code"] = e.code
+        self.events.append(event)
+        self.save()
+
+    def save(self):
+        return write_cassette(self.directory, self.request_hash, self.header, self.events)
+
+def _replay_error(event):
+    """Tạo lại exception đã ghi: lỗi httpx/google.api_core giữ nguyên loại để SDK và lớp retry xử lý như thật."""
+    message = event["message"]
+    error_class = getattr(httpx, event["error"], None)
+    if isinstance(error_class, type) and issubclass(error_class, httpx.TransportError):
+        return error_class(message)
+    if "code" in event:
+        return core_exceptions.from_http_status(event["code"], message)
+    if event.get("retryable"):
+        return ReplayedConnectionError(f"{event['error']}: {message}")
+    return ReplayedStreamError(f"{event['error']}: {message}")
+
+class _RecordingByteStream(httpx.SyncByteStream):
+    """Chuyển tiếp body của response thật và ghi lại từng chunk byte."""
+    def __init__(self, stream, recorder):
+        self._stream = stream
+        self._recorder = recorder
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                self._recorder.chunk(raw=chunk.decode("latin-1"))
+                yield chunk
+        except Exception as e:
+            self._recorder.error(e)
+            raise
+
+    def close(self):
+        # SDK có thể đóng response ngay sau event cuối (vd. [DONE] của OpenAI) mà không đọc hết body,
+        # nên cassette được ghi khi đóng với đúng phần SDK đã đọc
+        self._stream.close()
+        self._recorder.save()
+
+class _AsyncRecordingByteStream(httpx.AsyncByteStream):
+    def __init__(self, stream, recorder):
+        self._stream = stream
+        self._recorder = recorder
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                self._recorder.chunk(raw=chunk.decode("latin-1"))
+                yield chunk
+        except Exception as e:
+            self._recorder.error(e)
+            raise
+
+    async def aclose(self):
+        await self._stream.aclose()
+        self._recorder.save()
+
+class _ReplayByteStream(httpx.SyncByteStream):
+    """Phát lại body đã ghi theo đúng ranh giới chunk và nhịp thời gian (nhân time_scale)."""
+    def __init__(self, events, time_scale):
+        self._events = events
+        self._time_scale = time_scale
+        self._closed = threading.Event()
+
+    def __iter__(self):
+        for event in self._events:
+            if self._closed.wait(event["dt"] * self._time_scale) if self._time_scale else self._closed.is_set():
+                return
+            if "error" in event:
+                raise _replay_error(event)
+            yield event["raw"].encode("latin-1")
+
+    def close(self):
+        self._closed.set()
+
+class _AsyncReplayByteStream(httpx.AsyncByteStream):
+    def __init__(self, events, time_scale):
+        self._events = events
+        self._time_scale = time_scale
+        self._closed = False
+
+    async def __aiter__(self):
+        for event in self._events:
+            if self._time_scale:
+                await asyncio.sleep(event["dt"] * self._time_scale)
+            if self._closed:
+                return
+            if "error" in event:
+                raise _replay_error(event)
+            yield event["raw"].encode("latin-1")
+
+    async def aclose(self):
+        self._closed = True
+
+class CassetteTransport(httpx.BaseTransport):
+    """Transport httpx cho SDK OpenAI/Anthropic: ghi response thật hoặc phát lại từ cassette.
+
+    Khi phát lại, SDK vẫn tự parse SSE, dựng event và ném lỗi theo status code như lúc gọi API thật.
+    """
+    def __init__(self, cassette):
+        self.cassette = cassette
+        self._inner = httpx.HTTPTransport() if cassette.mode == "record" else None
+
+    def handle_request(self, request):
+        request.read()
+        request_hash = http_request_hash(request)
+        if self._inner is None:
+            header, events = read_cassette(self.cassette.directory, request_hash)
+            if "status" not in header:
+                raise _replay_error(events[-1])
+            return httpx.Response(header["status"], headers=header["headers"],
+                                  stream=_ReplayByteStream(events, self.cassette.time_scale))
+        recorder = CassetteRecorder(self.cassette.directory, request_hash, kind="http",
+                                    method=request.method, url=str(request.url.copy_with(query=None)))
+        try:
+            response = self._inner.handle_request(request)
+        except Exception as e:
+            recorder.error(e)
+            raise
+        recorder.header.update(status=response.status_code, headers=list(response.headers.multi_items()))
+        return httpx.Response(response.status_code, headers=response.headers,
+                              stream=_RecordingByteStream(response.stream, recorder), extensions=response.extensions)
+
+    def close(self):
+        if self._inner is not None:
+            self._inner.close()
+
+class AsyncCassetteTransport(httpx.AsyncBaseTransport):
+    def __init__(self, cassette):
+        self.cassette = cassette
+        self._inner = httpx.AsyncHTTPTransport() if cassette.mode == "record" else None
+
+    async def handle_async_request(self, request):
+        await request.aread()
+        request_hash = http_request_hash(request)
+        if self._inner is None:
+            header, events = read_cassette(self.cassette.directory, request_hash)
+            if "status" not in header:
+                raise _replay_error(events[-1])
+            return httpx.Response(header["status"], headers=header["headers"],
+                                  stream=_AsyncReplayByteStream(events, self.cassette.time_scale))
+        recorder = CassetteRecorder(self.cassette.directory, request_hash, kind="http",
+                                    method=request.method, url=str(request.url.copy_with(query=None)))
+        try:
+            response = await self._inner.handle_async_request(request)
+        except Exception as e:
+            recorder.error(e)
+            raise
+        recorder.header.update(status=response.status_code, headers=list(response.headers.multi_items()))
+        return httpx.Response(response.status_code, headers=response.headers,
+                              stream=_AsyncRecordingByteStream(response.stream, recorder), extensions=response.extensions)
+
+    async def aclose(self):
+        if self._inner is not None:
+            await self._inner.aclose()
+
+class _RecordingResponseIterator:
+    """Chuyển tiếp các GenerateContentResponse của Gemini và ghi mỗi proto thành JSON."""
+    def __init__(self, iterator, recorder):
+        self._iterator = iter(iterator)
+        self._source = iterator
+        self._recorder = recorder
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            response = next(self._iterator)
+        except StopIteration:
+            self._recorder.save()
+            raise
+        except Exception as e:
+            self._recorder.error(e)
+            raise
+        self._recorder.chunk(response=json.loads(type(response).to_json(response)))
+        return response
+
+    def cancel(self):
+        close = getattr(self._source, "cancel", None) or getattr(self._source, "close", None)
+        if close is not None:
+            close()
+
+class _AsyncRecordingResponseIterator:
+    def __init__(self, iterator, recorder):
+        self._iterator = iterator.__aiter__()
+        self._recorder = recorder
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            response = await self._iterator.__anext__()
+        except StopAsyncIteration:
+            self._recorder.save()
+            raise
+        except Exception as e:
+            self._recorder.error(e)
+            raise
+        self._recorder.chunk(response=json.loads(type(response).to_json(response)))
+        return response
+
+class _ReplayResponseIterator:
+    """Phát lại các GenerateContentResponse đã ghi dưới dạng proto thật của SDK."""
+    def __init__(self, events, response_type, time_scale):
+        self._events = iter(events)
+        self._response_type = response_type
+        self._time_scale = time_scale
+        self._cancelled = threading.Event()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        event = next(self._events)
+        if self._cancelled.wait(event["dt"] * self._time_scale) if self._time_scale else self._cancelled.is_set():
+            raise StopIteration
+        if "error" in event:
+            raise _replay_error(event)
+        return self._response_type.from_json(json.dumps(event["response"]))
+
+    def cancel(self):
+        self._cancelled.set()
+
+class _AsyncReplayResponseIterator:
+    def __init__(self, events, response_type, time_scale):
+        self._events = iter(events)
+        self._response_type = response_type
+        self._time_scale = time_scale
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = next(self._events, None)
+        if event is None:
+            raise StopAsyncIteration
+        if self._time_scale:
+            await asyncio.sleep(event["dt"] * self._time_scale)
+        if "error" in event:
+            raise _replay_error(event)
+        return self._response_type.from_json(json.dumps(event["response"]))
+
+class GapicCassetteClient:
+    """Bọc GenerativeServiceClient (sync hoặc async) của Gemini, ghi/phát lại stream_generate_content.
+
+    Cassette giữ từng GenerateContentResponse nên khi phát lại genai và GoogleProvider
+    vẫn xử lý chunk như thật (kể cả fallback sang parts).
+    """
+    def __init__(self, cassette, client, is_async=False):
+        self.cassette = cassette
+        self._client = client
+        self._is_async = is_async
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _replay(self, request_hash):
+        from google.ai.generativelanguage import GenerateContentResponse
+        header, events = read_cassette(self.cassette.directory, request_hash)
+        iterator_class = _AsyncReplayResponseIterator if self._is_async else _ReplayResponseIterator
+        return iterator_class(events, GenerateContentResponse, self.cassette.time_scale)
+
+    def _recorder(self, request_hash):
+        return CassetteRecorder(self.cassette.directory, request_hash, kind="gapic", method="stream_generate_content")
+
+    def stream_generate_content(self, request=None, **kwargs):
+        request_hash = gapic_request_hash("stream_generate_content", request)
+        if self._is_async:
+            return self._astream_generate_content(request_hash, request, **kwargs)
+        if self.cassette.mode == "replay":
+            return self._replay(request_hash)
+        recorder = self._recorder(request_hash)
+        try:
+            iterator = self._client.stream_generate_content(request, **kwargs)
+        except Exception as e:
+            recorder.error(e)
+            raise
+        return _RecordingResponseIterator(iterator, recorder)
+
+    async def _astream_generate_content(self, request_hash, request, **kwargs):
+        if self.cassette.mode == "replay":
+            return self._replay(request_hash)
+        recorder = self._recorder(request_hash)
+        try:
+            iterator = await self._client.stream_generate_content(request, **kwargs)
+        except Exception as e:
+            recorder.error(e)
+            raise
+        return _AsyncRecordingResponseIterator(iterator, recorder)
+
+class Cassette:
+    """Ghi/phát lại stream ở tầng wire của SDK: byte HTTP (OpenAI, Anthropic, DeepSeek) hoặc proto GAPIC (Gemini).
+
+    Phát lại không cần mạng nhưng vẫn chạy toàn bộ phần xử lý chunk của provider.
+    """
+    def __init__(self, mode, directory=CASSETTE_DIR, time_scale=CASSETTE_TIME_SCALE):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"LLM_CASSETTE_MODE không hợp lệ: {mode!r}")
+        self.mode = mode
+        self.directory = directory
+        self.time_scale = time_scale
+
+    @property
+    def variant(self):
+        """Phân biệt client có cassette với client gọi API thật trong ClientPool."""
+        return ("cassette", self.mode, self.directory, self.time_scale)
+
+    def http_client(self, is_async=False):
+        """httpx client truyền vào SDK qua tham số http_client."""
+        if is_async:
+            return httpx.AsyncClient(transport=AsyncCassetteTransport(self))
+        return httpx.Client(transport=CassetteTransport(self))
+
+    def gapic_client(self, client, is_async=False):
+        return GapicCassetteClient(self, client, is_async)
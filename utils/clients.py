@@ -0,0 +1,166 @@
+import asyncio
+import hashlib
+import inspect
+import os
+import threading
+import weakref
+from collections import OrderedDict
+import streamlit as st
+
+# Số client tối đa giữ trong pool cho toàn bộ process
+DEFAULT_MAX_CLIENTS = int(os.environ.get("LLM_CLIENT_POOL_SIZE", "32"))
+
+def hash_api_key(api_key):
+    """Băm API key để dùng làm khóa, tránh giữ key dạng rõ trong registry."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+def _close_method(client):
+    close = getattr(client, "close", None)
+    if close is None:
+        # Client GAPIC (Gemini) đóng kết nối qua transport
+        transport = getattr(client, "transport", None)
+        close = getattr(transport, "close", None)
+    return close
+
+def close_client(client):
+    """Đóng một client (sync hoặc async) và giải phóng connection pool của nó."""
+    close = _close_method(client)
+    if close is None:
+        return
+    try:
+        result = close()
+        if inspect.isawaitable(result):
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                asyncio.run(result)
+            else:
+                loop.create_task(result)
+    except Exception:
+        # Client đã bị đóng hoặc loop cũ đã kết thúc - bỏ qua
+        pass
+
+async def aclose_client(client):
+    """Đóng một client async trong event loop đang chạy (loop đã tạo ra nó)."""
+    close = _close_method(client)
+    if close is None:
+        return
+    try:
+        result = close()
+        if inspect.isawaitable(result):
+            await result
+    except Exception:
+        pass
+
+class ClientPool:
+    """Registry các client HTTP của nhà cung cấp LLM, dùng chung trong process với LRU eviction."""
+    def __init__(self, max_size=DEFAULT_MAX_CLIENTS):
+        self.max_size = max_size
+        self._clients = OrderedDict()
+        # Client async gắn với event loop tạo ra nó: mỗi loop một nhóm client, tự bỏ khi loop bị thu hồi
+        self._loop_clients = weakref.WeakKeyDictionary()
+        # Async generator theo dõi từng loop, đóng client của loop khi loop kết thúc
+        self._loop_watchers = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, provider, api_key, factory, variant="sync"):
+        """Lấy client theo (provider, hash API key, variant), tạo mới bằng factory nếu chưa có."""
+        key = (provider, hash_api_key(api_key), variant)
+        evicted = []
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                self.hits += 1
+                return client
+            self.misses += 1
+            client = factory()
+            self._clients[key] = client
+            while len(self._clients) > self.max_size:
+                _, old_client = self._clients.popitem(last=False)
+                evicted.append(old_client)
+                self.evictions += 1
+        # Đóng client bên ngoài lock để không chặn các luồng khác
+        for old_client in evicted:
+            close_client(old_client)
+        return client
+
+    def get_async(self, provider, api_key, factory, variant="async"):
+        """Lấy client async của event loop đang chạy, tạo mới bằng factory (bên trong loop) nếu chưa có.
+
+        Không dùng chung client async giữa các loop (mỗi asyncio.run/rerun có thể là một loop mới).
+        Mỗi loop giữ tối đa max_size client (LRU); client của loop được đóng khi loop kết thúc.
+        """
+        loop = asyncio.get_running_loop()
+        key = (provider, hash_api_key(api_key), variant)
+        evicted = []
+        with self._lock:
+            clients = self._loop_clients.get(loop)
+            new_loop = clients is None
+            if new_loop:
+                clients = self._loop_clients[loop] = OrderedDict()
+            client = clients.get(key)
+            if client is not None:
+                clients.move_to_end(key)
+                self.hits += 1
+                return client
+            self.misses += 1
+            client = clients[key] = factory()
+            while len(clients) > self.max_size:
+                _, old_client = clients.popitem(last=False)
+                evicted.append(old_client)
+                self.evictions += 1
+        if new_loop:
+            self._watch_loop(loop)
+        for old_client in evicted:
+            loop.create_task(aclose_client(old_client))
+        return client
+
+    def _watch_loop(self, loop):
+        """Chạy một async generator trong loop: asyncio.run gọi shutdown_asyncgens trước khi đóng loop,
+        lúc đó finally của generator đóng các client async của loop ngay trong loop đó.
+        """
+        watcher = self._close_loop_clients()
+        with self._lock:
+            self._loop_watchers[loop] = watcher
+        loop.create_task(watcher.__anext__())
+
+    async def _close_loop_clients(self):
+        # Không giữ tham chiếu tới loop để loop vẫn được thu hồi nếu không chạy shutdown_asyncgens
+        try:
+            yield
+        finally:
+            loop = asyncio.get_running_loop()
+            with self._lock:
+                clients = self._loop_clients.pop(loop, {})
+                self._loop_watchers.pop(loop, None)
+            for client in clients.values():
+                await aclose_client(client)
+
+    def clear(self):
+        """Đóng và xóa toàn bộ client trong pool."""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            close_client(client)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._clients),
+                "async_loops": len(self._loop_clients),
+                "async_clients": sum(len(clients) for clients in self._loop_clients.values()),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+@st.cache_resource
+def get_client_pool():
+    """Trả về ClientPool dùng chung cho mọi session trong process."""
+    return ClientPool()
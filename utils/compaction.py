@@ -0,0 +1,124 @@
+import collections
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+from utils.db import current_db_target, save_chat_summary
+from utils.llm import is_error_response
+
+# Bắt đầu tóm tắt khi số tin nhắn chưa được tóm tắt vượt quá ngưỡng này
+COMPACT_THRESHOLD_MESSAGES = int(os.environ.get("CHAT_COMPACT_THRESHOLD", "20"))
+# Số tin nhắn gần nhất luôn được gửi nguyên văn
+KEEP_RECENT_MESSAGES = int(os.environ.get("CHAT_COMPACT_KEEP_RECENT", "10"))
+# Số bản tóm tắt đã lưu nhưng trang chưa nhận (người dùng đã rời phiên chat) được giữ trong bộ nhớ
+MAX_UNCOLLECTED_RESULTS = 256
+
+SUMMARY_SYSTEM_PROMPT = "Bạn là trợ lý chuyên tóm tắt hội thoại. Giữ lại mọi sự kiện, quyết định, số liệu, tên riêng và yêu cầu còn dang dở; bỏ lời chào hỏi và nội dung lặp lại."
+
+def _format_turns(turns):
+    lines = []
+    for msg in turns:
+        role_name = "Người dùng" if msg['role'] == 'user' else "AI"
+        lines.append(f"{role_name}: {msg['content']}")
+    return "\n\n".join(lines)
+
+def build_summary_prompt(previous_summary, turns):
+    """Tạo prompt cập nhật bản tóm tắt với các lượt hội thoại vừa bị đẩy ra khỏi phần gần nhất."""
+    prompt = ""
+    if previous_summary:
+        prompt += f"Bản tóm tắt hiện tại của cuộc trò chuyện:\n{previous_summary}\n\n"
+        prompt += "Hãy cập nhật bản tóm tắt trên bằng cách bổ sung nội dung của các lượt hội thoại tiếp theo dưới đây. "
+    else:
+        prompt += "Hãy tóm tắt các lượt hội thoại dưới đây. "
+    prompt += "Chỉ trả về bản tóm tắt mới.\n\n"
+    prompt += _format_turns(turns)
+    return prompt
+
+def build_compacted_messages(history, summary, summary_upto):
+    """Trả về messages gửi cho LLM: bản tóm tắt (nếu có) + các tin nhắn chưa được tóm tắt."""
+    if not summary or not summary_upto:
+        return history
+    return [
+        {"role": "user", "content": f"Tóm tắt phần trước của cuộc trò chuyện:\n{summary}"},
+        {"role": "assistant", "content": "Tôi đã nắm được nội dung trước đó. Chúng ta tiếp tục."},
+    ] + history[summary_upto:]
+
+def compaction_cutoff(history, summary_upto):
+    """Vị trí mới cần tóm tắt tới, hoặc None nếu chưa vượt ngưỡng.
+
+    Vị trí luôn rơi vào một tin nhắn của user để phần gần nhất bắt đầu bằng user.
+    """
+    if len(history) - summary_upto <= COMPACT_THRESHOLD_MESSAGES:
+        return None
+    cutoff = len(history) - KEEP_RECENT_MESSAGES
+    while cutoff > summary_upto and history[cutoff]['role'] != 'user':
+        cutoff -= 1
+    return cutoff if cutoff > summary_upto else None
+
+class ConversationCompactor:
+    """Tóm tắt dần các lượt hội thoại cũ trong background thread.
+
+    Tác vụ tự lưu bản tóm tắt vào phiên chat nên không mất kết quả khi người dùng
+    đã chuyển phiên chat hoặc rời trang; collect() chỉ để trang cập nhật session_state.
+    """
+    def __init__(self, max_workers=2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="compactor")
+        self._lock = threading.Lock()
+        self._running = set()
+        self._results = collections.OrderedDict()
+
+    def schedule(self, session_id, history, summary, summary_upto, llm_provider, model):
+        """Lên lịch tóm tắt nếu cần. Trả về True nếu đã tạo tác vụ mới."""
+        cutoff = compaction_cutoff(history, summary_upto)
+        if cutoff is None or session_id is None:
+            return False
+        key = str(session_id)
+        # Database của phiên chat được lấy ngay, lúc còn trong lần chạy script của session
+        target = current_db_target()
+        with self._lock:
+            if key in self._running:
+                return False
+            self._running.add(key)
+            self._results.pop(key, None)
+        # Chỉ gộp các lượt mới bị đẩy ra, không tóm tắt lại từ đầu
+        turns = list(history[summary_upto:cutoff])
+        self._executor.submit(self._run, key, target, llm_provider, model, summary, turns, cutoff)
+        return True
+
+    def _run(self, key, target, llm_provider, model, previous_summary, turns, cutoff):
+        result = None
+        try:
+            result = self._summarize(llm_provider, model, previous_summary, turns, cutoff)
+            save_chat_summary(key, *result, target=target)
+        except Exception:
+            # Tóm tắt thất bại: giữ bản tóm tắt cũ, sẽ thử lại ở lượt sau
+            result = None
+        with self._lock:
+            self._running.discard(key)
+            if result is not None:
+                self._results[key] = result
+                while len(self._results) > MAX_UNCOLLECTED_RESULTS:
+                    self._results.popitem(last=False)
+
+    @staticmethod
+    def _summarize(llm_provider, model, previous_summary, turns, cutoff):
+        response = "".join(llm_provider.chat_stream(
+            messages=[{"role": "user", "content": build_summary_prompt(previous_summary, turns)}],
+            model=model,
+            temperature=0.2,
+            max_tokens=1024,
+            system_prompt=SUMMARY_SYSTEM_PROMPT
+        ))
+        if not response.strip() or is_error_response(response):
+            raise RuntimeError(response.strip() or "Empty summary")
+        return response.strip(), cutoff
+
+    def collect(self, session_id):
+        """Lấy kết quả tóm tắt đã xong (và đã được lưu) của session: (summary, summary_upto) hoặc None."""
+        with self._lock:
+            return self._results.pop(str(session_id), None)
+
+@st.cache_resource
+def get_compactor():
+    """Trả về ConversationCompactor dùng chung cho process."""
+    return ConversationCompactor()
@@ -1,4 +1,9 @@
+import os
 import streamlit as st
+from utils.db import is_db_offline
+
+# Các user group được dùng API key chung của operator trong secrets [API_KEYS]
+SHARED_API_KEY_GROUPS = ("ADMIN",)
 
 def get_mongo_uri_for_key(user_key):
     """Lấy MongoDB URI tương ứng với user key từ secrets."""
@@ -24,7 +29,13 @@ def initialize_session_state():
         "api_key": None,
         "db_client": None,
         "chat_history": [],
-        "current_chat_session_id": None
+        "current_chat_session_id": None,
+        "context_manager": None,
+        "chat_summary": None,
+        "chat_summary_upto": 0,
+        "chat_comparisons": [],
+        "compare_run": None,
+        "session_page_cursors": [None]
     }
     for key, value in defaults.items():
         if key not in st.session_state:
@@ -51,6 +62,8 @@ def setup_sidebar():
                 st.session_state.user_group = user_group
                 st.session_state.mongo_uri = mongo_uri
                 st.success(f"✅ Key hợp lệ - Đang sử dụng {user_group} database")
+                if is_db_offline():
+                    st.warning("📴 Tạm thời không kết nối được MongoDB - dữ liệu được lưu cục bộ và sẽ tự đồng bộ lại.")
             else:
                 st.session_state.user_key = None
                 st.session_state.user_group = None
@@ -70,10 +83,15 @@ def setup_sidebar():
         )
         # Cập nhật danh sách nhà cung cấp
         providers = ["OpenAI", "Google", "Anthropic", "DeepSeek"]
+        # Provider giả lập để benchmark toàn bộ app offline
+        if os.environ.get("ENABLE_FAKE_LLM") == "1":
+            providers.append("Fake")
+        # Provider đã chọn có thể không còn trong danh sách (ví dụ Fake khi đã tắt ENABLE_FAKE_LLM)
+        current_provider = st.session_state.get("api_provider", "OpenAI")
         st.session_state.api_provider = st.selectbox(
             "🤖 Nhà cung cấp API",
             providers,
-            index=providers.index(st.session_state.get("api_provider", "OpenAI"))
+            index=providers.index(current_provider) if current_provider in providers else 0
         )
         st.markdown("---")
         
@@ -86,6 +104,20 @@ def setup_sidebar():
         else:
             st.warning("Vui lòng nhập đầy đủ cấu hình.")
 
+def get_provider_api_keys():
+    """API key dùng được cho từng nhà cung cấp: key đang nhập ở sidebar, cộng thêm key trong
+    secrets [API_KEYS] nếu user group nằm trong SHARED_API_KEY_GROUPS.
+    """
+    api_keys = {}
+    if st.session_state.get("user_group") in SHARED_API_KEY_GROUPS:
+        try:
+            api_keys = dict(st.secrets["API_KEYS"])
+        except Exception:
+            api_keys = {}
+    if st.session_state.get("api_key"):
+        api_keys[st.session_state.api_provider] = st.session_state.api_key
+    return api_keys
+
 def check_configuration():
     """Kiểm tra xem cấu hình đã được nhập chưa và hiển thị cảnh báo nếu cần."""
     if not st.session_state.get("api_key") or not st.session_state.get("user_key"):
@@ -0,0 +1,98 @@
+import os
+import threading
+import streamlit as st
+
+# Số token dành cho output khi người dùng không giới hạn max_tokens
+DEFAULT_RESERVED_OUTPUT_TOKENS = 4096
+# Token phụ trội cho mỗi tin nhắn (role, phân tách, ...)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Giới hạn token input tùy chọn để kiểm soát chi phí, kể cả với model context lớn
+MAX_INPUT_TOKENS = int(os.environ.get("CHAT_CONTEXT_MAX_TOKENS", "0")) or None
+
+def estimate_tokens(text):
+    """Ước lượng số token của text (khoảng 3 byte UTF-8 mỗi token, thiên về an toàn)."""
+    if not text:
+        return 0
+    return len(text.encode("utf-8")) // 3 + 1
+
+class ContextWindowManager:
+    """Chọn các tin nhắn mới nhất vừa với ngân sách token của model.
+
+    Số token của từng tin nhắn được lưu lại và chỉ tính thêm cho tin nhắn mới,
+    nên mỗi lượt không phải ước lượng lại toàn bộ history.
+    """
+    def __init__(self, max_input_tokens=MAX_INPUT_TOKENS):
+        self.max_input_tokens = max_input_tokens
+        self._lock = threading.Lock()
+        self._counts = []
+        self._first = None
+        self._last = None
+        self.requests = 0
+        self.trimmed_requests = 0
+        self.trimmed_tokens_total = 0
+        self.last_trimmed_tokens = 0
+        self.last_trimmed_messages = 0
+
+    def _sync(self, messages):
+        # Nếu history bị thay thế (tải phiên khác, phiên mới, bản tóm tắt mới) thì tính lại từ đầu
+        synced = len(self._counts)
+        if synced and (
+            len(messages) < synced
+            or self._first != (messages[0]['role'], messages[0]['content'])
+            or self._last != (messages[synced - 1]['role'], messages[synced - 1]['content'])
+        ):
+            self._counts = []
+            synced = 0
+        for msg in messages[synced:]:
+            self._counts.append(estimate_tokens(msg['content']) + MESSAGE_OVERHEAD_TOKENS)
+        self._first = (messages[0]['role'], messages[0]['content']) if messages else None
+        self._last = (messages[-1]['role'], messages[-1]['content']) if messages else None
+
+    def budget(self, context_window, system_prompt, max_tokens):
+        """Số token còn lại cho history sau khi trừ system prompt và phần output."""
+        reserved_output = max_tokens if max_tokens is not None else DEFAULT_RESERVED_OUTPUT_TOKENS
+        available = context_window - estimate_tokens(system_prompt) - reserved_output
+        if self.max_input_tokens:
+            available = min(available, self.max_input_tokens)
+        return max(available, 0)
+
+    def select(self, messages, context_window, system_prompt, max_tokens):
+        """Trả về các tin nhắn mới nhất vừa ngân sách; tin nhắn cuối luôn được giữ."""
+        with self._lock:
+            self._sync(messages)
+            budget = self.budget(context_window, system_prompt, max_tokens)
+            used = 0
+            start = len(messages)
+            while start > 0:
+                cost = self._counts[start - 1]
+                if used + cost > budget and start < len(messages):
+                    break
+                used += cost
+                start -= 1
+            # Anthropic/Gemini yêu cầu history bắt đầu bằng tin nhắn của user
+            while start < len(messages) - 1 and messages[start]['role'] != 'user':
+                start += 1
+            trimmed = sum(self._counts[:start])
+            self.requests += 1
+            self.last_trimmed_messages = start
+            self.last_trimmed_tokens = trimmed
+            if start:
+                self.trimmed_requests += 1
+                self.trimmed_tokens_total += trimmed
+            return messages[start:]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "trimmed_requests": self.trimmed_requests,
+                "trimmed_tokens_total": self.trimmed_tokens_total,
+                "last_trimmed_tokens": self.last_trimmed_tokens,
+                "last_trimmed_messages": self.last_trimmed_messages,
+            }
+
+def get_context_manager():
+    """Lấy ContextWindowManager của session hiện tại."""
+    if st.session_state.get("context_manager") is None:
+        st.session_state.context_manager = ContextWindowManager()
+    return st.session_state.context_manager
@@ -1,67 +1,187 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import streamlit as st
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, MongoClient, UpdateOne
 from pymongo.errors import ConnectionFailure, OperationFailure
 from bson import ObjectId
 import datetime
+from utils.journal import JOURNAL_ENABLED, JournalReconciler, get_local_journal, get_mongo_health
+from utils.writebehind import WRITE_BEHIND_ENABLED, SessionMutation, SessionWriteBehind
+
+# Thời gian chờ chọn server/mở kết nối (ms) khi dò các cấu hình kết nối
+MONGO_PROBE_TIMEOUT_MS = int(os.environ.get("MONGO_PROBE_TIMEOUT_MS", "5000"))
+# Kích thước connection pool: đủ cho các job sinh nội dung chạy song song và thread ghi log
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", "40"))
+# Giữ sẵn vài kết nối để request đầu tiên sau khi rảnh không phải bắt tay TLS lại
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "2"))
+# File ghi nhớ cấu hình kết nối thành công của từng URI (theo hash, không lưu URI)
+CONNECT_CACHE_PATH = os.environ.get("MONGO_CONNECT_CACHE", os.path.join(".cache", "mongo_connect.json"))
+# Giây chờ trước khi chạy lại migration phiên chat đã lỗi
+MIGRATION_RETRY_INTERVAL = float(os.environ.get("CHAT_MIGRATION_RETRY_INTERVAL", "600"))
+
+# Các cấu hình kết nối được thử: (tên, mô tả, tham số riêng)
+CONNECTION_CANDIDATES = [
+    # Cấu hình chính với TLS configuration hiện đại
+    ("tls", "phương pháp chính", {
+        "tls": True,  # Sử dụng tls thay vì ssl
+        "tlsAllowInvalidCertificates": True,  # Cho phép certificate không hợp lệ
+        "retryWrites": True,  # Cho phép retry writes
+        "w": "majority",  # Write concern
+    }),
+    # Cấu hình thay thế 1 với SSL legacy
+    ("ssl_legacy", "phương pháp thay thế 1", {
+        "ssl": True,
+        "ssl_cert_reqs": None,  # Không yêu cầu certificate
+        "retryWrites": True,
+    }),
+    # Cấu hình thay thế 2 (cơ bản nhất)
+    ("basic", "phương pháp thay thế 2", {}),
+]
+
+class ConnectStats:
+    """Thời gian từng lần thử kết nối MongoDB và cấu hình đã thắng, dùng để theo dõi thời gian mở trang."""
+    def __init__(self, window=50):
+        self._lock = threading.Lock()
+        self.attempts = collections.deque(maxlen=window)
+        self.connects = collections.deque(maxlen=window)
+
+    def record_attempt(self, candidate, seconds, error=None):
+        with self._lock:
+            self.attempts.append({"candidate": candidate, "seconds": seconds,
+                                  "ok": error is None, "error": type(error).__name__ if error else None})
+
+    def record_connect(self, candidate, seconds, remembered):
+        with self._lock:
+            self.connects.append({"candidate": candidate, "seconds": seconds, "remembered": remembered})
+
+    def stats(self):
+        with self._lock:
+            return {"attempts": list(self.attempts), "connects": list(self.connects)}
 
 @st.cache_resource
-def get_db_client(mongo_uri):
-    """Kết nối tới MongoDB và trả về client. Cache resource để tránh kết nối lại."""
+def get_connect_stats():
+    """Trả về ConnectStats dùng chung cho process."""
+    return ConnectStats()
+
+def _uri_key(mongo_uri):
+    return hashlib.sha256(mongo_uri.encode("utf-8")).hexdigest()[:16]
+
+def _load_connect_cache():
+    try:
+        with open(CONNECT_CACHE_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _remember_candidate(mongo_uri, candidate):
+    """Ghi nhớ cấu hình thắng của URI để process sau kết nối ngay từ lần thử đầu."""
+    cache = _load_connect_cache()
+    if cache.get(_uri_key(mongo_uri)) == candidate:
+        return
+    cache[_uri_key(mongo_uri)] = candidate
+    try:
+        os.makedirs(os.path.dirname(CONNECT_CACHE_PATH) or ".", exist_ok=True)
+        with open(CONNECT_CACHE_PATH, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+    except OSError:
+        # Không ghi được thì lần sau dò lại từ đầu
+        pass
+
+def _probe(mongo_uri, options):
+    """Mở client với một cấu hình và ping. Trả về (client hoặc None, số giây, lỗi)."""
+    started = time.perf_counter()
+    client = None
     try:
-        # Thử phương pháp kết nối chính (với TLS configuration hiện đại)
         client = MongoClient(
-            mongo_uri, 
-            serverSelectionTimeoutMS=30000,  # Tăng timeout
-            connectTimeoutMS=30000,
+            mongo_uri,
+            serverSelectionTimeoutMS=MONGO_PROBE_TIMEOUT_MS,
+            connectTimeoutMS=MONGO_PROBE_TIMEOUT_MS,
             socketTimeoutMS=30000,
-            tls=True,  # Sử dụng tls thay vì ssl
-            tlsAllowInvalidCertificates=True,  # Cho phép certificate không hợp lệ
-            retryWrites=True,  # Cho phép retry writes
-            w='majority'  # Write concern
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            **options
         )
         client.admin.command('ping')
-        st.success("✅ Kết nối MongoDB thành công!")
-        return client
+        return client, time.perf_counter() - started, None
     except Exception as e:
-        st.warning(f"⚠️ Phương pháp kết nối chính thất bại: {e}")
-        
-        # Thử phương pháp kết nối thay thế 1 (với SSL legacy)
-        try:
-            client = MongoClient(
-                mongo_uri,
-                serverSelectionTimeoutMS=30000,
-                connectTimeoutMS=30000,
-                socketTimeoutMS=30000,
-                ssl=True,  # Sử dụng SSL legacy
-                ssl_cert_reqs=None,  # Không yêu cầu certificate
-                retryWrites=True
-            )
-            client.admin.command('ping')
-            st.success("✅ Kết nối MongoDB thành công (phương pháp thay thế 1)!")
+        if client is not None:
+            client.close()
+        return None, time.perf_counter() - started, e
+
+def _close_probe(future):
+    client = future.result()[0]
+    if client is not None:
+        client.close()
+
+def _probe_all(mongo_uri, candidates, stats):
+    """Thử song song các cấu hình, cấu hình ping được đầu tiên thắng.
+
+    Trả về (tên, client, số giây) của cấu hình thắng, hoặc (None, None, {tên: lỗi}) nếu tất cả thất bại.
+    """
+    executor = ThreadPoolExecutor(max_workers=len(candidates), thread_name_prefix="mongo-probe")
+    futures = {executor.submit(_probe, mongo_uri, options): name for name, _, options in candidates}
+    errors = {}
+    try:
+        for future in as_completed(futures):
+            name = futures[future]
+            client, seconds, error = future.result()
+            stats.record_attempt(name, seconds, error)
+            if client is not None:
+                # Các lần thử còn lại chạy tiếp trong nền và tự đóng client khi xong
+                for other in futures:
+                    if other is not future:
+                        other.add_done_callback(_close_probe)
+                return name, client, seconds
+            errors[name] = error
+        return None, None, errors
+    finally:
+        executor.shutdown(wait=False)
+
+@st.cache_resource
+def get_db_client(mongo_uri):
+    """Kết nối tới MongoDB và trả về client. Cache resource để tránh kết nối lại.
+
+    Cấu hình đã thành công trước đó (kể cả ở process khác) được thử trước; nếu không có
+    hoặc thất bại thì các cấu hình được dò song song với timeout ngắn.
+    """
+    stats = get_connect_stats()
+    labels = {name: label for name, label, _ in CONNECTION_CANDIDATES}
+    started = time.perf_counter()
+    remembered = _load_connect_cache().get(_uri_key(mongo_uri))
+    candidates = CONNECTION_CANDIDATES
+    if remembered in labels:
+        options = next(options for name, _, options in CONNECTION_CANDIDATES if name == remembered)
+        client, seconds, error = _probe(mongo_uri, options)
+        stats.record_attempt(remembered, seconds, error)
+        if client is not None:
+            stats.record_connect(remembered, time.perf_counter() - started, True)
+            st.success(f"✅ Kết nối MongoDB thành công ({labels[remembered]}, {seconds:.2f}s)!")
             return client
-        except Exception as e2:
-            st.warning(f"⚠️ Phương pháp kết nối thay thế 1 thất bại: {e2}")
-            
-            # Thử phương pháp kết nối thay thế 2 (cơ bản nhất)
-            try:
-                client = MongoClient(
-                    mongo_uri,
-                    serverSelectionTimeoutMS=30000
-                )
-                client.admin.command('ping')
-                st.success("✅ Kết nối MongoDB thành công (phương pháp thay thế 2)!")
-                return client
-            except Exception as e3:
-                st.error(f"❌ Tất cả phương pháp kết nối đều thất bại:")
-                st.error(f"Lỗi chính: {e}")
-                st.error(f"Lỗi thay thế 1: {e2}")
-                st.error(f"Lỗi thay thế 2: {e3}")
-                st.info("💡 Gợi ý: Kiểm tra lại MongoDB URI và đảm bảo rằng cluster đang hoạt động.")
-                return None
+        st.warning(f"⚠️ Cấu hình kết nối đã lưu ({labels[remembered]}) thất bại: {error}")
+        candidates = [c for c in CONNECTION_CANDIDATES if c[0] != remembered]
 
-def get_database_name():
-    """Lấy tên database dựa trên user group."""
-    user_group = st.session_state.get("user_group")
+    name, client, result = _probe_all(mongo_uri, candidates, stats)
+    if client is not None:
+        _remember_candidate(mongo_uri, name)
+        stats.record_connect(name, time.perf_counter() - started, False)
+        st.success(f"✅ Kết nối MongoDB thành công ({labels[name]}, {result:.2f}s)!")
+        return client
+    st.error(f"❌ Tất cả phương pháp kết nối đều thất bại:")
+    for name, error in result.items():
+        st.error(f"Lỗi {labels[name]}: {error}")
+    st.info("💡 Gợi ý: Kiểm tra lại MongoDB URI và đảm bảo rằng cluster đang hoạt động.")
+    # Ném lỗi thay vì trả về None để cache_resource không ghi nhớ lần kết nối thất bại
+    raise ConnectionFailure("Không kết nối được MongoDB")
+
+def get_database_name(user_group=None):
+    """Lấy tên database dựa trên user group (mặc định là user group của session hiện tại)."""
+    if user_group is None:
+        user_group = st.session_state.get("user_group")
     if user_group == "ADMIN":
         return "ai_tools_admin_db"
     elif user_group == "GUEST":
@@ -69,14 +189,534 @@ def get_database_name():
     else:
         return "ai_tools_default_db"  # fallback
 
+# Index theo đúng dạng các truy vấn: {collection: [(khóa, tên index, tùy chọn)]}
+INDEX_SPECS = {
+    "chat_sessions": [
+        # list_chat_sessions: lọc user_group, sắp xếp (updated_at, _id) giảm dần để phân trang keyset
+        ([("user_group", ASCENDING), ("updated_at", DESCENDING), ("_id", DESCENDING)], "user_group_updated_at_id", {}),
+    ],
+    "chat_messages": [
+        # iter_chat_messages: đọc theo thứ tự seq; unique để ghi lại cùng tin nhắn không bị nhân đôi
+        ([("session_id", ASCENDING), ("seq", ASCENDING)], "session_id_seq", {"unique": True}),
+    ],
+    "prompt_templates": [
+        # get_all_templates: sắp xếp created_at giảm dần
+        ([("created_at", DESCENDING)], "created_at", {}),
+    ],
+}
+# Index đã tạo ở phiên bản trước nhưng không còn cần: lọc theo _id đã dùng index _id mặc định
+# (user_group chỉ là điều kiện kiểm tra thêm trên một document), index kép chỉ làm chậm mỗi lần ghi
+OBSOLETE_INDEXES = {
+    "chat_sessions": ["id_user_group"],
+    "system_prompts": ["id_user_group"],
+}
+
+# Số ký tự của tin nhắn cuối được lưu sẵn làm preview trong danh sách phiên chat
+PREVIEW_CHARS = 100
+# Số tin nhắn mỗi trang khi xem phiên chat đã lưu
+MESSAGE_PAGE_SIZE = int(os.environ.get("CHAT_MESSAGE_PAGE_SIZE", "50"))
+# Các trường trả về khi liệt kê phiên chat (không gồm history)
+SESSION_LIST_PROJECTION = {
+    "session_name": 1,
+    "created_at": 1,
+    "updated_at": 1,
+    "api_provider": 1,
+    "model": 1,
+    "last_message_preview": 1,
+    "message_count": 1,
+}
+
+def session_summary_fields(history):
+    """Preview tin nhắn cuối và số tin nhắn, lưu kèm phiên chat để danh sách không phải đọc history."""
+    preview = None
+    if history:
+        content = history[-1]['content']
+        preview = content[:PREVIEW_CHARS] + "..." if len(content) > PREVIEW_CHARS else content
+    return {"last_message_preview": preview, "message_count": len(history)}
+
+# Các trường kỹ thuật của document chat_messages, bỏ đi khi trả tin nhắn về cho trang
+MESSAGE_PROJECTION = {"_id": 0, "session_id": 0, "seq": 0, "user_group": 0, "created_at": 0}
+
+def _message_doc(session_id, seq, message, user_group, created_at):
+    return dict(message, session_id=session_id, seq=seq, user_group=user_group, created_at=created_at)
+
+class StoredMessageCounts:
+    """Số tin nhắn đã có trong chat_messages của các phiên chat vừa đọc/ghi trong process.
+
+    Lần lưu tiếp theo của phiên chat biết ngay vị trí ghi thêm, không phải đọc message_count từ MongoDB.
+    """
+    def __init__(self, max_size=10000):
+        self._lock = threading.Lock()
+        self._counts = collections.OrderedDict()
+        self.max_size = max_size
+
+    def get(self, db_name, session_id):
+        with self._lock:
+            return self._counts.get((db_name, session_id))
+
+    def set(self, db_name, session_id, count):
+        with self._lock:
+            self._counts[(db_name, session_id)] = count
+            self._counts.move_to_end((db_name, session_id))
+            while len(self._counts) > self.max_size:
+                self._counts.popitem(last=False)
+
+    def discard(self, db_name, session_id):
+        with self._lock:
+            self._counts.pop((db_name, session_id), None)
+
+@st.cache_resource
+def get_stored_message_counts():
+    """Trả về StoredMessageCounts dùng chung cho process."""
+    return StoredMessageCounts()
+
+def _write_session_mutations(mutations):
+    """Ghi một lô SessionMutation: tin nhắn mới vào chat_messages rồi metadata phiên chat, mỗi database hai bulk_write.
+
+    Tin nhắn được upsert theo (session_id, seq) nên ghi lại một lô đã ghi một phần vẫn an toàn.
+    """
+    by_db = {}
+    for mutation in mutations:
+        by_db.setdefault(id(mutation.db), (mutation.db, []))[1].append(mutation)
+    counts = get_stored_message_counts()
+    for db, group in by_db.values():
+        chat_coll = db["chat_sessions"]
+        # Vị trí bắt đầu ghi tin nhắn của các phiên chat chưa biết stored_count, đọc bằng một truy vấn
+        existing_ids = [m.session_id for m in group if m.history is not None and not m.new and m.stored_count is None]
+        stored = {}
+        if existing_ids:
+            projection = {"message_count": 1, "history": {"$slice": 0}}
+            stored = {doc["_id"]: doc for doc in chat_coll.find({"_id": {"$in": existing_ids}}, projection)}
+        message_ops = []
+        session_ops = []
+        written = []
+        for m in group:
+            update = {"$set": m.fields}
+            if m.history is not None:
+                if m.new:
+                    start = 0
+                elif m.stored_count is not None:
+                    start = m.stored_count
+                elif m.session_id in stored:
+                    # Phiên chat chưa migrate: ghi toàn bộ history sang chat_messages
+                    doc = stored[m.session_id]
+                    start = 0 if "history" in doc else doc.get("message_count", 0)
+                else:
+                    # Phiên chat đã bị xóa hoặc thuộc user group khác
+                    continue
+                message_ops.extend(
+                    UpdateOne({"session_id": m.session_id, "seq": seq},
+                              {"$setOnInsert": _message_doc(m.session_id, seq, message, m.user_group, m.created_at)},
+                              upsert=True)
+                    for seq, message in enumerate(m.history[start:], start)
+                )
+                written.append(m)
+                update["$unset"] = {"history": ""}
+            if m.new:
+                update["$setOnInsert"] = {"created_at": m.created_at}
+            session_ops.append(UpdateOne({"_id": m.session_id, "user_group": m.user_group}, update, upsert=m.new))
+        if message_ops:
+            db["chat_messages"].bulk_write(message_ops, ordered=False)
+        if session_ops:
+            chat_coll.bulk_write(session_ops, ordered=False)
+        for m in written:
+            counts.set(db.name, m.session_id, len(m.history))
+
+def _mutation_payload(mutation):
+    return {
+        "session_id": mutation.session_id,
+        "user_group": mutation.user_group,
+        "fields": mutation.fields,
+        "history": mutation.history,
+        "new": mutation.new,
+        "created_at": mutation.created_at,
+        "stored_count": mutation.stored_count,
+    }
+
+def _write_session_mutations_or_journal(mutations):
+    """Ghi lô SessionMutation; mất kết nối thì chuyển cả lô vào journal để reconciler ghi lại sau."""
+    try:
+        _write_session_mutations(mutations)
+    except ConnectionFailure:
+        if not JOURNAL_ENABLED:
+            raise
+        reconciler = get_journal_reconciler()
+        uri_keys = [reconciler.uri_key_for(m.db.client) for m in mutations]
+        if None in uri_keys:
+            raise
+        for mutation, uri_key in zip(mutations, uri_keys):
+            get_mongo_health().mark_down(uri_key)
+            payload = _mutation_payload(mutation)
+            # Lúc gửi vào hàng đợi chưa lưu bản đầy đủ (MongoDB còn hoạt động), giờ thay đổi nằm trong journal
+            _apply_snapshot((uri_key, mutation.db.name), "session_mutation", payload)
+            get_local_journal().append(uri_key, mutation.db.name, "session_mutation", payload)
+
+@st.cache_resource
+def get_session_writer():
+    """Trả về hàng đợi ghi phiên chat dùng chung cho process."""
+    # Chỉ lỗi mất kết nối mới ghi lại cả lô; lỗi khác (ví dụ document quá lớn) chỉ ảnh hưởng phiên chat đó
+    return SessionWriteBehind(_write_session_mutations_or_journal, retryable=lambda e: isinstance(e, ConnectionFailure))
+
+def _submit_session_mutation(mutation, scope=None):
+    """Đưa thay đổi phiên chat vào hàng đợi ghi nền; ghi trực tiếp nếu tắt write-behind hoặc hàng đợi đầy.
+
+    Khi cluster không truy cập được (mutation.db là None) hoặc journal còn thao tác chưa đồng bộ,
+    thay đổi được ghi vào journal để giữ đúng thứ tự. scope mặc định là journal của session hiện tại.
+    Trả về False nếu không ghi được vào đâu.
+    """
+    scope = scope or _journal_scope()
+    journalled = mutation.db is None or (scope is not None and get_local_journal().has_pending(scope[0]))
+    payload = _mutation_payload(mutation)
+    if scope is not None:
+        _apply_snapshot(scope, "session_mutation", payload, journalled=journalled)
+    if journalled:
+        if scope is None:
+            return False
+        get_local_journal().append(*scope, "session_mutation", payload)
+        return True
+    if not WRITE_BEHIND_ENABLED or not get_session_writer().submit(mutation):
+        _write_session_mutations_or_journal([mutation])
+    return True
+
+# --- Journal cục bộ khi MongoDB không truy cập được ---
+
+def _op_insert(db, payload):
+    # _id được cấp phía client nên ghi lại nhiều lần vẫn chỉ có một document
+    doc = payload["doc"]
+    db[payload["collection"]].replace_one({"_id": doc["_id"]}, doc, upsert=True)
+
+def _op_update(db, payload):
+    db[payload["collection"]].update_one(payload["filter"], {"$set": payload["data"]})
+
+def _op_increment(db, payload):
+    db[payload["collection"]].update_one(payload["filter"], {"$inc": payload["inc"]})
+
+def _op_delete(db, payload):
+    db[payload["collection"]].delete_one(payload["filter"])
+
+def _op_session_mutation(db, payload):
+    mutation = SessionMutation(db, payload["session_id"], payload["user_group"], payload["fields"],
+                               payload["history"], payload["new"])
+    mutation.created_at = payload["created_at"]
+    mutation.stored_count = payload.get("stored_count")
+    _write_session_mutations([mutation])
+
+def _op_delete_chat_session(db, payload):
+    get_stored_message_counts().discard(db.name, payload["filter"]["_id"])
+    if db["chat_sessions"].delete_one(payload["filter"]).deleted_count:
+        db["chat_messages"].delete_many({"session_id": payload["filter"]["_id"]})
+
+# Các thao tác ghi, dùng chung cho lần ghi trực tiếp và lần reconciler ghi lại từ journal
+JOURNAL_OPS = {
+    "insert": _op_insert,
+    "update": _op_update,
+    "increment": _op_increment,
+    "delete": _op_delete,
+    "session_mutation": _op_session_mutation,
+    "delete_chat_session": _op_delete_chat_session,
+}
+
+def _apply_journal_op(db, op, payload):
+    JOURNAL_OPS[op](db, payload)
+
+@st.cache_resource
+def get_journal_reconciler():
+    """Trả về JournalReconciler dùng chung cho process."""
+    return JournalReconciler(get_local_journal(), get_mongo_health(), _apply_journal_op)
+
+def _journal_scope():
+    """(uri_key, db_name) của session hiện tại trong journal, None nếu không dùng journal."""
+    if not JOURNAL_ENABLED or not st.session_state.get("mongo_uri"):
+        return None
+    return _uri_key(st.session_state.mongo_uri), get_database_name()
+
+def _mark_down():
+    """Đánh dấu cluster của session hiện tại không truy cập được."""
+    get_mongo_health().mark_down(_uri_key(st.session_state.mongo_uri))
+
+def is_db_offline():
+    """Session hiện tại đang dùng journal cục bộ vì MongoDB không truy cập được."""
+    return bool(st.session_state.get("mongo_uri")) and not get_mongo_health().available(_uri_key(st.session_state.mongo_uri))
+
+# Bản sao phiên chat: chat_sessions chỉ giữ các trường của danh sách, bản đầy đủ (kèm history) lưu riêng
+SESSION_SNAPSHOT_FIELDS = ("user_group", *SESSION_LIST_PROJECTION)
+FULL_SESSION_SNAPSHOT = "chat_sessions.full"
+
+def _session_summary(doc):
+    return {field: doc[field] for field in ("_id", *SESSION_SNAPSHOT_FIELDS) if field in doc}
+
+def _apply_snapshot(scope, op, payload, journalled=True):
+    """Áp thao tác ghi lên bản sao cục bộ để các lần đọc khi mất kết nối thấy dữ liệu mới nhất.
+
+    journalled=False khi thao tác được ghi thẳng vào MongoDB: phiên chat khi đó không chép lại history.
+    """
+    journal = get_local_journal()
+    try:
+        if op == "insert":
+            journal.put_docs(*scope, payload["collection"], [payload["doc"]])
+        elif op == "update":
+            journal.merge_doc(*scope, payload["collection"], payload["filter"]["_id"], payload["data"], create=False)
+        elif op == "increment":
+            doc = journal.get_doc(*scope, payload["collection"], payload["filter"]["_id"])
+            if doc is not None:
+                for field, amount in payload["inc"].items():
+                    doc[field] = doc.get(field, 0) + amount
+                journal.put_docs(*scope, payload["collection"], [doc])
+        elif op == "delete":
+            journal.delete_doc(*scope, payload["collection"], payload["filter"]["_id"])
+        elif op == "delete_chat_session":
+            journal.delete_doc(*scope, "chat_sessions", payload["filter"]["_id"])
+            journal.delete_doc(*scope, FULL_SESSION_SNAPSHOT, payload["filter"]["_id"])
+        elif op == "session_mutation":
+            fields = dict(payload["fields"])
+            if payload["new"]:
+                fields["created_at"] = payload["created_at"]
+            # Chỉ tạo bản sao mới khi thay đổi có đủ nội dung phiên chat
+            create = payload["new"] or payload["history"] is not None
+            journal.merge_doc(*scope, "chat_sessions", payload["session_id"],
+                              _session_summary(fields), create=create)
+            if payload["history"] is None:
+                journal.merge_doc(*scope, FULL_SESSION_SNAPSHOT, payload["session_id"], fields, create=create)
+            elif journalled:
+                fields["history"] = payload["history"]
+                journal.merge_doc(*scope, FULL_SESSION_SNAPSHOT, payload["session_id"], fields, create=create)
+            else:
+                # Không ghi lại toàn bộ history mỗi lượt chat: bỏ bản đầy đủ đã cũ,
+                # lần mở phiên chat tiếp theo từ MongoDB sẽ lưu lại (_remember_session)
+                journal.delete_doc(*scope, FULL_SESSION_SNAPSHOT, payload["session_id"])
+    except Exception:
+        # Bản sao chỉ để dự phòng, không được làm hỏng thao tác ghi
+        pass
+
+def _seed_snapshot(collection_name, docs, key=()):
+    """Nạp bản sao collection_name từ lần đọc đầu tiên trong process (docs có thể là hàm trả về document).
+
+    Các lần đọc sau không ghi SQLite; bản sao được giữ mới theo các thao tác ghi.
+    """
+    scope = _journal_scope()
+    if scope is None:
+        return
+    journal = get_local_journal()
+    key = (*scope, collection_name, *key)
+    # Khi journal còn thao tác chưa đồng bộ, dữ liệu trên MongoDB chưa có các thay đổi đó
+    if journal.is_seeded(key) or journal.has_pending(scope[0]) or not journal.seed_once(key):
+        return
+    try:
+        journal.put_docs(*scope, collection_name, docs() if callable(docs) else docs, replace_all=True)
+    except Exception:
+        pass
+
+def _remember_session(session):
+    """Lưu bản sao đầy đủ của phiên chat vừa mở, chỉ khi phiên chat đã thay đổi kể từ lần lưu trước."""
+    scope = _journal_scope()
+    if scope is None:
+        return
+    journal = get_local_journal()
+    version = (str(session["_id"]), session.get("message_count"), str(session.get("updated_at")))
+    if not journal.seed_once((*scope, FULL_SESSION_SNAPSHOT, *version)):
+        return
+    try:
+        journal.put_docs(*scope, FULL_SESSION_SNAPSHOT, [session])
+    except Exception:
+        pass
+
+def _journal_docs(collection_name):
+    """Bản sao cục bộ các document của collection, dùng khi không đọc được từ MongoDB."""
+    scope = _journal_scope()
+    return get_local_journal().docs(*scope, collection_name) if scope is not None else []
+
+def _write(collection_name, op, payload):
+    """Thực hiện thao tác ghi op trên MongoDB, hoặc ghi vào journal khi cluster không truy cập được
+    hay journal còn thao tác chưa đồng bộ (để giữ đúng thứ tự). Trả về True nếu đã ghi được vào một trong hai.
+    """
+    coll = get_collection(collection_name)
+    scope = _journal_scope()
+    if scope is not None:
+        _apply_snapshot(scope, op, payload)
+    if coll is not None and (scope is None or not get_local_journal().has_pending(scope[0])):
+        try:
+            _apply_journal_op(coll.database, op, payload)
+            return True
+        except ConnectionFailure:
+            _mark_down()
+    if scope is None:
+        return False
+    get_local_journal().append(*scope, op, payload)
+    return True
+
+def migrate_chat_sessions(client, db_name, batch_size=200):
+    """Chuyển các phiên chat cũ sang lưu tin nhắn trong chat_messages.
+
+    Mảng history của document được chép sang chat_messages (upsert theo (session_id, seq))
+    rồi mới bị xóa, kèm preview/số tin nhắn; dừng giữa chừng thì lần sau chạy tiếp được.
+    Trả về số phiên chat đã chuyển.
+    """
+    db = client[db_name]
+    chat_coll = db["chat_sessions"]
+    messages_coll = db["chat_messages"]
+    migrated = 0
+    legacy = {"$or": [{"history": {"$exists": True}}, {"message_count": {"$exists": False}}]}
+    for doc in chat_coll.find(legacy, {"history": 1, "user_group": 1, "created_at": 1}):
+        history = doc.get("history") or []
+        for offset in range(0, len(history), batch_size):
+            messages_coll.bulk_write([
+                UpdateOne({"session_id": doc["_id"], "seq": seq},
+                          {"$setOnInsert": _message_doc(doc["_id"], seq, message, doc.get("user_group"), doc.get("created_at"))},
+                          upsert=True)
+                for seq, message in enumerate(history[offset:offset + batch_size], offset)
+            ], ordered=False)
+        # Phiên chat vừa được ghi (và migrate) bởi write-behind thì giữ nguyên số tin nhắn mới hơn
+        result = chat_coll.update_one({"_id": doc["_id"], **legacy},
+                                      {"$set": session_summary_fields(history), "$unset": {"history": ""}})
+        migrated += result.modified_count
+    return migrated
+
+class MigrationRunner:
+    """Chạy migrate_chat_sessions trong background thread, một lần cho mỗi (cluster, database).
+
+    Request không phải chờ migration vì phiên chat chưa migrate vẫn đọc được từ history.
+    Lần chạy lỗi được ghi nhớ và chỉ được thử lại sau retry_interval giây.
+    """
+    def __init__(self, retry_interval=MIGRATION_RETRY_INTERVAL):
+        self._lock = threading.Lock()
+        self.retry_interval = retry_interval
+        self._jobs = {}
+
+    def start(self, client, uri_key, db_name):
+        """Bắt đầu migration nếu chưa chạy (hoặc lần lỗi trước đã đủ lâu). Trả về True nếu vừa bắt đầu."""
+        key = (uri_key, db_name)
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and (job["state"] != "failed" or time.monotonic() - job["finished_at"] < self.retry_interval):
+                return False
+            self._jobs[key] = {"state": "running", "attempts": (job or {}).get("attempts", 0) + 1}
+        threading.Thread(target=self._run, args=(key, client, db_name), name=f"migrate-{db_name}", daemon=True).start()
+        return True
+
+    def _run(self, key, client, db_name):
+        try:
+            result = {"state": "done", "migrated": migrate_chat_sessions(client, db_name)}
+        except Exception as e:
+            result = {"state": "failed", "error": f"{type(e).__name__}: {e}"}
+        with self._lock:
+            self._jobs[key].update(result, finished_at=time.monotonic())
+
+    def stats(self):
+        with self._lock:
+            return {db_name: {k: v for k, v in job.items() if k != "finished_at"} for (_, db_name), job in self._jobs.items()}
+
+@st.cache_resource
+def get_migration_runner():
+    """Trả về MigrationRunner dùng chung cho process."""
+    return MigrationRunner()
+
+@st.cache_resource
+def ensure_indexes(_client, mongo_uri, db_name):
+    """Tạo các index trong INDEX_SPECS và xóa các index trong OBSOLETE_INDEXES, một lần cho mỗi client.
+
+    create_index không làm gì nếu index đã tồn tại nên gọi lại ở process khác vẫn an toàn.
+    Trả về {collection: [tên index đã có hoặc thông báo lỗi]}.
+    """
+    db = _client[db_name]
+    result = {}
+    for collection_name, names in OBSOLETE_INDEXES.items():
+        for name in names:
+            try:
+                db[collection_name].drop_index(name)
+            except OperationFailure:
+                # Index chưa từng được tạo hoặc thiếu quyền xóa
+                pass
+    for collection_name, specs in INDEX_SPECS.items():
+        for keys, name, options in specs:
+            try:
+                db[collection_name].create_index(keys, name=name, **options)
+                result.setdefault(collection_name, []).append(name)
+            except OperationFailure as e:
+                # Thiếu quyền tạo index hoặc index cùng khóa đã có với tên khác: truy vấn vẫn chạy được
+                result.setdefault(collection_name, []).append(f"{name}: {e}")
+    return result
+
+def _plan_summary(plan):
+    """Rút gọn winningPlan thành chuỗi các stage, ví dụ "FETCH > IXSCAN(user_group_updated_at)"."""
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if plan.get("indexName"):
+            stage += f"({plan['indexName']})"
+        stages.append(stage)
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return " > ".join(stages)
+
+def get_index_report():
+    """Báo cáo index của database hiện tại: số lần dùng từng index ($indexStats) và
+    plan của các truy vấn chính (explain), để kiểm tra truy vấn không còn COLLSCAN/SORT trong bộ nhớ.
+    """
+    user_group = st.session_state.get("user_group")
+    queries = {
+        "chat_sessions": [
+            ("list_chat_sessions", {"user_group": user_group}, [("updated_at", DESCENDING), ("_id", DESCENDING)]),
+            ("get_chat_session", {"_id": ObjectId(), "user_group": user_group}, None),
+        ],
+        "chat_messages": [
+            ("iter_chat_messages", {"session_id": ObjectId()}, [("seq", ASCENDING)]),
+        ],
+        "system_prompts": [
+            ("update_prompt", {"_id": ObjectId(), "user_group": user_group}, None),
+        ],
+        "prompt_templates": [
+            ("get_all_templates", {}, [("created_at", DESCENDING)]),
+        ],
+    }
+    report = {}
+    for collection_name, shapes in queries.items():
+        coll = get_collection(collection_name)
+        if coll is None:
+            return {}
+        entry = {"indexes": {}, "plans": {}}
+        try:
+            for stat in coll.aggregate([{"$indexStats": {}}]):
+                entry["indexes"][stat["name"]] = stat["accesses"]["ops"]
+        except OperationFailure as e:
+            entry["indexes"] = str(e)
+        for query_name, query_filter, sort in shapes:
+            cursor = coll.find(query_filter)
+            if sort:
+                cursor = cursor.sort(sort)
+            try:
+                entry["plans"][query_name] = _plan_summary(cursor.explain()["queryPlanner"]["winningPlan"])
+            except OperationFailure as e:
+                entry["plans"][query_name] = str(e)
+        report[collection_name] = entry
+    return report
+
 def get_collection(collection_name):
-    """Lấy một collection từ database tương ứng với user group."""
+    """Lấy một collection từ database tương ứng với user group.
+
+    Trả về None khi chưa cấu hình hoặc khi cluster vừa lỗi kết nối (các hàm bên dưới dùng journal cục bộ).
+    """
     if st.session_state.get("mongo_uri"):
+        uri_key = _uri_key(st.session_state.mongo_uri)
+        health = get_mongo_health()
+        # Cluster vừa lỗi kết nối: dùng journal ngay thay vì chờ timeout
+        if not health.available(uri_key):
+            return None
         if "db_client" not in st.session_state or st.session_state.db_client is None:
-            st.session_state.db_client = get_db_client(st.session_state.mongo_uri)
+            try:
+                st.session_state.db_client = get_db_client(st.session_state.mongo_uri)
+            except ConnectionFailure:
+                health.mark_down(uri_key)
+                return None
         if st.session_state.db_client:
+            # Reconciler dùng client này để ghi lại journal khi kết nối trở lại
+            get_journal_reconciler().register_client(uri_key, st.session_state.db_client)
             # Sử dụng database riêng cho từng user group
             db_name = get_database_name()
+            try:
+                ensure_indexes(st.session_state.db_client, st.session_state.mongo_uri, db_name)
+            except Exception:
+                # Mất kết nối khi tạo index: không cache kết quả, lần gọi sau sẽ thử lại
+                pass
+            get_migration_runner().start(st.session_state.db_client, uri_key, db_name)
             db = st.session_state.db_client[db_name]
             collection = db[collection_name]
             return collection
@@ -85,110 +725,310 @@ def get_collection(collection_name):
 # --- Prompts Collection Functions ---
 
 def get_all_prompts():
-    """Lấy tất cả prompts từ DB của user hiện tại."""
+    """Lấy tất cả prompts từ DB của user hiện tại (từ bản sao cục bộ khi mất kết nối)."""
     prompts_coll = get_collection("system_prompts")
     if prompts_coll is not None:
-        return list(prompts_coll.find())
-    return []
+        try:
+            prompts = list(prompts_coll.find())
+        except ConnectionFailure:
+            _mark_down()
+        else:
+            _seed_snapshot("system_prompts", prompts)
+            return prompts
+    return _journal_docs("system_prompts")
 
 def save_prompt(name, content, tags):
     """Lưu một prompt mới hoặc cập nhật prompt đã có cho user hiện tại."""
-    prompts_coll = get_collection("system_prompts")
-    if prompts_coll is not None:
-        doc = {
-            "name": name,
-            "content": content,
-            "tags": tags,
-            "user_group": st.session_state.get("user_group"),  # Thêm user_group để phân biệt
-            "created_at": datetime.datetime.now(datetime.timezone.utc),
-            "last_used": None,
-            "used_count": 0
-        }
-        prompts_coll.insert_one(doc)
-        return True
-    return False
+    doc = {
+        # Cấp _id phía client để ghi lại từ journal không tạo prompt trùng
+        "_id": ObjectId(),
+        "name": name,
+        "content": content,
+        "tags": tags,
+        "user_group": st.session_state.get("user_group"),  # Thêm user_group để phân biệt
+        "created_at": datetime.datetime.now(datetime.timezone.utc),
+        "last_used": None,
+        "used_count": 0
+    }
+    return _write("system_prompts", "insert", {"collection": "system_prompts", "doc": doc})
 
 def update_prompt(prompt_id, data):
     """Cập nhật một prompt của user hiện tại."""
-    prompts_coll = get_collection("system_prompts")
-    if prompts_coll is not None:
-        # Thêm user_group filter để đảm bảo chỉ update prompt của user hiện tại
-        filter_query = {
-            "_id": ObjectId(prompt_id),
-            "user_group": st.session_state.get("user_group")
-        }
-        prompts_coll.update_one(filter_query, {"$set": data})
-        return True
-    return False
+    # Thêm user_group filter để đảm bảo chỉ update prompt của user hiện tại
+    filter_query = {
+        "_id": ObjectId(prompt_id),
+        "user_group": st.session_state.get("user_group")
+    }
+    return _write("system_prompts", "update", {"collection": "system_prompts", "filter": filter_query, "data": data})
 
 def delete_prompt(prompt_id):
     """Xóa một prompt của user hiện tại."""
-    prompts_coll = get_collection("system_prompts")
-    if prompts_coll is not None:
-        # Thêm user_group filter để đảm bảo chỉ xóa prompt của user hiện tại
-        filter_query = {
-            "_id": ObjectId(prompt_id),
-            "user_group": st.session_state.get("user_group")
-        }
-        prompts_coll.delete_one(filter_query)
-        return True
-    return False
+    # Thêm user_group filter để đảm bảo chỉ xóa prompt của user hiện tại
+    filter_query = {
+        "_id": ObjectId(prompt_id),
+        "user_group": st.session_state.get("user_group")
+    }
+    return _write("system_prompts", "delete", {"collection": "system_prompts", "filter": filter_query})
+
+# --- Prompt Templates Collection Functions ---
+
+def _naive(value):
+    """Bỏ tzinfo để so sánh thời gian đọc từ MongoDB (naive) với thời gian trong journal."""
+    return value.replace(tzinfo=None) if isinstance(value, datetime.datetime) else value
+
+def get_all_templates():
+    """Lấy tất cả prompt templates, mới nhất trước (từ bản sao cục bộ khi mất kết nối)."""
+    templates_coll = get_collection("prompt_templates")
+    if templates_coll is not None:
+        try:
+            templates = list(templates_coll.find().sort("created_at", DESCENDING))
+        except ConnectionFailure:
+            _mark_down()
+        else:
+            _seed_snapshot("prompt_templates", templates)
+            return templates
+    templates = _journal_docs("prompt_templates")
+    templates.sort(key=lambda t: _naive(t.get("created_at")) or datetime.datetime.min, reverse=True)
+    return templates
+
+def save_template(name, template_content, variables, description=""):
+    """Lưu một template mới. Trả về _id của template, None nếu không lưu được."""
+    doc = {
+        # Cấp _id phía client để ghi lại từ journal không tạo template trùng
+        "_id": ObjectId(),
+        "name": name,
+        "template_content": template_content,
+        "variables": variables,
+        "description": description,
+        "created_at": datetime.datetime.now(),
+        "updated_at": datetime.datetime.now(),
+        "used_count": 0
+    }
+    if _write("prompt_templates", "insert", {"collection": "prompt_templates", "doc": doc}):
+        return doc["_id"]
+    return None
+
+def update_template(template_id, data):
+    """Cập nhật một template."""
+    data = dict(data, updated_at=datetime.datetime.now())
+    return _write("prompt_templates", "update",
+                  {"collection": "prompt_templates", "filter": {"_id": ObjectId(template_id)}, "data": data})
+
+def delete_template(template_id):
+    """Xóa một template."""
+    return _write("prompt_templates", "delete",
+                  {"collection": "prompt_templates", "filter": {"_id": ObjectId(template_id)}})
+
+def increment_template_usage(template_id):
+    """Tăng số lần sử dụng template."""
+    return _write("prompt_templates", "increment",
+                  {"collection": "prompt_templates", "filter": {"_id": ObjectId(template_id)}, "inc": {"used_count": 1}})
 
 # --- Chat Sessions Collection Functions ---
 
-def get_all_chat_sessions():
-    """Lấy tất cả phiên chat từ DB của user hiện tại, sắp xếp theo thời gian mới nhất."""
+def _snapshot_sessions():
+    """Bản sao cục bộ các phiên chat của user hiện tại."""
+    user_group = st.session_state.get("user_group")
+    return [doc for doc in _journal_docs("chat_sessions") if doc.get("user_group") == user_group]
+
+def _list_snapshot_sessions(limit, after):
+    """list_chat_sessions trên bản sao cục bộ, cùng thứ tự và cursor như khi đọc từ MongoDB."""
+    def key(doc):
+        return _naive(doc.get("updated_at")) or datetime.datetime.min, doc["_id"]
+    sessions = sorted(_snapshot_sessions(), key=key, reverse=True)
+    if after is not None:
+        cursor = (_naive(after[0]) or datetime.datetime.min, after[1])
+        sessions = [doc for doc in sessions if key(doc) < cursor]
+    sessions = [{field: doc[field] for field in ("_id", *SESSION_LIST_PROJECTION) if field in doc} for doc in sessions]
+    if limit is None or len(sessions) <= limit:
+        return sessions, None
+    sessions = sessions[:limit]
+    return sessions, (sessions[-1].get("updated_at"), sessions[-1]["_id"])
+
+def list_chat_sessions(limit=20, after=None):
+    """Liệt kê phiên chat của user hiện tại (chỉ các trường tóm tắt, không có history), mới nhất trước.
+
+    Phân trang keyset trên (updated_at, _id): after là cursor trang trước trả về.
+    Trả về (danh sách phiên chat, cursor của trang sau hoặc None nếu đã hết). limit=None lấy tất cả.
+    Khi mất kết nối MongoDB, danh sách được đọc từ bản sao cục bộ.
+    """
+    chat_coll = get_collection("chat_sessions")
+    if chat_coll is None:
+        return _list_snapshot_sessions(limit, after)
+    filter_query = {"user_group": st.session_state.get("user_group")}
+    if after is not None:
+        updated_at, last_id = after
+        filter_query["$or"] = [
+            {"updated_at": {"$lt": updated_at}},
+            {"updated_at": updated_at, "_id": {"$lt": last_id}},
+        ]
+    cursor = chat_coll.find(filter_query, SESSION_LIST_PROJECTION).sort([("updated_at", DESCENDING), ("_id", DESCENDING)])
+    try:
+        # Lấy dư một phiên để biết còn trang sau hay không
+        sessions = list(cursor if limit is None else cursor.limit(limit + 1))
+    except ConnectionFailure:
+        _mark_down()
+        return _list_snapshot_sessions(limit, after)
+    # Lần liệt kê đầu tiên trong process nạp bản tóm tắt mọi phiên chat của user
+    _seed_snapshot("chat_sessions", lambda: chat_coll.find({"user_group": filter_query["user_group"]}, list(SESSION_SNAPSHOT_FIELDS)),
+                   key=(filter_query["user_group"],))
+    if limit is None or len(sessions) <= limit:
+        return sessions, None
+    sessions = sessions[:limit]
+    return sessions, (sessions[-1].get("updated_at"), sessions[-1]["_id"])
+
+def count_chat_sessions():
+    """Đếm số phiên chat của user hiện tại."""
     chat_coll = get_collection("chat_sessions")
     if chat_coll is not None:
-        # Filter theo user_group
-        filter_query = {"user_group": st.session_state.get("user_group")}
-        return list(chat_coll.find(filter_query).sort("updated_at", -1))
-    return []
+        try:
+            return chat_coll.count_documents({"user_group": st.session_state.get("user_group")})
+        except ConnectionFailure:
+            _mark_down()
+    return len(_snapshot_sessions())
 
-def get_chat_session(session_id):
-    """Lấy một phiên chat cụ thể theo ID của user hiện tại."""
+def get_chat_session(session_id, include_history=True):
+    """Lấy một phiên chat cụ thể theo ID của user hiện tại (từ bản sao cục bộ khi mất kết nối).
+
+    include_history=False bỏ qua việc đọc tin nhắn từ chat_messages; đọc từng trang bằng get_chat_messages.
+    """
+    # Thêm user_group filter
+    filter_query = {
+        "_id": ObjectId(session_id),
+        "user_group": st.session_state.get("user_group")
+    }
     chat_coll = get_collection("chat_sessions")
+    scope = _journal_scope()
+    session = None
+    from_db = False
     if chat_coll is not None:
-        # Thêm user_group filter
-        filter_query = {
-            "_id": ObjectId(session_id),
-            "user_group": st.session_state.get("user_group")
-        }
-        return chat_coll.find_one(filter_query)
-    return None
+        try:
+            session = chat_coll.find_one(filter_query)
+            # Phiên chat chưa được migrate vẫn còn history trong document
+            if session is not None and "history" not in session:
+                get_stored_message_counts().set(chat_coll.database.name, session["_id"], session.get("message_count", 0))
+                if include_history:
+                    session["history"] = list(iter_chat_messages(session["_id"]))
+            from_db = True
+        except ConnectionFailure:
+            _mark_down()
+    if from_db:
+        if session is not None and "history" in session:
+            _remember_session(session)
+    elif scope is not None:
+        # Chỉ phiên chat đã được mở hoặc lưu trước đó mới có bản đầy đủ (kèm history)
+        session = get_local_journal().get_doc(*scope, FULL_SESSION_SNAPSHOT, filter_query["_id"])
+        if session is not None and session.get("user_group") != filter_query["user_group"]:
+            session = None
+        if session is not None:
+            session.setdefault("history", [])
+    elif chat_coll is None:
+        return None
+    # Thay đổi còn trong hàng đợi ghi nền được áp lên bản đọc từ DB
+    pending = get_session_writer().get_pending(filter_query["_id"])
+    if pending is not None and pending.user_group == filter_query["user_group"]:
+        session = session or {"_id": pending.session_id, "created_at": pending.created_at, "history": []}
+        session.update(pending.fields)
+        if pending.history is not None:
+            session["history"] = list(pending.history)
+    return session
+
+def iter_chat_messages(session_id, batch_size=500):
+    """Đọc lần lượt các tin nhắn của một phiên chat theo thứ tự seq, từng lô batch_size từ cursor.
+
+    Không lọc theo user_group: chỉ gọi với phiên chat đã được kiểm tra quyền (ví dụ qua get_chat_session).
+    """
+    messages_coll = get_collection("chat_messages")
+    if messages_coll is None:
+        return
+    cursor = messages_coll.find({"session_id": ObjectId(session_id)}, MESSAGE_PROJECTION)
+    yield from cursor.sort("seq", ASCENDING).batch_size(batch_size)
+
+def get_chat_messages(session, start=0, limit=MESSAGE_PAGE_SIZE):
+    """Đọc một trang tin nhắn [start, start + limit) của phiên chat lấy từ get_chat_session.
+
+    Trả về (messages, has_more). Phiên chat đã có history (chưa migrate, bản cục bộ hoặc còn trong
+    hàng đợi ghi nền) được cắt trực tiếp, còn lại đọc theo seq từ chat_messages.
+    """
+    if "history" in session:
+        history = session["history"]
+        return history[start:start + limit], len(history) > start + limit
+    messages_coll = get_collection("chat_messages")
+    if messages_coll is None:
+        return [], False
+    try:
+        cursor = messages_coll.find({"session_id": session["_id"], "seq": {"$gte": start, "$lt": start + limit + 1}},
+                                    MESSAGE_PROJECTION)
+        messages = list(cursor.sort("seq", ASCENDING))
+    except ConnectionFailure:
+        _mark_down()
+        return [], False
+    return messages[:limit], len(messages) > limit
 
 def delete_chat_session(session_id):
     """Xóa một phiên chat của user hiện tại."""
-    chat_coll = get_collection("chat_sessions")
-    if chat_coll is not None:
-        # Thêm user_group filter
-        filter_query = {
-            "_id": ObjectId(session_id),
-            "user_group": st.session_state.get("user_group")
-        }
-        chat_coll.delete_one(filter_query)
-        return True
-    return False
+    # Thêm user_group filter
+    filter_query = {
+        "_id": ObjectId(session_id),
+        "user_group": st.session_state.get("user_group")
+    }
+    get_session_writer().discard(filter_query["_id"])
+    return _write("chat_sessions", "delete_chat_session", {"filter": filter_query})
 
 def save_chat_session(session_data):
-    """Lưu một phiên chat vào DB của user hiện tại."""
+    """Lưu một phiên chat vào DB của user hiện tại.
+
+    Thay đổi được đưa vào hàng đợi ghi nền nên hàm trả về ngay; phiên chat mới được cấp
+    _id phía client. Document phiên chat chỉ giữ metadata, các tin nhắn của history chưa
+    được lưu (vị trí >= message_count đã lưu) được ghi thêm vào chat_messages.
+    Khi mất kết nối MongoDB, thay đổi được ghi vào journal cục bộ.
+    """
     chat_coll = get_collection("chat_sessions")
-    if chat_coll is not None:
-        session_data["updated_at"] = datetime.datetime.now(datetime.timezone.utc)
-        session_data["user_group"] = st.session_state.get("user_group")  # Thêm user_group
-        
-        if "_id" in session_data and session_data["_id"] is not None:
-            # Update existing session - thêm user_group filter
-            filter_query = {
-                "_id": session_data["_id"],
-                "user_group": st.session_state.get("user_group")
-            }
-            chat_coll.update_one(filter_query, {"$set": session_data})
-            return session_data["_id"]
-        else:
-            # Create new session
-            session_data.pop("_id", None)
-            session_data["created_at"] = datetime.datetime.now(datetime.timezone.utc)
-            result = chat_coll.insert_one(session_data)
-            return result.inserted_id
-    return None 
\ No newline at end of file
+    if chat_coll is None and _journal_scope() is None:
+        return None
+    session_data = dict(session_data)
+    history = session_data.pop("history", None)
+    session_id = session_data.pop("_id", None)
+    new = session_id is None
+    session_id = ObjectId() if new else ObjectId(session_id)
+    user_group = st.session_state.get("user_group")
+    session_data["updated_at"] = datetime.datetime.now(datetime.timezone.utc)
+    session_data["user_group"] = user_group  # Thêm user_group
+    if history is not None:
+        history = list(history)
+        session_data.update(session_summary_fields(history))
+    db = chat_coll.database if chat_coll is not None else None
+    mutation = SessionMutation(db, session_id, user_group, session_data, history, new)
+    if db is not None and not new:
+        mutation.stored_count = get_stored_message_counts().get(db.name, session_id)
+    if not _submit_session_mutation(mutation):
+        return None
+    return session_id
+
+def current_db_target():
+    """(mongo_uri, user_group) của session hiện tại, để ghi từ background thread đúng database lúc lên lịch."""
+    return st.session_state.get("mongo_uri"), st.session_state.get("user_group")
+
+def save_chat_summary(session_id, summary, summary_upto, target=None):
+    """Lưu bản tóm tắt hội thoại và số tin nhắn đã được tóm tắt của một phiên chat.
+
+    target là current_db_target() lấy lúc lên lịch khi gọi ngoài lần chạy script (ví dụ từ compactor).
+    """
+    mongo_uri, user_group = target or current_db_target()
+    if session_id is None or not mongo_uri:
+        return False
+    uri_key = _uri_key(mongo_uri)
+    db_name = get_database_name(user_group)
+    db = None
+    health = get_mongo_health()
+    if health.available(uri_key):
+        try:
+            db = get_db_client(mongo_uri)[db_name]
+        except ConnectionFailure:
+            health.mark_down(uri_key)
+    scope = (uri_key, db_name) if JOURNAL_ENABLED else None
+    if db is None and scope is None:
+        return False
+    # Đi qua hàng đợi ghi nền để không ghi trước khi phiên chat mới kịp được tạo
+    return _submit_session_mutation(SessionMutation(db, ObjectId(session_id), user_group,
+                                                    {"summary": summary, "summary_upto": summary_upto}), scope)
@@ -0,0 +1,170 @@
+import asyncio
+import itertools
+import os
+import threading
+import time
+from collections import deque
+import streamlit as st
+from utils.clients import hash_api_key
+from utils.context import estimate_tokens
+from utils.llm import ProviderWrapper, is_cancelled
+
+# Giới hạn mặc định cho mỗi (provider, API key); ghi đè bằng biến môi trường
+DEFAULT_RPM = int(os.environ.get("LLM_MAX_RPM", "60"))
+DEFAULT_TPM = int(os.environ.get("LLM_MAX_TPM", "200000"))
+DEFAULT_MAX_IN_FLIGHT = int(os.environ.get("LLM_MAX_IN_FLIGHT", "8"))
+# Số token output giữ chỗ khi request không giới hạn max_tokens
+DEFAULT_RESERVED_OUTPUT_TOKENS = 1024
+
+class TokenBucket:
+    """Token bucket nạp lại đều theo thời gian, dung lượng bằng hạn mức mỗi phút."""
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Thời gian (giây) cần chờ để đủ amount; amount lớn hơn dung lượng chỉ cần bucket đầy."""
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+class ProviderGovernor:
+    """Giới hạn requests/phút, tokens/phút và số request đồng thời cho một (provider, API key).
+
+    Request vượt hạn mức được xếp hàng FIFO thay vì bị từ chối.
+    """
+    def __init__(self, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_in_flight = max_in_flight
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._tickets = itertools.count()
+        self.in_flight = 0
+        self.total_requests = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+
+    def _wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def acquire(self, estimated_tokens, cancel_token=None):
+        """Chờ tới lượt rồi trừ hạn mức. Trả về số token đã giữ chỗ, None nếu bị hủy khi đang chờ."""
+        ticket = next(self._tickets)
+        started = time.monotonic()
+        if cancel_token is not None:
+            cancel_token.on_cancel(self._wake)
+        with self._cond:
+            self._queue.append(ticket)
+            try:
+                while True:
+                    if is_cancelled(cancel_token):
+                        return None
+                    now = time.monotonic()
+                    self.requests.refill(now)
+                    self.tokens.refill(now)
+                    if self._queue[0] == ticket and self.in_flight < self.max_in_flight:
+                        delay = max(self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens))
+                        if delay <= 0:
+                            break
+                        self._cond.wait(delay)
+                    else:
+                        self._cond.wait()
+            finally:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+            self.requests.tokens -= 1
+            self.tokens.tokens -= min(estimated_tokens, self.tokens.capacity)
+            self.in_flight += 1
+            waited = time.monotonic() - started
+            self.total_requests += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            self.last_wait = waited
+        return estimated_tokens
+
+    def release(self, reserved_tokens, used_tokens):
+        """Trả lại slot đồng thời và hoàn phần token đã giữ chỗ nhưng không dùng."""
+        with self._cond:
+            self.in_flight -= 1
+            self.tokens.tokens = min(self.tokens.capacity, self.tokens.tokens + reserved_tokens - used_tokens)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queue_depth": len(self._queue),
+                "in_flight": self.in_flight,
+                "total_requests": self.total_requests,
+                "avg_wait": self.total_wait / self.total_requests if self.total_requests else 0.0,
+                "max_wait": self.max_wait,
+                "last_wait": self.last_wait,
+            }
+
+class GovernorRegistry:
+    """Danh sách governor dùng chung trong process, mỗi (provider, API key) một governor."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._governors = {}
+
+    def get(self, provider_name, api_key):
+        key = (provider_name, hash_api_key(api_key))
+        with self._lock:
+            if key not in self._governors:
+                self._governors[key] = ProviderGovernor()
+            return self._governors[key]
+
+    def stats(self):
+        with self._lock:
+            governors = dict(self._governors)
+        return {f"{name}:{key_hash}": g.stats() for (name, key_hash), g in governors.items()}
+
+@st.cache_resource
+def get_governor_registry():
+    """Trả về GovernorRegistry dùng chung cho process."""
+    return GovernorRegistry()
+
+def estimate_request_tokens(messages, max_tokens, system_prompt):
+    """Ước lượng số token một request sẽ tiêu tốn (input + output giữ chỗ)."""
+    input_tokens = estimate_tokens(system_prompt) + sum(estimate_tokens(m['content']) for m in messages)
+    return input_tokens, input_tokens + (max_tokens if max_tokens is not None else DEFAULT_RESERVED_OUTPUT_TOKENS)
+
+class GovernedProvider(ProviderWrapper):
+    """Bọc một LLMProvider, xếp hàng request theo hạn mức của governor."""
+    def __init__(self, inner, governor):
+        super().__init__(inner)
+        self.governor = governor
+
+    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        input_tokens, reserved = estimate_request_tokens(messages, max_tokens, system_prompt)
+        if self.governor.acquire(reserved, cancel_token) is None:
+            return
+        output_tokens = 0
+        try:
+            for chunk in self.inner.chat_stream(messages, model, temperature, max_tokens, system_prompt, cancel_token):
+                output_tokens += estimate_tokens(chunk)
+                yield chunk
+        finally:
+            self.governor.release(reserved, input_tokens + output_tokens)
+
+    async def achat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        input_tokens, reserved = estimate_request_tokens(messages, max_tokens, system_prompt)
+        # Chờ trong thread riêng để không chặn event loop
+        if await asyncio.to_thread(self.governor.acquire, reserved, cancel_token) is None:
+            return
+        output_tokens = 0
+        try:
+            async for chunk in self.inner.achat_stream(messages, model, temperature, max_tokens, system_prompt, cancel_token):
+                output_tokens += estimate_tokens(chunk)
+                yield chunk
+        finally:
+            self.governor.release(reserved, input_tokens + output_tokens)
@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from utils.llm import CancelToken
+
+# Số job sinh nội dung chạy đồng thời tối đa trong process
+MAX_JOB_WORKERS = int(os.environ.get("LLM_JOB_WORKERS", "32"))
+# Job đã xong nhưng không được trang nào nhận lại sẽ bị xóa sau khoảng thời gian này (giây)
+FINISHED_JOB_TTL = 3600
+# Chu kỳ cập nhật trạng thái khi chờ job, để Streamlit kịp xử lý nút Dừng (giây)
+HEARTBEAT_INTERVAL = 1.0
+TRUNCATED_MARKER = "\n\n⏹️ *Đã dừng - nội dung bị cắt ngắn.*"
+
+def mark_truncated(text):
+    """Đánh dấu nội dung bị cắt ngắn do người dùng dừng stream."""
+    return text + TRUNCATED_MARKER
+
+class GenerationJob:
+    """Một lần sinh nội dung chạy nền; các chunk được nối vào buffer để trang đọc lại từ offset bất kỳ."""
+    def __init__(self, owner, name):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.name = name
+        self.chunks = []
+        self.status = "running"
+        self.error = None
+        self.result = None
+        # Số token provider báo về (nếu có), do on_complete gán
+        self.usage = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.first_chunk_at = None
+        self.cancel_token = CancelToken()
+        self._cond = threading.Condition()
+
+    @property
+    def done(self):
+        return self.status != "running"
+
+    @property
+    def cancelled(self):
+        return self.cancel_token.cancelled
+
+    @property
+    def ttft(self):
+        """Thời gian từ lúc tạo job tới chunk đầu tiên (giây), None nếu chưa có chunk."""
+        return self.first_chunk_at - self.created_at if self.first_chunk_at else None
+
+    @property
+    def latency(self):
+        """Tổng thời gian chạy của job (giây), tính tới hiện tại nếu chưa xong."""
+        return (self.finished_at or time.time()) - self.created_at
+
+    def cancel(self):
+        """Yêu cầu dừng stream; phần nội dung đã sinh vẫn được giữ lại."""
+        if not self.done:
+            self.cancel_token.cancel()
+
+    @property
+    def text(self):
+        with self._cond:
+            return "".join(self.chunks)
+
+    def append(self, chunk):
+        with self._cond:
+            if self.first_chunk_at is None:
+                self.first_chunk_at = time.time()
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.error = error
+            self.status = "error" if error else "done"
+            self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def read(self, offset, timeout=0.1):
+        """Chờ tối đa timeout giây để có chunk mới sau offset. Trả về (chunks mới, đã xong hay chưa)."""
+        with self._cond:
+            if len(self.chunks) <= offset and not self.done:
+                self._cond.wait(timeout)
+            return self.chunks[offset:], self.done
+
+class JobManager:
+    """Chạy các job sinh nội dung trong thread pool, tách khỏi vòng đời của một lần chạy script."""
+    def __init__(self, max_workers=MAX_JOB_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-job")
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def start(self, owner, name, stream_fn, on_complete=None):
+        """Chạy stream_fn(cancel_token) trong background và trả về job.
+
+        on_complete(job) được gọi trong worker sau khi stream kết thúc (kể cả khi lỗi),
+        giá trị trả về được lưu ở job.result. Worker mang ScriptRunContext của session
+        gọi hàm này nên vẫn dùng được st.session_state (ví dụ để lưu vào DB).
+        """
+        job = GenerationJob(owner, name)
+        ctx = get_script_run_ctx()
+        with self._lock:
+            self._cleanup()
+            self._jobs[(owner, name)] = job
+        self._executor.submit(self._run, job, stream_fn, on_complete, ctx)
+        return job
+
+    @staticmethod
+    def _run(job, stream_fn, on_complete, ctx):
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        error = None
+        try:
+            for chunk in stream_fn(job.cancel_token):
+                job.append(chunk)
+        except Exception as e:
+            error = e
+        if on_complete:
+            job.error = error
+            try:
+                job.result = on_complete(job)
+            except Exception as e:
+                error = error or e
+        job.finish(error)
+
+    def get(self, owner, name):
+        with self._lock:
+            return self._jobs.get((owner, name))
+
+    def cancel(self, owner, name):
+        job = self.get(owner, name)
+        if job is not None:
+            job.cancel()
+        return job
+
+    def pop(self, owner, name, job_id=None):
+        """Gỡ job khỏi danh sách (khi trang đã nhận kết quả). Chỉ gỡ nếu đúng job_id khi được truyền."""
+        with self._lock:
+            job = self._jobs.get((owner, name))
+            if job is not None and (job_id is None or job.id == job_id):
+                return self._jobs.pop((owner, name))
+            return None
+
+    def _cleanup(self):
+        now = time.time()
+        expired = [key for key, job in self._jobs.items()
+                   if job.done and now - job.finished_at > FINISHED_JOB_TTL]
+        for key in expired:
+            del self._jobs[key]
+
+@st.cache_resource
+def get_job_manager():
+    """Trả về JobManager dùng chung cho process."""
+    return JobManager()
+
+def follow_jobs(jobs, renderers=None, heartbeat=None, poll_interval=0.1):
+    """Đọc song song các chunk của nhiều job (ghi vào renderer tương ứng nếu có) cho tới khi tất cả kết thúc.
+
+    heartbeat là placeholder được cập nhật định kỳ: Streamlit chỉ ngắt script ở các lệnh st,
+    nên không có nó thì lần bấm nút Dừng phải chờ đến khi có chunk mới.
+    """
+    renderers = renderers or [None] * len(jobs)
+    offsets = [0] * len(jobs)
+    pending = set(range(len(jobs)))
+    started_at = min((job.created_at for job in jobs), default=time.time())
+    last_beat = time.monotonic()
+    while pending:
+        # Chia đều thời gian chờ để job chậm không giữ chậm việc hiển thị của job khác
+        timeout = poll_interval / len(pending)
+        for i in sorted(pending):
+            new_chunks, done = jobs[i].read(offsets[i], timeout)
+            offsets[i] += len(new_chunks)
+            if renderers[i] is not None:
+                for chunk in new_chunks:
+                    renderers[i].write(chunk)
+            if done:
+                pending.discard(i)
+        if heartbeat is not None and time.monotonic() - last_beat >= HEARTBEAT_INTERVAL:
+            heartbeat.caption(f"⏳ Đang sinh... {time.time() - started_at:.0f}s")
+            last_beat = time.monotonic()
+    if heartbeat is not None:
+        heartbeat.empty()
+
+def follow_job(job, renderer=None, heartbeat=None):
+    """Đọc các chunk của một job (ghi vào renderer nếu có) cho tới khi job kết thúc."""
+    follow_jobs([job], [renderer], heartbeat)
+
+def get_session_key():
+    """Khóa ổn định của browser session hiện tại, dùng để gắn job với session."""
+    if not st.session_state.get("session_key"):
+        st.session_state.session_key = uuid.uuid4().hex
+    return st.session_state.session_key
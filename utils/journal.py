@@ -0,0 +1,266 @@
+import os
+import sqlite3
+import threading
+import time
+import streamlit as st
+from bson import json_util
+from pymongo.errors import ConnectionFailure
+
+# Bật/tắt journal cục bộ khi MongoDB không truy cập được
+JOURNAL_ENABLED = os.environ.get("DB_JOURNAL", "1") == "1"
+# File SQLite (WAL) chứa các thao tác ghi chờ đồng bộ và bản sao dữ liệu đọc gần nhất
+JOURNAL_PATH = os.environ.get("DB_JOURNAL_PATH", os.path.join(".cache", "journal.sqlite3"))
+# Sau khi MongoDB lỗi kết nối, thời gian (giây) dùng journal trước khi thử kết nối lại trên request
+MONGO_RETRY_COOLDOWN = float(os.environ.get("MONGO_RETRY_COOLDOWN", "30"))
+# Chu kỳ (giây) reconciler kiểm tra kết nối và ghi lại journal vào MongoDB
+RECONCILE_INTERVAL = float(os.environ.get("DB_RECONCILE_INTERVAL", "10"))
+# Số thao tác tối đa mỗi lượt ghi lại
+RECONCILE_BATCH = 100
+
+class LocalJournal:
+    """Journal append-only trong SQLite: các thao tác ghi chưa vào được MongoDB (bảng ops, theo thứ tự id)
+    và bản sao các document đọc/ghi gần nhất (bảng docs) để trang vẫn hiển thị được khi mất kết nối.
+
+    Mọi bản ghi được khóa theo (uri_key, db_name); uri_key là hash của MongoDB URI, không lưu URI.
+    """
+    def __init__(self, path=JOURNAL_PATH):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        # Các bản sao đã được nạp trong process này (xem seed_once)
+        self._seeded = set()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS ops (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uri_key TEXT NOT NULL,
+            db_name TEXT NOT NULL,
+            op TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            error TEXT)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ops_uri_key_id ON ops (uri_key, error, id)")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS docs (
+            uri_key TEXT NOT NULL,
+            db_name TEXT NOT NULL,
+            collection TEXT NOT NULL,
+            doc_id TEXT NOT NULL,
+            doc TEXT NOT NULL,
+            PRIMARY KEY (uri_key, db_name, collection, doc_id))""")
+
+    # --- Thao tác ghi chờ đồng bộ ---
+
+    def append(self, uri_key, db_name, op, payload):
+        with self._lock:
+            self._conn.execute("INSERT INTO ops (uri_key, db_name, op, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+                               (uri_key, db_name, op, json_util.dumps(payload), time.time()))
+
+    def has_pending(self, uri_key):
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM ops WHERE uri_key = ? AND error IS NULL LIMIT 1", (uri_key,)).fetchone()
+        return row is not None
+
+    def pending(self, uri_key, limit=RECONCILE_BATCH):
+        """Các thao tác chưa ghi của uri_key theo đúng thứ tự đã ghi: [(id, db_name, op, payload)]."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, db_name, op, payload FROM ops WHERE uri_key = ? AND error IS NULL ORDER BY id LIMIT ?",
+                (uri_key, limit)).fetchall()
+        return [(op_id, db_name, op, json_util.loads(payload)) for op_id, db_name, op, payload in rows]
+
+    def done(self, op_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM ops WHERE id = ?", (op_id,))
+
+    def fail(self, op_id, error):
+        """Đánh dấu thao tác không thể ghi (lỗi không phải do mất kết nối) để không chặn các thao tác sau."""
+        with self._lock:
+            self._conn.execute("UPDATE ops SET error = ? WHERE id = ?", (error, op_id))
+
+    def stats(self):
+        with self._lock:
+            pending, failed = self._conn.execute(
+                "SELECT COUNT(*) - COUNT(error), COUNT(error) FROM ops").fetchone()
+        return {"pending": pending, "failed": failed}
+
+    # --- Bản sao document ---
+
+    def is_seeded(self, key):
+        with self._lock:
+            return key in self._seeded
+
+    def seed_once(self, key):
+        """True nếu key chưa được nạp bản sao trong process này (và đánh dấu đã nạp).
+
+        Bản sao chỉ được nạp một lần khi đọc, sau đó được cập nhật theo các thao tác ghi,
+        để việc đọc khi MongoDB hoạt động bình thường không phải ghi SQLite.
+        """
+        with self._lock:
+            if key in self._seeded:
+                return False
+            self._seeded.add(key)
+            return True
+
+    def get_doc(self, uri_key, db_name, collection, doc_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT doc FROM docs WHERE uri_key = ? AND db_name = ? AND collection = ? AND doc_id = ?",
+                (uri_key, db_name, collection, str(doc_id))).fetchone()
+        return json_util.loads(row[0]) if row else None
+
+    def docs(self, uri_key, db_name, collection):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT doc FROM docs WHERE uri_key = ? AND db_name = ? AND collection = ?",
+                (uri_key, db_name, collection)).fetchall()
+        return [json_util.loads(doc) for doc, in rows]
+
+    def put_docs(self, uri_key, db_name, collection, docs, replace_all=False, merge=False):
+        """Lưu bản sao các document. replace_all=True khi docs là toàn bộ collection (bỏ document đã bị xóa);
+        merge=True để giữ các trường của bản sao cũ mà docs không có (ví dụ history khi docs chỉ là bản tóm tắt)."""
+        if merge:
+            docs = [dict(self.get_doc(uri_key, db_name, collection, doc["_id"]) or {}, **doc) for doc in docs]
+        rows = [(uri_key, db_name, collection, str(doc["_id"]), json_util.dumps(doc)) for doc in docs]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                if replace_all:
+                    self._conn.execute("DELETE FROM docs WHERE uri_key = ? AND db_name = ? AND collection = ?",
+                                       (uri_key, db_name, collection))
+                self._conn.executemany("INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?)", rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def merge_doc(self, uri_key, db_name, collection, doc_id, fields, create=True):
+        """Cập nhật một phần bản sao document; create=False thì bỏ qua nếu chưa có bản sao."""
+        doc = self.get_doc(uri_key, db_name, collection, doc_id)
+        if doc is None:
+            if not create:
+                return
+            doc = {"_id": doc_id}
+        doc.update(fields)
+        self.put_docs(uri_key, db_name, collection, [doc])
+
+    def delete_doc(self, uri_key, db_name, collection, doc_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM docs WHERE uri_key = ? AND db_name = ? AND collection = ? AND doc_id = ?",
+                               (uri_key, db_name, collection, str(doc_id)))
+
+@st.cache_resource
+def get_local_journal():
+    """Trả về LocalJournal dùng chung cho process."""
+    return LocalJournal()
+
+class MongoHealth:
+    """Trạng thái kết nối của từng cluster (theo uri_key).
+
+    Sau một lỗi kết nối, request dùng journal ngay thay vì chờ timeout, cho tới khi reconciler
+    ping lại được hoặc hết MONGO_RETRY_COOLDOWN.
+    """
+    def __init__(self, cooldown=MONGO_RETRY_COOLDOWN):
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._retry_at = {}
+
+    def available(self, uri_key):
+        with self._lock:
+            return time.monotonic() >= self._retry_at.get(uri_key, 0)
+
+    def mark_down(self, uri_key):
+        with self._lock:
+            self._retry_at[uri_key] = time.monotonic() + self.cooldown
+
+    def mark_up(self, uri_key):
+        with self._lock:
+            self._retry_at.pop(uri_key, None)
+
+@st.cache_resource
+def get_mongo_health():
+    """Trả về MongoHealth dùng chung cho process."""
+    return MongoHealth()
+
+class JournalReconciler:
+    """Thread nền ghi lại các thao tác trong journal vào MongoDB theo đúng thứ tự khi kết nối trở lại.
+
+    apply_fn(db, op, payload) thực hiện một thao tác trên database pymongo. Client được đăng ký
+    bởi request đã kết nối thành công, nên URI không cần được lưu cùng journal.
+    """
+    def __init__(self, journal, health, apply_fn, interval=RECONCILE_INTERVAL):
+        self.journal = journal
+        self.health = health
+        self.apply_fn = apply_fn
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._wake = threading.Event()
+        self.counters = {"replayed": 0, "failed": 0, "runs": 0}
+        threading.Thread(target=self._run, daemon=True, name="db-journal-reconciler").start()
+
+    def register_client(self, uri_key, client):
+        with self._lock:
+            known = self._clients.get(uri_key) is client
+            self._clients[uri_key] = client
+        if not known:
+            self.kick()
+
+    def uri_key_for(self, client):
+        with self._lock:
+            return next((key for key, known in self._clients.items() if known is client), None)
+
+    def kick(self):
+        """Chạy lượt đồng bộ tiếp theo ngay, không chờ hết chu kỳ."""
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            with self._lock:
+                clients = list(self._clients.items())
+            for uri_key, client in clients:
+                try:
+                    self.reconcile(uri_key, client)
+                except Exception:
+                    # Lượt sau thử lại
+                    pass
+
+    def reconcile(self, uri_key, client):
+        """Ghi lại journal của uri_key vào MongoDB. Trả về số thao tác đã ghi."""
+        if not self.journal.has_pending(uri_key) and self.health.available(uri_key):
+            return 0
+        try:
+            client.admin.command('ping')
+        except ConnectionFailure:
+            self.health.mark_down(uri_key)
+            return 0
+        self.health.mark_up(uri_key)
+        replayed = 0
+        with self._lock:
+            self.counters["runs"] += 1
+        while True:
+            ops = self.journal.pending(uri_key)
+            if not ops:
+                return replayed
+            for op_id, db_name, op, payload in ops:
+                try:
+                    self.apply_fn(client[db_name], op, payload)
+                except ConnectionFailure:
+                    # Mất kết nối giữa chừng: giữ nguyên thứ tự, lượt sau ghi tiếp từ thao tác này
+                    self.health.mark_down(uri_key)
+                    return replayed
+                except Exception as e:
+                    self.journal.fail(op_id, repr(e))
+                    with self._lock:
+                        self.counters["failed"] += 1
+                    continue
+                self.journal.done(op_id)
+                replayed += 1
+                with self._lock:
+                    self.counters["replayed"] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, clients=len(self._clients), **self.journal.stats())
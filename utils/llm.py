@@ -1,31 +1,294 @@
+import asyncio
+import contextlib
+import copy
+import hashlib
+import json
+import os
+import random
+import threading
 import streamlit as st
-from openai import OpenAI
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from openai import OpenAI, AsyncOpenAI
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
 import anthropic
+from utils.clients import ClientPool, get_client_pool
+from utils.context import estimate_tokens
+
+# Context window mặc định cho model không có trong bảng context_windows
+DEFAULT_CONTEXT_WINDOW = 8192
+# Đặt cache breakpoint cho prefix dài (system prompt, ngữ cảnh tham khảo) với Anthropic
+PROMPT_CACHE_ENABLED = os.environ.get("LLM_PROMPT_CACHE", "1") == "1"
+
+class CancelToken:
+    """Cho phép hủy một stream từ thread khác.
+
+    Provider đăng ký hàm đóng kết nối HTTP bằng on_cancel(); cancel() gọi các hàm đó
+    ngay lập tức để stream dừng kể cả khi đang chờ chunk tiếp theo.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._parent = None
+        # Số token provider báo về cho request dùng token này
+        self.usage = None
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                # Kết nối có thể đã đóng sẵn
+                pass
+
+    def on_cancel(self, callback):
+        """Đăng ký hàm được gọi khi hủy; gọi ngay nếu token đã bị hủy."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def wait(self, timeout):
+        """Ngủ tối đa timeout giây, thức dậy sớm nếu bị hủy. Trả về True nếu đã hủy."""
+        return self._event.wait(timeout)
+
+    def child(self):
+        """Token cho một phần của request (ví dụ một lần thử): bị hủy theo token này và báo usage ngược lên."""
+        child = CancelToken()
+        child._parent = self
+        self.on_cancel(child.cancel)
+        return child
+
+    def report_usage(self, usage):
+        """Ghi nhận usage provider báo về; đi theo lời gọi nên đúng cả khi stream được đọc ở thread khác."""
+        self.usage = usage
+        if self._parent is not None:
+            self._parent.report_usage(usage)
+
+def is_cancelled(cancel_token):
+    return cancel_token is not None and cancel_token.cancelled
+
+@contextlib.contextmanager
+def close_on_cancel(cancel_token, close):
+    """Gọi close() khi token bị hủy và khi stream kết thúc.
+
+    Lỗi phát sinh do kết nối bị đóng giữa chừng sau khi hủy được bỏ qua.
+    """
+    if cancel_token is not None:
+        cancel_token.on_cancel(close)
+    try:
+        yield
+    except Exception:
+        if not is_cancelled(cancel_token):
+            raise
+    finally:
+        try:
+            close()
+        except Exception:
+            pass
 
 class LLMProvider:
     """Lớp cơ sở cho các nhà cung cấp LLM."""
-    def __init__(self, api_key):
+    # Số token context tối đa của từng model trong get_models()
+    context_windows = {}
+    # Các model dùng cho routing tự động, xếp từ nhẹ/nhanh nhất tới mạnh nhất
+    routing_tiers = ()
+
+    def __init__(self, api_key, cassette=None):
         if not api_key:
             raise ValueError("API key is required.")
         self.api_key = api_key
+        # Cassette ghi/phát lại stream ở tầng wire của SDK (utils/cassette.py), None khi gọi API thật
+        self.cassette = cassette
+
+    def _client_variant(self, *variant):
+        # Client có cassette không được dùng chung với client gọi API thật trong ClientPool
+        return variant + (self.cassette.variant,) if self.cassette else variant
+
+    def _http_client_options(self, is_async=False):
+        """Tham số http_client cho SDK dùng httpx (OpenAI, Anthropic) khi đang ghi/phát lại cassette."""
+        return {"http_client": self.cassette.http_client(is_async)} if self.cassette else {}
 
     def get_models(self):
         raise NotImplementedError
 
-    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt):
+    def get_context_window(self, model):
+        """Trả về kích thước context window (token) của model."""
+        return self.context_windows.get(model, DEFAULT_CONTEXT_WINDOW)
+
+    def for_task(self, task):
+        """Provider dùng cho một loại tác vụ (chat, translate, summarize, markmap) khi chọn model tự động."""
+        return self
+
+    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        """Stream câu trả lời thành các chunk text.
+
+        Khi cancel_token bị hủy, kết nối bên dưới được đóng và generator kết thúc
+        bình thường với phần nội dung đã nhận.
+        """
+        raise NotImplementedError
+
+    async def achat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        """Phiên bản async của chat_stream, trả về async generator các chunk text."""
         raise NotImplementedError
+        yield  # để Python coi hàm này là async generator
+
+    @property
+    def provider_name(self):
+        return type(self).__name__
+
+    def _set_usage(self, model, usage, cancel_token=None):
+        """Lưu số token provider báo về cho response vừa nhận vào cancel_token của lời gọi."""
+        if cancel_token is not None:
+            cancel_token.report_usage(usage)
+        get_usage_stats().record(self.provider_name, model, usage)
+
+# Tiền tố của các thông báo lỗi mà provider trả về dưới dạng text
+ERROR_MARKERS = ("⚠️", "❌")
+
+def is_error_response(text):
+    """Kiểm tra response có phải thông báo lỗi của provider hay không."""
+    return text.lstrip().startswith(ERROR_MARKERS)
+
+class UsageStats:
+    """Tổng số token theo (provider, model) do API báo về, gồm cả token đọc/ghi prompt cache."""
+    FIELDS = ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def record(self, provider_name, model, usage):
+        with self._lock:
+            totals = self._totals.setdefault((provider_name, model), dict.fromkeys(("requests",) + self.FIELDS, 0))
+            totals["requests"] += 1
+            for field in self.FIELDS:
+                totals[field] += usage.get(field, 0)
+
+    def stats(self):
+        with self._lock:
+            return {f"{provider}:{model}": dict(totals) for (provider, model), totals in self._totals.items()}
+
+@st.cache_resource
+def get_usage_stats():
+    """Trả về UsageStats dùng chung cho process."""
+    return UsageStats()
+
+def describe_prompt_cache(usage):
+    """Mô tả ngắn số token đọc/ghi prompt cache của một response, None nếu không dùng cache."""
+    if not usage or not (usage.get("cache_read_input_tokens") or usage.get("cache_creation_input_tokens")):
+        return None
+    return (f"🗄️ Prompt cache: đọc {usage['cache_read_input_tokens']:,} · ghi {usage['cache_creation_input_tokens']:,} "
+            f"· input mới {usage['input_tokens']:,} tokens")
+
+# Mã HTTP của các lỗi tạm thời có thể thử lại
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+def is_retryable_error(e):
+    """Lỗi tạm thời (mất kết nối, timeout, 429, 5xx) có thể thử lại hay không."""
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+    # openai/anthropic dùng status_code, google.api_core dùng code
+    status = getattr(e, "status_code", None)
+    if status is None:
+        status = getattr(e, "code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS_CODES or status >= 500
+    name = type(e).__name__
+    return "Connection" in name or "Timeout" in name
+
+def canonical_request_hash(provider_name, messages, model, temperature, max_tokens, system_prompt):
+    """Tạo hash ổn định cho một request, dùng làm khóa cache/dedup."""
+    payload = {
+        "provider": provider_name,
+        "model": model,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "system_prompt": system_prompt,
+        "messages": [{"role": m["role"], "content": m["content"]} for m in messages],
+    }
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class ProviderWrapper(LLMProvider):
+    """Lớp cơ sở cho các lớp bọc một LLMProvider khác, mặc định chuyển tiếp mọi lời gọi."""
+    def __init__(self, inner):
+        super().__init__(inner.api_key)
+        self.inner = inner
+
+    def __getattr__(self, name):
+        if name == "inner":
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+    @property
+    def provider_name(self):
+        return self.inner.provider_name
+
+    def get_models(self):
+        return self.inner.get_models()
+
+    def get_context_window(self, model):
+        return self.inner.get_context_window(model)
+
+    def for_task(self, task):
+        inner = self.inner.for_task(task)
+        if inner is self.inner:
+            return self
+        wrapper = copy.copy(self)
+        wrapper.inner = inner
+        return wrapper
+
+    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        return self.inner.chat_stream(messages, model, temperature, max_tokens, system_prompt, cancel_token)
+
+    async def achat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        async for chunk in self.inner.achat_stream(messages, model, temperature, max_tokens, system_prompt, cancel_token):
+            yield chunk
 
 class OpenAIProvider(LLMProvider):
     """Triển khai cho OpenAI."""
-    def __init__(self, api_key):
-        super().__init__(api_key)
-        self.client = OpenAI(api_key=self.api_key)
+    base_url = None
+    context_windows = {
+        "gpt-4.1-mini": 1047576,
+        "gpt-4.1-nano": 1047576,
+        "gpt-4o-mini": 128000,
+    }
+    routing_tiers = ("gpt-4.1-nano", "gpt-4o-mini", "gpt-4.1-mini")
+
+    def __init__(self, api_key, cassette=None):
+        super().__init__(api_key, cassette)
+        # Dùng lại client (và connection pool keep-alive) giữa các lần rerun.
+        # max_retries=0: ResilientProvider là lớp thử lại/backoff duy nhất
+        pool = get_client_pool()
+        name = type(self).__name__
+        self.client = pool.get(name, self.api_key,
+                               lambda: OpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0, **self._http_client_options()),
+                               variant=self._client_variant("sync", self.base_url))
+
+    @property
+    def async_client(self):
+        # Client async gắn với event loop đang chạy nên được lấy theo từng loop
+        return get_client_pool().get_async(type(self).__name__, self.api_key,
+                                           lambda: AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                                                               **self._http_client_options(is_async=True)),
+                                           variant=self._client_variant("async", self.base_url))
 
     def get_models(self):
         return ["gpt-4.1-mini","gpt-4.1-nano", "gpt-4o-mini" ]
 
-    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt):
+    def _build_request(self, messages, model, temperature, max_tokens, system_prompt):
         messages_with_system = [{"role": "system", "content": system_prompt}] + messages
         
         # Prepare request parameters
@@ -33,95 +296,360 @@ class OpenAIProvider(LLMProvider):
             "model": model,
             "messages": messages_with_system,
             "temperature": temperature,
-            "stream": True
+            "stream": True,
+            # Chunk cuối (không có choices) mang số token của cả request
+            "stream_options": {"include_usage": True}
         }
         
         # Only add max_tokens if it's specified
         if max_tokens is not None:
             request_params["max_tokens"] = max_tokens
-            
+        return request_params
+
+    def _record_usage(self, model, usage, cancel_token=None):
+        """Lưu số token của response; token đọc từ prompt cache được tách khỏi input_tokens."""
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", 0) or 0
+        self._set_usage(model, {
+            "model": model,
+            "input_tokens": (getattr(usage, "prompt_tokens", 0) or 0) - cached,
+            "output_tokens": getattr(usage, "completion_tokens", 0) or 0,
+            "cache_read_input_tokens": cached,
+            "cache_creation_input_tokens": 0,
+        }, cancel_token)
+
+    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        request_params = self._build_request(messages, model, temperature, max_tokens, system_prompt)
         stream = self.client.chat.completions.create(**request_params)
-        for chunk in stream:
-            content = chunk.choices[0].delta.content
-            if content:
-                yield content
+        usage = None
+        with close_on_cancel(cancel_token, stream.close):
+            for chunk in stream:
+                if is_cancelled(cancel_token):
+                    break
+                usage = getattr(chunk, "usage", None) or usage
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    yield content
+            else:
+                self._record_usage(model, usage, cancel_token)
+
+    async def achat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        request_params = self._build_request(messages, model, temperature, max_tokens, system_prompt)
+        stream = await self.async_client.chat.completions.create(**request_params)
+        usage = None
+        try:
+            async for chunk in stream:
+                if is_cancelled(cancel_token):
+                    break
+                usage = getattr(chunk, "usage", None) or usage
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    yield content
+            else:
+                self._record_usage(model, usage, cancel_token)
+        finally:
+            await stream.close()
+
+# Configure safety settings to be less restrictive
+GEMINI_SAFETY_SETTINGS = [
+    {
+        "category": "HARM_CATEGORY_HARASSMENT",
+        "threshold": "BLOCK_ONLY_HIGH"
+    },
+    {
+        "category": "HARM_CATEGORY_HATE_SPEECH",
+        "threshold": "BLOCK_ONLY_HIGH"
+    },
+    {
+        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "threshold": "BLOCK_ONLY_HIGH"
+    },
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_ONLY_HIGH"
+    },
+]
+
+class GeminiHistory:
+    """History đã chuyển sang format Gemini của một cuộc hội thoại, cập nhật tăng dần.
+
+    Giả định history chỉ được nối thêm ở cuối (như Chat AI); nếu tin nhắn đầu,
+    tin nhắn cuối đã đồng bộ hoặc độ dài không khớp thì chuyển đổi lại từ đầu.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._first = None
+        self._last = None
+        self._contents = []
+
+    @staticmethod
+    def _to_content(msg):
+        # Gemini API không nhận role 'assistant', dùng 'model' thay thế
+        role = 'model' if msg['role'] == 'assistant' else 'user'
+        return genai.protos.Content(role=role, parts=[genai.protos.Part(text=msg['content'])])
+
+    def sync(self, messages):
+        """Đồng bộ với messages và trả về bản sao danh sách Content tương ứng."""
+        with self._lock:
+            synced = len(self._contents)
+            if not (
+                synced
+                and len(messages) >= synced
+                and self._first == (messages[0]['role'], messages[0]['content'])
+                and self._last == (messages[synced - 1]['role'], messages[synced - 1]['content'])
+            ):
+                self._contents = []
+                synced = 0
+            for msg in messages[synced:]:
+                self._contents.append(self._to_content(msg))
+            if messages:
+                self._first = (messages[0]['role'], messages[0]['content'])
+                self._last = (messages[-1]['role'], messages[-1]['content'])
+            return list(self._contents)
+
+def current_session_id():
+    """ID browser session Streamlit của thread hiện tại, None nếu chạy ngoài Streamlit."""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else None
+
+@st.cache_resource
+def get_gemini_cache():
+    """Cache GenerativeModel và history Gemini dùng chung trong process."""
+    return ClientPool(max_size=int(os.environ.get("GEMINI_MODEL_CACHE_SIZE", "64")))
 
 class GoogleProvider(LLMProvider):
     """Triển khai cho Google Gemini."""
-    def __init__(self, api_key):
-        super().__init__(api_key)
-        genai.configure(api_key=self.api_key)
+    # Endpoint/transport tùy chọn (mặc định của thư viện nếu None), ví dụ server giả lập khi benchmark
+    api_endpoint = None
+    transport = None
+    context_windows = {
+        "gemini-2.5-flash": 1048576,
+        "gemini-2.5-pro": 1048576,
+    }
+    routing_tiers = ("gemini-2.5-flash", "gemini-2.5-pro")
+
+    def __init__(self, api_key, cassette=None):
+        super().__init__(api_key, cassette)
+        # Lấy lúc tạo provider (thread chạy script) vì stream có thể được đọc ở thread khác
+        self.conversation_key = current_session_id()
+        # Mỗi API key có client riêng thay vì genai.configure toàn cục,
+        # để các session dùng key khác nhau không ghi đè lẫn nhau
+        self.client = get_client_pool().get(
+            "GoogleProvider", self.api_key,
+            lambda: self._wrap_gapic(glm.GenerativeServiceClient(client_options=self._client_options(), transport=self.transport)),
+            variant=self._client_variant("sync", self.api_endpoint, self.transport)
+        )
 
     def get_models(self):
         return ["gemini-2.5-flash", "gemini-2.5-pro"]
 
-    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt):
-        generation_config = {
-            "temperature": temperature,
-        }
-        
-        # Only add max_output_tokens if max_tokens is specified
-        if max_tokens is not None:
-            generation_config["max_output_tokens"] = max_tokens
+    def _get_async_client(self):
+        # Client async phải được tạo bên trong event loop đang chạy và chỉ dùng trong loop đó
+        return get_client_pool().get_async(
+            "GoogleProvider", self.api_key,
+            lambda: self._wrap_gapic(glm.GenerativeServiceAsyncClient(client_options=self._client_options()), is_async=True),
+            variant=self._client_variant("async", self.api_endpoint)
+        )
+
+    def _wrap_gapic(self, client, is_async=False):
+        # Gemini không đi qua httpx nên cassette bọc trực tiếp client GAPIC
+        return self.cassette.gapic_client(client, is_async) if self.cassette else client
+
+    def _client_options(self):
+        options = {"api_key": self.api_key}
+        if self.api_endpoint:
+            options["api_endpoint"] = self.api_endpoint
+        return options
+
+    def _get_model(self, model, temperature, max_tokens, system_prompt):
+        """Lấy GenerativeModel đã cấu hình từ cache theo (model, temperature, max_tokens, system prompt)."""
+        def build():
+            generation_config = {
+                "temperature": temperature,
+            }
             
-        # Configure safety settings to be less restrictive
-        safety_settings = [
-            {
-                "category": "HARM_CATEGORY_HARASSMENT",
-                "threshold": "BLOCK_ONLY_HIGH"
-            },
-            {
-                "category": "HARM_CATEGORY_HATE_SPEECH",
-                "threshold": "BLOCK_ONLY_HIGH"
-            },
-            {
-                "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                "threshold": "BLOCK_ONLY_HIGH"
-            },
-            {
-                "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                "threshold": "BLOCK_ONLY_HIGH"
-            },
-        ]
-        
-        gemini_model = genai.GenerativeModel(
-            model_name=model,
-            generation_config=generation_config,
-            safety_settings=safety_settings,
-            system_instruction=system_prompt
+            # Only add max_output_tokens if max_tokens is specified
+            if max_tokens is not None:
+                generation_config["max_output_tokens"] = max_tokens
+
+            gemini_model = genai.GenerativeModel(
+                model_name=model,
+                generation_config=generation_config,
+                safety_settings=GEMINI_SAFETY_SETTINGS,
+                system_instruction=system_prompt
+            )
+            gemini_model._client = self.client
+            return gemini_model
+        return get_gemini_cache().get(
+            "GoogleProvider", self.api_key, build,
+            variant=("model", model, temperature, max_tokens, system_prompt)
         )
-        # Gemini API xử lý history khác, nó không nhận role 'assistant' trong mảng messages
-        # Ta cần chuyển đổi history cho phù hợp
-        history_for_gemini = []
-        for msg in messages:
-            role = 'model' if msg['role'] == 'assistant' else 'user'
-            history_for_gemini.append({'role': role, 'parts': [msg['content']]})
 
+    def _get_history(self, messages, model, system_prompt):
+        # Request một lượt (Translation Tool, Markmap) hoặc chạy ngoài Streamlit không cần giữ history trong cache
+        if len(messages) == 1 or self.conversation_key is None:
+            return GeminiHistory()
+        # Mỗi browser session một history cho mỗi model: khi history bị cắt, tóm tắt hoặc chuyển
+        # sang phiên chat khác, sync() chuyển đổi lại ngay trong mục cache đó thay vì tạo mục mới
+        return get_gemini_cache().get(
+            "GoogleProvider", self.api_key, GeminiHistory,
+            variant=("history", self.conversation_key, model)
+        )
+
+    def _prepare_chat(self, messages, model, temperature, max_tokens, system_prompt):
+        """Lấy GenerativeModel và history Gemini đã chuyển đổi cho request.
+
+        Trả về (gemini_model, history, last_user_message) hoặc None nếu tin nhắn cuối không phải của user.
+        """
+        if not messages or messages[-1]['role'] == 'assistant':
+            return None
+        gemini_model = self._get_model(model, temperature, max_tokens, system_prompt)
+        history_for_gemini = self._get_history(messages, model, system_prompt).sync(messages)
         # Lấy tin nhắn cuối cùng của user để stream
-        if history_for_gemini and history_for_gemini[-1]['role'] == 'user':
-             last_user_message = history_for_gemini.pop()['parts']
-             chat_session = gemini_model.start_chat(history=history_for_gemini)
-             try:
-                 response = chat_session.send_message(last_user_message, stream=True)
-                 for chunk in response:
-                     if hasattr(chunk, 'text') and chunk.text:
-                         yield chunk.text
-                     elif hasattr(chunk, 'parts') and chunk.parts:
-                         for part in chunk.parts:
-                             if hasattr(part, 'text') and part.text:
-                                 yield part.text
-             except Exception as e:
-                 # Handle safety filter blocks and other errors
-                 if "finish_reason" in str(e) or "safety" in str(e).lower():
-                     yield "⚠️ Nội dung bị chặn bởi bộ lọc an toàn của Gemini. Vui lòng thử lại với văn bản khác hoặc chuyển sang model khác."
-                 else:
-                     yield f"❌ Lỗi Gemini API: {str(e)}"
+        last_user_message = history_for_gemini.pop()
+        return gemini_model, history_for_gemini, last_user_message
+
+    @staticmethod
+    def _chunk_texts(chunk):
+        """Lấy text từ một chunk Gemini, fallback sang parts nếu không có text."""
+        if hasattr(chunk, 'text') and chunk.text:
+            return [chunk.text]
+        if hasattr(chunk, 'parts') and chunk.parts:
+            return [part.text for part in chunk.parts if hasattr(part, 'text') and part.text]
+        return []
+
+    @staticmethod
+    def _error_message(e):
+        # Handle safety filter blocks and other errors
+        if "finish_reason" in str(e) or "safety" in str(e).lower():
+            return "⚠️ Nội dung bị chặn bởi bộ lọc an toàn của Gemini. Vui lòng thử lại với văn bản khác hoặc chuyển sang model khác."
+        return f"❌ Lỗi Gemini API: {str(e)}"
+
+    def _record_usage(self, model, usage_metadata, cancel_token=None):
+        """Lưu số token của response từ usage_metadata (prompt_token_count đã gồm token cache)."""
+        if usage_metadata is None:
+            return
+        cached = getattr(usage_metadata, "cached_content_token_count", 0) or 0
+        self._set_usage(model, {
+            "model": model,
+            "input_tokens": (getattr(usage_metadata, "prompt_token_count", 0) or 0) - cached,
+            "output_tokens": getattr(usage_metadata, "candidates_token_count", 0) or 0,
+            "cache_read_input_tokens": cached,
+            "cache_creation_input_tokens": 0,
+        }, cancel_token)
+
+    @staticmethod
+    def _close_response(response):
+        """Hủy iterator gRPC/REST bên dưới response stream của Gemini."""
+        iterator = getattr(response, "_iterator", None)
+        close = getattr(iterator, "cancel", None) or getattr(iterator, "close", None)
+        if close is not None:
+            close()
+
+    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        prepared = self._prepare_chat(messages, model, temperature, max_tokens, system_prompt)
+        if prepared is None:
+            return
+        gemini_model, history_for_gemini, last_user_message = prepared
+        chat_session = gemini_model.start_chat(history=history_for_gemini)
+        started = False
+        try:
+            response = chat_session.send_message(last_user_message, stream=True)
+            usage_metadata = None
+            with close_on_cancel(cancel_token, lambda: self._close_response(response)):
+                for chunk in response:
+                    if is_cancelled(cancel_token):
+                        break
+                    usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+                    for text in self._chunk_texts(chunk):
+                        started = True
+                        yield text
+                else:
+                    self._record_usage(model, usage_metadata, cancel_token)
+        except Exception as e:
+            # Lỗi tạm thời trước chunk đầu tiên được ném ra để lớp retry xử lý
+            if not started and is_retryable_error(e):
+                raise
+            yield self._error_message(e)
+
+    async def achat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        prepared = self._prepare_chat(messages, model, temperature, max_tokens, system_prompt)
+        if prepared is None:
+            return
+        gemini_model, history_for_gemini, last_user_message = prepared
+        # Bản sao nông cho lời gọi này: GenerativeModel trong cache được dùng chung giữa các thread
+        gemini_model = copy.copy(gemini_model)
+        gemini_model._async_client = self._get_async_client()
+        chat_session = gemini_model.start_chat(history=history_for_gemini)
+        started = False
+        try:
+            response = await chat_session.send_message_async(last_user_message, stream=True)
+            usage_metadata = None
+            try:
+                async for chunk in response:
+                    if is_cancelled(cancel_token):
+                        break
+                    usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+                    for text in self._chunk_texts(chunk):
+                        started = True
+                        yield text
+                else:
+                    self._record_usage(model, usage_metadata, cancel_token)
+            finally:
+                if is_cancelled(cancel_token):
+                    self._close_response(response)
+        except Exception as e:
+            if not started and is_retryable_error(e):
+                raise
+            yield self._error_message(e)
 
 class AnthropicProvider(LLMProvider):
     """Triển khai cho Anthropic Claude."""
-    def __init__(self, api_key):
-        super().__init__(api_key)
-        self.client = anthropic.Anthropic(api_key=self.api_key)
+    base_url = None
+    context_windows = {
+        "claude-opus-4-1-20250805": 200000,
+        "claude-opus-4-20250514": 200000,
+        "claude-sonnet-4-20250514": 200000,
+        "claude-3-7-sonnet-20250219": 200000,
+        "claude-3-5-haiku-20241022": 200000,
+        "claude-3-5-sonnet-20241022": 200000,
+        "claude-3-5-sonnet-20240620": 200000,
+        "claude-3-haiku-20240307": 200000,
+    }
+    routing_tiers = ("claude-3-5-haiku-20241022", "claude-sonnet-4-20250514", "claude-opus-4-1-20250805")
+    # Prefix ngắn hơn số token này không được Anthropic cache (mặc định 1024)
+    min_cacheable_tokens = {
+        "claude-3-5-haiku-20241022": 2048,
+        "claude-3-haiku-20240307": 2048,
+    }
+    # API bắt buộc max_tokens, dùng giá trị này khi người dùng không giới hạn
+    default_max_tokens = 4096
+    # Chỉ tác vụ chat gửi lại hội thoại ở lượt sau; tác vụ khác là request một lần nên chỉ cache system prompt
+    conversation_cache_tasks = ("chat",)
+    cache_conversation = True
+
+    def __init__(self, api_key, cassette=None):
+        super().__init__(api_key, cassette)
+        # Tắt retry của SDK như OpenAIProvider, để chỉ ResilientProvider thử lại
+        pool = get_client_pool()
+        self.client = pool.get("AnthropicProvider", self.api_key,
+                               lambda: anthropic.Anthropic(api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                                                               **self._http_client_options()),
+                               variant=self._client_variant("sync", self.base_url))
+
+    @property
+    def async_client(self):
+        # Client async gắn với event loop đang chạy nên được lấy theo từng loop
+        return get_client_pool().get_async("AnthropicProvider", self.api_key,
+                                           lambda: anthropic.AsyncAnthropic(api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                                                                            **self._http_client_options(is_async=True)),
+                                           variant=self._client_variant("async", self.base_url))
 
     def get_models(self):
         '''
@@ -138,64 +666,229 @@ Claude Haiku 3	claude-3-haiku-20240307	anthropic.claude-3-haiku-20240307-v1:0	cl
         '''
         return ["claude-opus-4-1-20250805", "claude-opus-4-20250514", "claude-sonnet-4-20250514", "claude-3-7-sonnet-20250219", "claude-3-5-haiku-20241022", "claude-3-5-sonnet-20241022", "claude-3-5-sonnet-20240620", "claude-3-haiku-20240307"]
 
-    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt):
+    def for_task(self, task):
+        cache_conversation = task in self.conversation_cache_tasks
+        if cache_conversation == self.cache_conversation:
+            return self
+        provider = copy.copy(self)
+        provider.cache_conversation = cache_conversation
+        return provider
+
+    @staticmethod
+    def _cached_block(text):
+        return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+
+    def _build_request(self, messages, model, temperature, max_tokens, system_prompt):
+        """Tạo request, đặt cache breakpoint ở cuối system prompt và cuối hội thoại (chỉ với tác vụ chat) khi đủ dài.
+
+        Text được gửi nguyên văn (không chèn thời gian hay id) để prefix giữ nguyên từng byte
+        giữa các lượt, nhờ đó lượt sau đọc lại được cache của lượt trước.
+        """
+        min_tokens = self.min_cacheable_tokens.get(model, 1024)
+        system = system_prompt
+        prefix_tokens = estimate_tokens(system_prompt)
+        if PROMPT_CACHE_ENABLED and system_prompt and prefix_tokens >= min_tokens:
+            system = self._cached_block(system_prompt)
+        messages = list(messages)
+        prefix_tokens += sum(estimate_tokens(m['content']) for m in messages)
+        # Breakpoint trên tin nhắn cuối: lượt sau dùng lại toàn bộ hội thoại tới đây
+        if PROMPT_CACHE_ENABLED and self.cache_conversation and messages and prefix_tokens >= min_tokens:
+            last = messages[-1]
+            messages[-1] = {"role": last['role'], "content": self._cached_block(last['content'])}
         # Prepare request parameters
         request_params = {
             "model": model,
             "messages": messages,
-            "system": system_prompt,
+            "system": system,
             "temperature": temperature,
+            "max_tokens": max_tokens if max_tokens is not None else self.default_max_tokens,
         }
-        
-        # Only add max_tokens if it's specified
-        if max_tokens is not None:
-            request_params["max_tokens"] = max_tokens
-            
+        return request_params
+
+    def _record_usage(self, model, message, cancel_token=None):
+        """Lưu số token (kể cả token đọc/ghi prompt cache) của response vừa nhận."""
+        usage = getattr(message, "usage", None)
+        if usage is None:
+            return
+        self._set_usage(model, {
+            "model": model,
+            "input_tokens": getattr(usage, "input_tokens", 0) or 0,
+            "output_tokens": getattr(usage, "output_tokens", 0) or 0,
+            "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", 0) or 0,
+            "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+        }, cancel_token)
+
+    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        request_params = self._build_request(messages, model, temperature, max_tokens, system_prompt)
         with self.client.messages.stream(**request_params) as stream:
-            for text in stream.text_stream:
+            with close_on_cancel(cancel_token, stream.close):
+                for text in stream.text_stream:
+                    if is_cancelled(cancel_token):
+                        break
+                    yield text
+                else:
+                    self._record_usage(model, stream.get_final_message(), cancel_token)
+
+    async def achat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        request_params = self._build_request(messages, model, temperature, max_tokens, system_prompt)
+        async with self.async_client.messages.stream(**request_params) as stream:
+            async for text in stream.text_stream:
+                if is_cancelled(cancel_token):
+                    break
                 yield text
+            else:
+                self._record_usage(model, await stream.get_final_message(), cancel_token)
 
-class DeepSeekProvider(LLMProvider):
-    """Triển khai cho DeepSeek."""
-    def __init__(self, api_key):
-        super().__init__(api_key)
-        self.client = OpenAI(api_key=self.api_key, base_url="https://api.deepseek.com/v1")
+class DeepSeekProvider(OpenAIProvider):
+    """Triển khai cho DeepSeek (API tương thích OpenAI)."""
+    base_url = "https://api.deepseek.com/v1"
+    context_windows = {
+        "deepseek-chat": 65536,
+        "deepseek-coder": 65536,
+    }
+    routing_tiers = ("deepseek-chat",)
 
     def get_models(self):
         return ["deepseek-chat", "deepseek-coder"]
 
-    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt):
-        messages_with_system = [{"role": "system", "content": system_prompt}] + messages
-        
-        # Prepare request parameters
-        request_params = {
-            "model": model,
-            "messages": messages_with_system,
-            "temperature": temperature,
-            "stream": True
-        }
-        
-        # Only add max_tokens if it's specified
-        if max_tokens is not None:
-            request_params["max_tokens"] = max_tokens
-            
-        stream = self.client.chat.completions.create(**request_params)
-        for chunk in stream:
-            content = chunk.choices[0].delta.content
-            if content:
-                yield content
-
-def get_llm_provider(api_provider, api_key):
-    """Factory function để lấy instance của nhà cung cấp LLM."""
-    provider_map = {
-        "OpenAI": OpenAIProvider,
-        "Google": GoogleProvider,
-        "Anthropic": AnthropicProvider,
-        "DeepSeek": DeepSeekProvider
+class FakeRateLimitError(Exception):
+    """Lỗi 429 giả lập của FakeProvider."""
+    status_code = 429
+
+class FakeProvider(LLMProvider):
+    """Provider giả lập trả về text xác định, dùng để đo hiệu năng/kiểm thử offline.
+
+    Độ trễ, số token, jitter và lỗi được cấu hình qua tham số hoặc biến môi trường FAKE_LLM_*.
+    Cùng một request luôn cho ra cùng text, cùng độ trễ và cùng lỗi.
+    """
+    context_windows = {
+        "fake-model": 128000,
     }
+    # Các loại lỗi có thể giả lập
+    ERROR_KINDS = ("429", "disconnect", "safety")
+    WORDS = ("alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta",
+             "iota", "kappa", "lambda", "mu", "nu", "xi", "omicron", "pi")
+
+    def __init__(self, api_key, ttft=None, inter_token_delay=None, tokens=None, jitter=None,
+                 error_rate=None, error_kinds=None):
+        super().__init__(api_key)
+        env = os.environ.get
+        self.ttft = float(env("FAKE_LLM_TTFT", "0.3")) if ttft is None else ttft
+        self.inter_token_delay = float(env("FAKE_LLM_INTER_TOKEN", "0.02")) if inter_token_delay is None else inter_token_delay
+        self.tokens = int(env("FAKE_LLM_TOKENS", "200")) if tokens is None else tokens
+        self.jitter = float(env("FAKE_LLM_JITTER", "0.2")) if jitter is None else jitter
+        self.error_rate = float(env("FAKE_LLM_ERROR_RATE", "0")) if error_rate is None else error_rate
+        if error_kinds is None:
+            error_kinds = [k for k in env("FAKE_LLM_ERRORS", ",".join(self.ERROR_KINDS)).split(",") if k]
+        self.error_kinds = error_kinds
+
+    def get_models(self):
+        return ["fake-model"]
+
+    def _plan(self, messages, model, temperature, max_tokens, system_prompt):
+        """Tạo kế hoạch xác định cho request: danh sách (độ trễ, token) và lỗi (nếu có)."""
+        seed = canonical_request_hash(self.provider_name, messages, model, temperature, max_tokens, system_prompt)
+        rng = random.Random(seed)
+        count = self.tokens if max_tokens is None else min(self.tokens, max_tokens)
+        steps = []
+        for i in range(count):
+            base = self.ttft if i == 0 else self.inter_token_delay
+            delay = max(0.0, base * (1 + rng.uniform(-self.jitter, self.jitter)))
+            steps.append((delay, rng.choice(self.WORDS) + " "))
+        error = None
+        if self.error_kinds and rng.random() < self.error_rate:
+            error = (rng.choice(self.error_kinds), rng.randrange(max(count, 1)))
+        return steps, error
+
+    def _error_before(self, error, index):
+        """Trả về exception/thông báo lỗi nếu lỗi giả lập xảy ra trước token index."""
+        if error is None:
+            return None
+        kind, at = error
+        if kind == "429" and index == 0:
+            return FakeRateLimitError("Fake 429: rate limit exceeded")
+        if kind == "safety" and index == 0:
+            return "⚠️ Nội dung bị chặn bởi bộ lọc an toàn của Gemini. Vui lòng thử lại với văn bản khác hoặc chuyển sang model khác."
+        if kind == "disconnect" and index == max(at, 1):
+            return ConnectionError("Fake disconnect: connection reset mid-stream")
+        return None
+
+    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        steps, error = self._plan(messages, model, temperature, max_tokens, system_prompt)
+        cancel_token = cancel_token or CancelToken()
+        for i, (delay, token) in enumerate(steps):
+            failure = self._error_before(error, i)
+            if isinstance(failure, Exception):
+                raise failure
+            if cancel_token.wait(delay):
+                return
+            if failure:
+                yield failure
+                return
+            yield token
+
+    async def achat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        steps, error = self._plan(messages, model, temperature, max_tokens, system_prompt)
+        for i, (delay, token) in enumerate(steps):
+            failure = self._error_before(error, i)
+            if isinstance(failure, Exception):
+                raise failure
+            await asyncio.sleep(delay)
+            if is_cancelled(cancel_token):
+                return
+            if failure:
+                yield failure
+                return
+            yield token
+
+provider_map = {
+    "OpenAI": OpenAIProvider,
+    "Google": GoogleProvider,
+    "Anthropic": AnthropicProvider,
+    "DeepSeek": DeepSeekProvider,
+    "Fake": FakeProvider
+}
+
+def build_provider(api_provider, api_key):
+    """Tạo provider đã gắn governor hạn mức, hoặc None nếu nhà cung cấp không được hỗ trợ."""
     provider_class = provider_map.get(api_provider)
-    if provider_class:
-        return provider_class(api_key)
+    if provider_class is None:
+        return None
+    cassette_mode = os.environ.get("LLM_CASSETTE_MODE")
+    # FakeProvider không gọi mạng nên không có gì để ghi/phát lại
+    if cassette_mode and provider_class is not FakeProvider:
+        # Ghi hoặc phát lại stream ở tầng wire của SDK thay vì gọi API thật
+        from utils.cassette import Cassette
+        provider = provider_class(api_key, cassette=Cassette(cassette_mode))
+    else:
+        provider = provider_class(api_key)
+    # Xếp hàng request theo hạn mức chung của (provider, API key) trong process
+    from utils.governor import GovernedProvider, get_governor_registry
+    return GovernedProvider(provider, get_governor_registry().get(provider.provider_name, api_key))
+
+def get_llm_provider(api_provider, api_key, page=None):
+    """Factory function để lấy instance của nhà cung cấp LLM. page là tên trang gọi, dùng khi ghi log."""
+    provider = build_provider(api_provider, api_key)
+    if provider:
+        # Retry/failover nằm ngoài governor để mỗi lần thử đều tuân theo hạn mức
+        from utils.resilience import ResilientProvider, get_failover_target, get_resilience_stats
+        provider = ResilientProvider(provider, get_resilience_stats(), failover=get_failover_target(api_provider))
+        # Log nằm trong router để ghi model thật sự được gọi, ngoài cache/single-flight để chỉ ghi lần gọi API thật
+        from utils.usage_log import wrap_usage_log
+        provider = wrap_usage_log(provider, page)
+        # Model "auto" được chọn ở đây, bên trong cache/single-flight để chỉ đo độ trễ của lần gọi thật
+        from utils.routing import ROUTING_ENABLED, RoutingProvider, get_latency_tracker
+        if ROUTING_ENABLED:
+            provider = RoutingProvider(provider, get_latency_tracker())
+        # Request giống hệt đang chạy ở tab/người dùng khác thì đọc chung stream đó
+        from utils.singleflight import SINGLE_FLIGHT_ENABLED, SingleFlightProvider, get_single_flight_group
+        if SINGLE_FLIGHT_ENABLED:
+            provider = SingleFlightProvider(provider, get_single_flight_group())
+        # Cache nằm ngoài cùng để response từ cache không tiêu tốn hạn mức
+        if os.environ.get("LLM_RESPONSE_CACHE") == "1":
+            from utils.cache import CachedProvider, get_response_cache
+            provider = CachedProvider(provider, get_response_cache())
+        return provider
     else:
         st.error(f"Nhà cung cấp {api_provider} chưa được hỗ trợ.")
-        return None 
\ No newline at end of file
+        return None
@@ -0,0 +1,241 @@
+import asyncio
+import os
+import queue
+import random
+import threading
+import streamlit as st
+from utils.llm import CancelToken, ProviderWrapper, build_provider, is_retryable_error
+
+# Số lần thử lại tối đa trước chunk đầu tiên, và tham số backoff (giây)
+MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "3"))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+# Watchdog: thời gian chờ tối đa cho chunk đầu tiên và giữa hai chunk (0 để tắt)
+FIRST_CHUNK_TIMEOUT = float(os.environ.get("LLM_FIRST_CHUNK_TIMEOUT", "120"))
+IDLE_CHUNK_TIMEOUT = float(os.environ.get("LLM_IDLE_CHUNK_TIMEOUT", "60"))
+
+class StreamStalledError(TimeoutError):
+    """Stream không nhận được chunk nào trong khoảng thời gian cho phép."""
+
+class ResilienceStats:
+    """Bộ đếm số lần thử, thất bại, thử lại, failover, stream bị treo và bị hủy."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {
+            "attempts": 0,
+            "failed_attempts": 0,
+            "retries": 0,
+            "failovers": 0,
+            "stalls": 0,
+            "successes": 0,
+            "cancellations": 0,
+        }
+
+    def record(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+@st.cache_resource
+def get_resilience_stats():
+    """Trả về ResilienceStats dùng chung cho process."""
+    return ResilienceStats()
+
+def get_failover_target(api_provider):
+    """Đọc cấu hình provider dự phòng từ secrets [FAILOVER]: (provider, model) hoặc None.
+
+    Không failover sang chính nhà cung cấp đang dùng.
+    """
+    try:
+        config = st.secrets["FAILOVER"]
+        target_provider, target_model, target_key = config["PROVIDER"], config["MODEL"], config["API_KEY"]
+    except Exception:
+        return None
+    if target_provider == api_provider:
+        return None
+    provider = build_provider(target_provider, target_key)
+    return (provider, target_model) if provider else None
+
+def backoff_delay(attempt, error=None):
+    """Thời gian chờ trước lần thử lại thứ attempt: exponential backoff với full jitter.
+
+    Ưu tiên header Retry-After nếu server trả về.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers:
+        try:
+            return min(float(headers.get("retry-after")), BACKOFF_MAX)
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+async def cancellable_sleep(delay, cancel_token):
+    """asyncio.sleep thức dậy sớm khi cancel_token bị hủy (kể cả từ thread khác). Trả về True nếu đã hủy."""
+    loop = asyncio.get_running_loop()
+    woken = asyncio.Event()
+    cancel_token.on_cancel(lambda: loop.call_soon_threadsafe(woken.set))
+    try:
+        await asyncio.wait_for(woken.wait(), delay)
+    except asyncio.TimeoutError:
+        pass
+    return cancel_token.cancelled
+
+_CHUNK, _DONE, _ERROR = range(3)
+
+class ResilientProvider(ProviderWrapper):
+    """Bọc một LLMProvider: thử lại lỗi tạm thời, failover và hủy stream bị treo.
+
+    Chỉ thử lại/failover trước chunk đầu tiên; lỗi sau đó được ném ra cho trang xử lý.
+    """
+    def __init__(self, inner, stats, failover=None, max_retries=MAX_RETRIES,
+                 first_chunk_timeout=FIRST_CHUNK_TIMEOUT, idle_timeout=IDLE_CHUNK_TIMEOUT):
+        super().__init__(inner)
+        self.stats = stats
+        self.failover = failover
+        self.max_retries = max_retries
+        self.first_chunk_timeout = first_chunk_timeout
+        self.idle_timeout = idle_timeout
+
+    def _targets(self, model):
+        yield self.inner, model
+        if self.failover:
+            self.stats.record("failovers")
+            yield self.failover
+
+    def _watch(self, stream, cancel_token=None):
+        """Đọc stream trong thread riêng, ném StreamStalledError nếu quá lâu không có chunk.
+
+        cancel_token là token riêng của lần thử: nó bị hủy khi stream bị treo hoặc người đọc dừng
+        giữa chừng, để provider đóng kết nối HTTP (và trả slot của governor) thay vì để thread đọc treo mãi.
+        """
+        if not self.idle_timeout:
+            yield from stream
+            return
+        chunks = queue.Queue()
+        stop = threading.Event()
+        if cancel_token is not None:
+            # Trả quyền điều khiển ngay khi bị hủy, không chờ thread đọc stream kết thúc
+            cancel_token.on_cancel(lambda: chunks.put((_DONE, None)))
+
+        def pump():
+            try:
+                for chunk in stream:
+                    if stop.is_set():
+                        break
+                    chunks.put((_CHUNK, chunk))
+                chunks.put((_DONE, None))
+            except Exception as e:
+                chunks.put((_ERROR, e))
+            finally:
+                stream.close()
+
+        threading.Thread(target=pump, daemon=True, name="llm-stream").start()
+        timeout = self.first_chunk_timeout or None
+        finished = False
+        try:
+            while True:
+                try:
+                    kind, value = chunks.get(timeout=timeout)
+                except queue.Empty:
+                    self.stats.record("stalls")
+                    raise StreamStalledError(f"Không nhận được dữ liệu sau {timeout:g}s")
+                if kind == _DONE:
+                    finished = True
+                    return
+                if kind == _ERROR:
+                    finished = True
+                    raise value
+                timeout = self.idle_timeout
+                yield value
+        finally:
+            stop.set()
+            if not finished and cancel_token is not None:
+                cancel_token.cancel()
+
+    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        cancel_token = cancel_token or CancelToken()
+        last_error = None
+        for provider, target_model in self._targets(model):
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    self.stats.record("retries")
+                    if cancel_token.wait(backoff_delay(attempt, last_error)):
+                        break
+                self.stats.record("attempts")
+                started = False
+                # Mỗi lần thử có token riêng để đóng được stream bị treo mà không hủy cả request
+                attempt_token = cancel_token.child()
+                try:
+                    stream = provider.chat_stream(messages, target_model, temperature, max_tokens, system_prompt, attempt_token)
+                    for chunk in self._watch(stream, attempt_token):
+                        started = True
+                        yield chunk
+                    self.stats.record("cancellations" if cancel_token.cancelled else "successes")
+                    return
+                except Exception as e:
+                    # Lỗi do đóng kết nối khi hủy: giữ phần đã nhận, không thử lại
+                    if cancel_token.cancelled:
+                        break
+                    self.stats.record("failed_attempts")
+                    if started or not is_retryable_error(e):
+                        raise
+                    last_error = e
+            if cancel_token.cancelled:
+                self.stats.record("cancellations")
+                return
+        raise last_error
+
+    async def _awatch(self, stream, cancel_token=None):
+        """Bản async của _watch: cancel_token của lần thử bị hủy khi stream bị treo hoặc người đọc dừng giữa chừng."""
+        timeout = self.first_chunk_timeout or None
+        finished = False
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), timeout if self.idle_timeout else None)
+                except StopAsyncIteration:
+                    finished = True
+                    return
+                except asyncio.TimeoutError:
+                    self.stats.record("stalls")
+                    raise StreamStalledError(f"Không nhận được dữ liệu sau {timeout:g}s")
+                timeout = self.idle_timeout
+                yield chunk
+        finally:
+            if not finished and cancel_token is not None:
+                cancel_token.cancel()
+            await stream.aclose()
+
+    async def achat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        cancel_token = cancel_token or CancelToken()
+        last_error = None
+        for provider, target_model in self._targets(model):
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    self.stats.record("retries")
+                    if await cancellable_sleep(backoff_delay(attempt, last_error), cancel_token):
+                        break
+                self.stats.record("attempts")
+                started = False
+                attempt_token = cancel_token.child()
+                try:
+                    stream = provider.achat_stream(messages, target_model, temperature, max_tokens, system_prompt, attempt_token)
+                    async for chunk in self._awatch(stream, attempt_token):
+                        started = True
+                        yield chunk
+                    self.stats.record("cancellations" if cancel_token.cancelled else "successes")
+                    return
+                except Exception as e:
+                    if cancel_token.cancelled:
+                        break
+                    self.stats.record("failed_attempts")
+                    if started or not is_retryable_error(e):
+                        raise
+                    last_error = e
+            if cancel_token.cancelled:
+                self.stats.record("cancellations")
+                return
+        raise last_error
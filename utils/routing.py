@@ -0,0 +1,229 @@
+import collections
+import datetime
+import json
+import os
+import threading
+import time
+import streamlit as st
+from utils.context import estimate_tokens
+from utils.llm import ProviderWrapper, is_error_response
+
+# Tên model đặc biệt để router tự chọn model cho từng request
+AUTO_MODEL = "auto"
+# Bật/tắt mục "auto" trong danh sách model
+ROUTING_ENABLED = os.environ.get("LLM_AUTO_ROUTING", "1") == "1"
+# Số lần gọi gần nhất dùng để tính p50/p95 cho mỗi model
+LATENCY_WINDOW = int(os.environ.get("LLM_ROUTING_WINDOW", "200"))
+# Request chat ngắn hơn ngưỡng này (token input) được coi là tra cứu nhanh
+SHORT_INPUT_TOKENS = int(os.environ.get("LLM_ROUTING_SHORT_TOKENS", "800"))
+# Request dài hơn ngưỡng này được đẩy lên model mạnh hơn một bậc
+LONG_INPUT_TOKENS = int(os.environ.get("LLM_ROUTING_LONG_TOKENS", "12000"))
+# SLO tổng thời gian p95 (giây): model vượt SLO sẽ được thay bằng model nhẹ hơn
+LATENCY_SLO_P95 = float(os.environ.get("LLM_ROUTING_SLO_P95", "30"))
+# Số mẫu tối thiểu trước khi tin vào thống kê độ trễ của một model
+MIN_SAMPLES = 5
+# File JSONL ghi lại quyết định routing và độ trễ quan sát được
+ROUTING_LOG_PATH = os.environ.get("LLM_ROUTING_LOG", os.path.join(".cache", "routing.jsonl"))
+
+# Bậc xuất phát (0 = model nhẹ nhất) theo loại tác vụ
+TASK_BASE_TIER = {
+    "chat": 1,
+    "summarize": 0,
+    "translate": 1,
+    "markmap": 1,
+}
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+class LatencyTracker:
+    """Lưu độ trễ các lần gọi gần nhất của từng (provider, model) và ghi log quyết định routing."""
+    def __init__(self, window=LATENCY_WINDOW, log_path=ROUTING_LOG_PATH):
+        self.window = window
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self._samples = {}
+        self.decisions = collections.deque(maxlen=window)
+
+    def record(self, provider_name, model, ttft, total):
+        with self._lock:
+            samples = self._samples.setdefault((provider_name, model), collections.deque(maxlen=self.window))
+            samples.append((ttft, total))
+
+    def stats(self, provider_name, model):
+        """p50/p95 của TTFT và tổng thời gian (giây), None nếu chưa có mẫu."""
+        with self._lock:
+            samples = list(self._samples.get((provider_name, model), ()))
+        if not samples:
+            return None
+        ttfts = [ttft for ttft, _ in samples if ttft is not None]
+        totals = [total for _, total in samples]
+        return {
+            "samples": len(samples),
+            "ttft_p50": percentile(ttfts, 50),
+            "ttft_p95": percentile(ttfts, 95),
+            "total_p50": percentile(totals, 50),
+            "total_p95": percentile(totals, 95),
+        }
+
+    def log(self, entry):
+        """Ghi một quyết định routing (kèm độ trễ quan sát được) ra file JSONL."""
+        with self._lock:
+            self.decisions.append(entry)
+            if not self.log_path:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+            except OSError:
+                # Không ghi được log thì vẫn phục vụ request
+                pass
+
+@st.cache_resource
+def get_latency_tracker():
+    """Trả về LatencyTracker dùng chung cho process."""
+    return LatencyTracker()
+
+class RoutingProvider(ProviderWrapper):
+    """Bọc một LLMProvider: thêm model "auto" và ghi nhận độ trễ mọi lần gọi.
+
+    Với model "auto", model được chọn theo số token input, loại tác vụ và p95 độ trễ
+    gần đây của từng model trong routing_tiers của provider (nhẹ -> mạnh).
+    """
+    def __init__(self, inner, tracker, task="chat"):
+        super().__init__(inner)
+        self.tracker = tracker
+        self.task = task
+
+    def for_task(self, task):
+        return RoutingProvider(self.inner.for_task(task), self.tracker, task)
+
+    @property
+    def tiers(self):
+        models = set(self.inner.get_models())
+        return [model for model in getattr(self.inner, "routing_tiers", ()) if model in models]
+
+    def get_models(self):
+        models = self.inner.get_models()
+        return models + [AUTO_MODEL] if self.tiers else models
+
+    def get_context_window(self, model):
+        if model == AUTO_MODEL:
+            return max((self.inner.get_context_window(m) for m in self.tiers), default=0)
+        return self.inner.get_context_window(model)
+
+    def route(self, messages, max_tokens, system_prompt, model=AUTO_MODEL):
+        """Chọn model cho request. Trả về (model, thông tin quyết định).
+
+        Provider không có model nào để định tuyến thì giữ nguyên model được yêu cầu.
+        """
+        input_tokens = estimate_tokens(system_prompt) + sum(estimate_tokens(m['content']) for m in messages)
+        if not self.tiers:
+            return model, {"task": self.task, "input_tokens": input_tokens, "reason": "no_tiers", "candidates": [], "stats": None}
+        needed = input_tokens + (max_tokens or 0)
+        tiers = [m for m in self.tiers if self.inner.get_context_window(m) >= needed] or self.tiers
+        tier = TASK_BASE_TIER.get(self.task, 1)
+        if self.task == "chat" and input_tokens < SHORT_INPUT_TOKENS:
+            tier = 0
+        elif input_tokens > LONG_INPUT_TOKENS:
+            tier += 1
+        tier = min(tier, len(tiers) - 1)
+        reason = "size"
+        # Model vượt SLO độ trễ được thay bằng model nhẹ hơn còn trong SLO (hoặc chưa đủ số liệu)
+        for candidate in range(tier, -1, -1):
+            stats = self.tracker.stats(self.provider_name, tiers[candidate])
+            if stats is None or stats["samples"] < MIN_SAMPLES or stats["total_p95"] <= LATENCY_SLO_P95:
+                if candidate != tier:
+                    reason = "latency_slo"
+                tier = candidate
+                break
+        else:
+            tier = 0
+            reason = "latency_slo"
+        model = tiers[tier]
+        return model, {
+            "task": self.task,
+            "input_tokens": input_tokens,
+            "reason": reason,
+            "candidates": tiers,
+            "stats": self.tracker.stats(self.provider_name, model),
+        }
+
+    def _route_call(self, messages, model, max_tokens, system_prompt):
+        decision = None
+        if model == AUTO_MODEL:
+            model, decision = self.route(messages, max_tokens, system_prompt, model)
+        return _RoutedCall(self, model, decision)
+
+    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        call = self._route_call(messages, model, max_tokens, system_prompt)
+        try:
+            for chunk in self.inner.chat_stream(messages, call.model, temperature, max_tokens, system_prompt, cancel_token):
+                call.chunk(chunk)
+                yield chunk
+            call.exhausted = True
+        except Exception as e:
+            call.error = type(e).__name__
+            raise
+        finally:
+            call.finish(cancel_token)
+
+    async def achat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        call = self._route_call(messages, model, max_tokens, system_prompt)
+        try:
+            async for chunk in self.inner.achat_stream(messages, call.model, temperature, max_tokens, system_prompt, cancel_token):
+                call.chunk(chunk)
+                yield chunk
+            call.exhausted = True
+        except Exception as e:
+            call.error = type(e).__name__
+            raise
+        finally:
+            call.finish(cancel_token)
+
+class _RoutedCall:
+    """Một lời gọi qua RoutingProvider (sync hoặc async): đo độ trễ cho tracker và ghi log quyết định định tuyến."""
+    def __init__(self, provider, model, decision):
+        self.provider = provider
+        self.model = model
+        self.decision = decision
+        self.started = time.perf_counter()
+        self.first = None
+        self.error = None
+        self.chars = 0
+        self.exhausted = False
+
+    def chunk(self, chunk):
+        if self.first is None:
+            self.first = time.perf_counter()
+            if is_error_response(chunk):
+                self.error = "error_response"
+        self.chars += len(chunk)
+
+    def finish(self, cancel_token):
+        tracker = self.provider.tracker
+        provider_name = self.provider.provider_name
+        total = time.perf_counter() - self.started
+        ttft = self.first - self.started if self.first is not None else None
+        # Chỉ lần gọi thành công trọn vẹn mới phản ánh đúng độ trễ của model
+        complete = (self.exhausted and self.error is None and self.first is not None
+                    and not (cancel_token is not None and cancel_token.cancelled))
+        if complete:
+            tracker.record(provider_name, self.model, ttft, total)
+        if self.decision is not None:
+            self.decision.update({
+                "at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "provider": provider_name,
+                "model": self.model,
+                "ttft": ttft,
+                "total": total,
+                "chars": self.chars,
+                "error": self.error,
+                "complete": complete,
+            })
+            tracker.log(self.decision)
@@ -0,0 +1,253 @@
+import asyncio
+import os
+import threading
+import time
+import streamlit as st
+from utils.clients import hash_api_key
+from utils.llm import CancelToken, ProviderWrapper, canonical_request_hash, is_cancelled
+
+# Bật/tắt gộp các request giống hệt nhau đang chạy đồng thời
+SINGLE_FLIGHT_ENABLED = os.environ.get("LLM_SINGLE_FLIGHT", "1") == "1"
+# Số ký tự tối đa một stream dùng chung được giữ trong bộ nhớ cho các subscriber
+SINGLE_FLIGHT_MAX_BUFFER = int(os.environ.get("LLM_SINGLE_FLIGHT_MAX_BUFFER", str(1024 * 1024)))
+# Subscriber chậm làm stream dùng chung phải chờ quá lâu (giây) sẽ bị tách ra
+SLOW_SUBSCRIBER_TIMEOUT = float(os.environ.get("LLM_SINGLE_FLIGHT_LAG_TIMEOUT", "30"))
+
+class SubscriberLaggedError(RuntimeError):
+    """Subscriber đọc quá chậm so với stream dùng chung và đã bị tách ra."""
+
+class _Flight:
+    """Một stream upstream đang chạy, được chia sẻ cho nhiều subscriber.
+
+    Các chunk được giữ trong một buffer chung; mỗi subscriber đọc từ vị trí riêng nên
+    người đến sau vẫn nhận đủ chuỗi chunk từ đầu. Khi buffer vượt quá max_buffer ký tự,
+    phần mọi subscriber đã đọc bị bỏ đi và flight không nhận thêm subscriber mới.
+    """
+    def __init__(self, max_buffer, lag_timeout):
+        self.max_buffer = max_buffer
+        self.lag_timeout = lag_timeout
+        self.cancel_token = CancelToken()
+        self.chunks = []
+        self.base = 0
+        self.buffered_chars = 0
+        self.done = False
+        self.error = None
+        self.positions = {}
+        self.lagged = set()
+        self._next_id = 0
+        self._cond = threading.Condition()
+
+    @property
+    def joinable(self):
+        return not self.done and self.base == 0
+
+    def subscribe(self):
+        with self._cond:
+            subscriber = self._next_id
+            self._next_id += 1
+            self.positions[subscriber] = 0
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._cond:
+            self.positions.pop(subscriber, None)
+            self.lagged.discard(subscriber)
+            orphaned = not self.positions and not self.done
+            self._cond.notify_all()
+        # Không còn ai đọc thì đóng kết nối upstream
+        if orphaned:
+            self.cancel_token.cancel()
+
+    def wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def _trim(self):
+        """Bỏ các chunk mọi subscriber đã đọc qua."""
+        keep_from = min(self.positions.values(), default=self.base + len(self.chunks))
+        drop = keep_from - self.base
+        if drop > 0:
+            self.buffered_chars -= sum(len(chunk) for chunk in self.chunks[:drop])
+            del self.chunks[:drop]
+            self.base = keep_from
+
+    def publish(self, chunk):
+        """Thêm chunk từ upstream; chờ subscriber chậm đọc bớt nếu buffer đã đầy."""
+        with self._cond:
+            self.chunks.append(chunk)
+            self.buffered_chars += len(chunk)
+            self._cond.notify_all()
+            if self.buffered_chars <= self.max_buffer:
+                return
+            self._trim()
+            deadline = time.monotonic() + self.lag_timeout
+            while self.buffered_chars > self.max_buffer and self.positions and not self.cancel_token.cancelled:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # Tách các subscriber chậm nhất để những người khác không phải chờ
+                    slowest = min(self.positions.values())
+                    for subscriber, position in list(self.positions.items()):
+                        if position == slowest:
+                            del self.positions[subscriber]
+                            self.lagged.add(subscriber)
+                    self._cond.notify_all()
+                else:
+                    self._cond.wait(remaining)
+                self._trim()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+
+    def read(self, subscriber, timeout=0.5):
+        """Trả về các chunk mới của subscriber; danh sách rỗng nghĩa là chưa có gì mới."""
+        with self._cond:
+            if subscriber in self.lagged:
+                raise SubscriberLaggedError("Đọc quá chậm so với stream dùng chung")
+            position = self.positions[subscriber]
+            available = self.base + len(self.chunks)
+            if position >= available and not self.done:
+                self._cond.wait(timeout)
+                if subscriber in self.lagged:
+                    raise SubscriberLaggedError("Đọc quá chậm so với stream dùng chung")
+                available = self.base + len(self.chunks)
+            new_chunks = self.chunks[position - self.base:]
+            self.positions[subscriber] = available
+            if new_chunks:
+                self._cond.notify_all()
+            return new_chunks
+
+class SingleFlightGroup:
+    """Gộp các request giống hệt nhau đang chạy đồng thời vào một stream upstream duy nhất."""
+    def __init__(self, max_buffer=SINGLE_FLIGHT_MAX_BUFFER, lag_timeout=SLOW_SUBSCRIBER_TIMEOUT):
+        self.max_buffer = max_buffer
+        self.lag_timeout = lag_timeout
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.counters = {
+            "flights": 0,
+            "joined": 0,
+            "lagged": 0,
+        }
+
+    def _pump(self, key, flight, stream_fn):
+        error = None
+        try:
+            for chunk in stream_fn(flight.cancel_token):
+                flight.publish(chunk)
+                if flight.cancel_token.cancelled:
+                    break
+        except Exception as e:
+            error = e
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.finish(error)
+
+    def _join(self, key, stream_fn):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight.joinable:
+                self.counters["joined"] += 1
+                return flight, flight.subscribe()
+            flight = _Flight(self.max_buffer, self.lag_timeout)
+            subscriber = flight.subscribe()
+            self._flights[key] = flight
+            self.counters["flights"] += 1
+        threading.Thread(target=self._pump, args=(key, flight, stream_fn),
+                         daemon=True, name="llm-single-flight").start()
+        return flight, subscriber
+
+    def stream(self, key, stream_fn, cancel_token=None):
+        """Stream các chunk của request key; stream_fn(cancel_token) chỉ được gọi khi chưa có flight chung."""
+        flight, subscriber = self._join(key, stream_fn)
+        if cancel_token is not None:
+            cancel_token.on_cancel(flight.wake)
+        try:
+            while not is_cancelled(cancel_token):
+                try:
+                    new_chunks = flight.read(subscriber)
+                except SubscriberLaggedError:
+                    with self._lock:
+                        self.counters["lagged"] += 1
+                    raise
+                yield from new_chunks
+                if flight.done and not new_chunks:
+                    break
+        finally:
+            flight.unsubscribe(subscriber)
+        self._finish(flight, cancel_token)
+
+    async def astream(self, key, stream_fn, cancel_token=None):
+        """Bản async của stream, dùng chung flight với các lời gọi sync: chờ chunk mới trong thread pool
+        để không chặn event loop."""
+        flight, subscriber = self._join(key, stream_fn)
+        if cancel_token is not None:
+            cancel_token.on_cancel(flight.wake)
+        try:
+            while not is_cancelled(cancel_token):
+                try:
+                    new_chunks = await asyncio.to_thread(flight.read, subscriber)
+                except SubscriberLaggedError:
+                    with self._lock:
+                        self.counters["lagged"] += 1
+                    raise
+                for chunk in new_chunks:
+                    yield chunk
+                if flight.done and not new_chunks:
+                    break
+        finally:
+            flight.unsubscribe(subscriber)
+        self._finish(flight, cancel_token)
+
+    @staticmethod
+    def _finish(flight, cancel_token):
+        # Subscriber tự hủy không nhận lỗi của upstream
+        if flight.error is not None and not is_cancelled(cancel_token):
+            raise flight.error
+        # Usage của request upstream được báo cho từng subscriber
+        if cancel_token is not None and flight.cancel_token.usage is not None:
+            cancel_token.report_usage(flight.cancel_token.usage)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, in_flight=len(self._flights))
+
+@st.cache_resource
+def get_single_flight_group():
+    """Trả về SingleFlightGroup dùng chung cho process."""
+    return SingleFlightGroup()
+
+class SingleFlightProvider(ProviderWrapper):
+    """Bọc một LLMProvider: các request giống hệt nhau (cùng API key) dùng chung một stream upstream.
+
+    Upstream luôn là chat_stream của provider bên trong (đọc trong thread riêng của flight)
+    nên lời gọi sync và async giống nhau cũng được gộp với nhau.
+    """
+    def __init__(self, inner, group):
+        super().__init__(inner)
+        self.group = group
+
+    def _key(self, messages, model, temperature, max_tokens, system_prompt):
+        request_hash = canonical_request_hash(self.provider_name, messages, model, temperature, max_tokens, system_prompt)
+        # Không dùng chung stream giữa các API key khác nhau
+        return (hash_api_key(self.api_key), request_hash)
+
+    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        key = self._key(messages, model, temperature, max_tokens, system_prompt)
+        return self.group.stream(
+            key,
+            lambda flight_token: self.inner.chat_stream(messages, model, temperature, max_tokens, system_prompt, flight_token),
+            cancel_token
+        )
+
+    def achat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        key = self._key(messages, model, temperature, max_tokens, system_prompt)
+        return self.group.astream(
+            key,
+            lambda flight_token: self.inner.chat_stream(messages, model, temperature, max_tokens, system_prompt, flight_token),
+            cancel_token
+        )
@@ -0,0 +1,58 @@
+import io
+import time
+
+# Số lần render tối đa mỗi giây khi stream
+DEFAULT_MAX_FPS = 12
+# Render sớm hơn khi phần chưa hiển thị đã lớn hơn ngưỡng này (ký tự)
+DEFAULT_FLUSH_CHARS = 2048
+# Giới hạn lưu lượng gửi qua websocket: response càng dài thì càng render thưa
+DEFAULT_MAX_CHARS_PER_SECOND = 200000
+
+class StreamRenderer:
+    """Gộp các chunk stream và render lên placeholder với tần suất giới hạn.
+
+    Mỗi lần render gửi lại toàn bộ nội dung, nên số lần render được giới hạn theo
+    frame rate và theo độ dài nội dung để response dài vẫn mượt như response ngắn.
+    """
+    def __init__(self, placeholder, format_fn=None, cursor="▌", max_fps=DEFAULT_MAX_FPS,
+                 flush_chars=DEFAULT_FLUSH_CHARS, max_chars_per_second=DEFAULT_MAX_CHARS_PER_SECOND):
+        self.placeholder = placeholder
+        self.format_fn = format_fn or (lambda text: text)
+        self.cursor = cursor
+        self.min_interval = 1.0 / max_fps
+        self.flush_chars = flush_chars
+        self.max_chars_per_second = max_chars_per_second
+        self._buffer = io.StringIO()
+        self._length = 0
+        self._pending = 0
+        self._last_flush = 0.0
+        self.renders = 0
+
+    @property
+    def text(self):
+        return self._buffer.getvalue()
+
+    def _interval(self):
+        return max(self.min_interval, self._length / self.max_chars_per_second)
+
+    def write(self, chunk):
+        """Thêm chunk vào buffer, chỉ render khi đã đến lượt."""
+        if not chunk:
+            return
+        self._buffer.write(chunk)
+        self._length += len(chunk)
+        self._pending += len(chunk)
+        elapsed = time.monotonic() - self._last_flush
+        if elapsed >= self._interval() or (self._pending >= self.flush_chars and elapsed >= self.min_interval):
+            self.flush()
+
+    def flush(self, final=False):
+        self.placeholder.markdown(self.format_fn(self.text) + ("" if final else self.cursor))
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        self.renders += 1
+
+    def close(self):
+        """Render lần cuối (không có con trỏ) và trả về toàn bộ nội dung."""
+        self.flush(final=True)
+        return self.text
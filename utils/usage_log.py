@@ -0,0 +1,244 @@
+import atexit
+import datetime
+import os
+import queue
+import threading
+import time
+import streamlit as st
+from pymongo.errors import ConnectionFailure
+from utils.context import estimate_tokens
+from utils.llm import CancelToken, ProviderWrapper, is_error_response
+
+# Bật/tắt ghi log mỗi lần gọi chat_stream vào collection logs
+USAGE_LOG_ENABLED = os.environ.get("LLM_USAGE_LOG", "1") == "1"
+# Số bản ghi tối đa mỗi lần insert_many
+LOG_BATCH_SIZE = int(os.environ.get("LLM_USAGE_LOG_BATCH", "100"))
+# Bản ghi chờ lâu nhất bao lâu (giây) trước khi được ghi xuống DB
+LOG_FLUSH_INTERVAL = float(os.environ.get("LLM_USAGE_LOG_INTERVAL", "2"))
+# Số bản ghi tối đa chờ ghi; vượt quá thì bản ghi mới bị bỏ để không làm chậm request
+LOG_MAX_QUEUE = int(os.environ.get("LLM_USAGE_LOG_MAX_QUEUE", "10000"))
+LOG_COLLECTION = "logs"
+
+class UsageLogBatcher:
+    """Gom các bản ghi log trong hàng đợi và ghi xuống MongoDB bằng insert_many ở thread nền.
+
+    log() không bao giờ chờ DB: khi hàng đợi đầy, bản ghi bị bỏ và được đếm ở counters["dropped"].
+    Đích ghi là (mongo_uri, db_name); collection chỉ được lấy ở thread nền lúc ghi.
+    """
+    def __init__(self, batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL, max_queue=LOG_MAX_QUEUE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.counters = {
+            "logged": 0,
+            "dropped": 0,
+            "written": 0,
+            "failed": 0,
+            "batches": 0,
+        }
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True, name="llm-usage-log")
+            self._thread.start()
+        # Ghi nốt các bản ghi còn trong hàng đợi khi process tắt
+        atexit.register(self.flush)
+
+    def log(self, target, record):
+        """Đưa một bản ghi vào hàng đợi ghi của target (mongo_uri, db_name)."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((target, record))
+        except queue.Full:
+            with self._lock:
+                self.counters["dropped"] += 1
+            return
+        with self._lock:
+            self.counters["logged"] += 1
+
+    def flush(self, timeout=5.0):
+        """Chờ tối đa timeout giây cho tới khi các bản ghi đang chờ được ghi xong."""
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def _next_batch(self):
+        """Lấy tối đa batch_size bản ghi, chờ thêm không quá flush_interval sau bản ghi đầu tiên."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and not isinstance(batch[-1], threading.Event):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    @staticmethod
+    def _collection(target):
+        """Collection log của target, None nếu cluster đang không truy cập được."""
+        from utils.db import _uri_key, get_db_client
+        from utils.journal import get_mongo_health
+        mongo_uri, db_name = target
+        if not get_mongo_health().available(_uri_key(mongo_uri)):
+            return None
+        return get_db_client(mongo_uri)[db_name][LOG_COLLECTION]
+
+    def _write(self, records):
+        groups = {}
+        for target, record in records:
+            # Mỗi user group ghi vào database riêng
+            groups.setdefault(target, []).append(record)
+        for target, docs in groups.items():
+            try:
+                collection = self._collection(target)
+                if collection is None:
+                    raise ConnectionFailure("MongoDB tạm thời không truy cập được")
+                collection.insert_many(docs, ordered=False)
+                written, failed = len(docs), 0
+            except Exception:
+                # Mất log tốt hơn làm hỏng request; số bản ghi lỗi được đếm lại
+                written, failed = 0, len(docs)
+            with self._lock:
+                self.counters["written"] += written
+                self.counters["failed"] += failed
+                self.counters["batches"] += 1
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            records = [item for item in batch if not isinstance(item, threading.Event)]
+            if records:
+                self._write(records)
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, pending=self._queue.qsize())
+
+@st.cache_resource
+def get_usage_log_batcher():
+    """Trả về UsageLogBatcher dùng chung cho process."""
+    return UsageLogBatcher()
+
+class UsageLogProvider(ProviderWrapper):
+    """Bọc một LLMProvider: ghi log provider, model, trang, user group, số token, TTFT,
+    tổng thời gian và loại lỗi của mỗi lần gọi chat_stream/achat_stream.
+
+    target, page và user_group được lấy lúc tạo provider (trong thread chạy script)
+    vì stream có thể được đọc ở thread nền không có session_state. Số token được đọc từ
+    cancel_token riêng của lời gọi, không phụ thuộc thread đọc stream.
+    """
+    def __init__(self, inner, batcher, target, page=None, user_group=None, task="chat"):
+        super().__init__(inner)
+        self.batcher = batcher
+        self.target = target
+        self.page = page
+        self.user_group = user_group
+        self.task = task
+
+    def for_task(self, task):
+        return UsageLogProvider(self.inner.for_task(task), self.batcher, self.target,
+                                self.page, self.user_group, task)
+
+    @staticmethod
+    def _call_token(cancel_token):
+        return cancel_token.child() if cancel_token is not None else CancelToken()
+
+    def _log(self, call_token, messages, model, system_prompt, started, first, error, chunks):
+        record = {
+            "created_at": datetime.datetime.now(datetime.timezone.utc),
+            "provider": self.provider_name,
+            "model": model,
+            "page": self.page,
+            "task": self.task,
+            "user_group": self.user_group,
+            "ttft": first - started if first is not None else None,
+            "duration": time.perf_counter() - started,
+            "error": error,
+            "cancelled": call_token.cancelled,
+        }
+        usage = call_token.usage
+        if usage is not None:
+            record.update({
+                "prompt_tokens": usage["input_tokens"] + usage["cache_read_input_tokens"] + usage["cache_creation_input_tokens"],
+                "completion_tokens": usage["output_tokens"],
+                "cache_read_tokens": usage["cache_read_input_tokens"],
+                "cache_write_tokens": usage["cache_creation_input_tokens"],
+                "tokens_estimated": False,
+            })
+        else:
+            # Provider không báo usage (hoặc stream bị dừng giữa chừng) thì ước lượng
+            record.update({
+                "prompt_tokens": estimate_tokens(system_prompt) + sum(estimate_tokens(m['content']) for m in messages),
+                "completion_tokens": estimate_tokens("".join(chunks)),
+                "cache_read_tokens": 0,
+                "cache_write_tokens": 0,
+                "tokens_estimated": True,
+            })
+        self.batcher.log(self.target, record)
+
+    def chat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        call_token = self._call_token(cancel_token)
+        started = time.perf_counter()
+        first = None
+        error = None
+        chunks = []
+        try:
+            for chunk in self.inner.chat_stream(messages, model, temperature, max_tokens, system_prompt, call_token):
+                if first is None:
+                    first = time.perf_counter()
+                    if is_error_response(chunk):
+                        error = "error_response"
+                chunks.append(chunk)
+                yield chunk
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self._log(call_token, messages, model, system_prompt, started, first, error, chunks)
+
+    async def achat_stream(self, messages, model, temperature, max_tokens, system_prompt, cancel_token=None):
+        call_token = self._call_token(cancel_token)
+        started = time.perf_counter()
+        first = None
+        error = None
+        chunks = []
+        try:
+            async for chunk in self.inner.achat_stream(messages, model, temperature, max_tokens, system_prompt, call_token):
+                if first is None:
+                    first = time.perf_counter()
+                    if is_error_response(chunk):
+                        error = "error_response"
+                chunks.append(chunk)
+                yield chunk
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self._log(call_token, messages, model, system_prompt, started, first, error, chunks)
+
+def wrap_usage_log(provider, page=None):
+    """Gắn UsageLogProvider nếu bật log và session hiện tại đã cấu hình MongoDB.
+
+    Chỉ đọc session_state; kết nối và collection được lấy ở thread ghi log.
+    """
+    if not USAGE_LOG_ENABLED or not st.session_state.get("mongo_uri"):
+        return provider
+    from utils.db import get_database_name
+    target = (st.session_state.mongo_uri, get_database_name())
+    return UsageLogProvider(provider, get_usage_log_batcher(), target,
+                            page=page, user_group=st.session_state.get("user_group"))
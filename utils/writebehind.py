@@ -0,0 +1,188 @@
+import atexit
+import collections
+import datetime
+import os
+import threading
+import time
+
+# Bật/tắt ghi phiên chat xuống DB ở thread nền
+WRITE_BEHIND_ENABLED = os.environ.get("SESSION_WRITE_BEHIND", "1") == "1"
+# Số phiên chat tối đa đang chờ ghi; đầy thì người gọi phải chờ (backpressure)
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get("SESSION_WRITE_MAX_PENDING", "1000"))
+# Thời gian gom thêm cập nhật trước mỗi lần ghi (giây)
+WRITE_BEHIND_LINGER = float(os.environ.get("SESSION_WRITE_LINGER", "0.2"))
+# Thời gian tối đa người gọi chờ khi hàng đợi đầy, quá thì tự ghi trực tiếp (giây)
+WRITE_BEHIND_SUBMIT_TIMEOUT = float(os.environ.get("SESSION_WRITE_SUBMIT_TIMEOUT", "5"))
+# Thời gian chờ trước khi ghi lại sau một lần ghi lỗi (giây)
+WRITE_BEHIND_RETRY_INTERVAL = float(os.environ.get("SESSION_WRITE_RETRY_INTERVAL", "2"))
+# Số lần ghi tối đa của một thay đổi gặp lỗi không phải do mất kết nối, quá thì bỏ thay đổi đó
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.environ.get("SESSION_WRITE_MAX_ATTEMPTS", "3"))
+
+class SessionMutation:
+    """Các thay đổi đang chờ ghi của một phiên chat: trường cần $set, history đầy đủ (nếu có)
+    và việc phiên chat có phải mới tạo hay không."""
+    def __init__(self, db, session_id, user_group, fields, history=None, new=False):
+        self.db = db
+        self.session_id = session_id
+        self.user_group = user_group
+        self.fields = dict(fields)
+        self.history = history
+        self.new = new
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        # Số tin nhắn đã có trong DB nếu đã biết (để ghi thêm không phải đọc lại), None nếu chưa biết
+        self.stored_count = None
+        # Số lần ghi đã thất bại vì lỗi không phải do mất kết nối
+        self.attempts = 0
+
+    def merge(self, newer):
+        """Gộp thay đổi mới hơn vào: trường mới ghi đè, history lấy bản mới nhất.
+
+        stored_count giữ giá trị của thay đổi cũ hơn vì các tin nhắn của nó chưa được ghi.
+        """
+        self.db = newer.db
+        self.fields.update(newer.fields)
+        if newer.history is not None:
+            self.history = newer.history
+        if newer.new and not self.new:
+            self.new = True
+            self.created_at = newer.created_at
+
+class SessionWriteBehind:
+    """Hàng đợi ghi phiên chat: gộp các thay đổi của cùng một phiên và ghi bằng write_fn ở thread nền.
+
+    write_fn(mutations) ghi một lô SessionMutation (ví dụ bằng bulk_write). Lô gặp lỗi retryable(e)
+    (mất kết nối) được đưa lại vào hàng đợi (gộp với thay đổi mới hơn nếu có) và thử lại sau
+    retry_interval. Với lỗi khác, từng thay đổi được ghi riêng: thay đổi lỗi được thử lại tối đa
+    max_attempts lần rồi bị bỏ, để một thay đổi hỏng không chặn việc ghi của các phiên chat khác.
+    """
+    def __init__(self, write_fn, retryable=lambda e: True, max_pending=WRITE_BEHIND_MAX_PENDING,
+                 linger=WRITE_BEHIND_LINGER, retry_interval=WRITE_BEHIND_RETRY_INTERVAL,
+                 max_attempts=WRITE_BEHIND_MAX_ATTEMPTS):
+        self.write_fn = write_fn
+        self.retryable = retryable
+        self.max_pending = max_pending
+        self.linger = linger
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.last_error = None
+        self._pending = collections.OrderedDict()
+        self._inflight = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self.counters = {
+            "submitted": 0,
+            "coalesced": 0,
+            "written": 0,
+            "batches": 0,
+            "failed_batches": 0,
+            "rejected": 0,
+            "dropped": 0,
+        }
+
+    def _ensure_started(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True, name="session-write-behind")
+            self._thread.start()
+        # Ghi nốt các thay đổi đang chờ khi process tắt
+        atexit.register(self.flush)
+
+    def submit(self, mutation, timeout=WRITE_BEHIND_SUBMIT_TIMEOUT):
+        """Đưa thay đổi vào hàng đợi. Trả về False nếu hàng đợi vẫn đầy sau timeout giây
+        (người gọi nên tự ghi trực tiếp)."""
+        self._ensure_started()
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                existing = self._pending.get(mutation.session_id)
+                if existing is not None:
+                    existing.merge(mutation)
+                    self.counters["coalesced"] += 1
+                    self._cond.notify_all()
+                    return True
+                if len(self._pending) < self.max_pending:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.counters["rejected"] += 1
+                    return False
+                self._cond.wait(remaining)
+            self._pending[mutation.session_id] = mutation
+            self.counters["submitted"] += 1
+            self._cond.notify_all()
+            return True
+
+    def get_pending(self, session_id):
+        """Thay đổi chưa ghi xong của phiên chat (đang chờ hoặc đang ghi), None nếu không có."""
+        with self._cond:
+            return self._pending.get(session_id) or self._inflight.get(session_id)
+
+    def discard(self, session_id, timeout=WRITE_BEHIND_SUBMIT_TIMEOUT):
+        """Bỏ các thay đổi đang chờ của phiên chat (khi xóa) và chờ lần ghi đang chạy của nó kết thúc."""
+        with self._cond:
+            self._pending.pop(session_id, None)
+            self._cond.wait_for(lambda: session_id not in self._inflight, timeout)
+            # Lô đang ghi bị lỗi sẽ được đưa lại vào hàng đợi, bỏ nốt
+            self._pending.pop(session_id, None)
+
+    def flush(self, timeout=10.0):
+        """Chờ tối đa timeout giây cho tới khi mọi thay đổi đã được ghi. Trả về True nếu đã ghi hết."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._inflight, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+            # Chờ thêm một chút để gộp các cập nhật liên tiếp của cùng phiên chat
+            time.sleep(self.linger)
+            with self._cond:
+                self._inflight = dict(self._pending)
+                self._pending.clear()
+                self._cond.notify_all()
+            batch = list(self._inflight.values())
+            retry, dropped = self._write(batch)
+            with self._cond:
+                self.counters["batches"] += 1
+                if retry:
+                    self.counters["failed_batches"] += 1
+                    # Đưa các thay đổi lỗi về đầu hàng đợi, thay đổi mới hơn được gộp vào sau
+                    for mutation in reversed(retry):
+                        newer = self._pending.pop(mutation.session_id, None)
+                        if newer is not None:
+                            mutation.merge(newer)
+                        self._pending[mutation.session_id] = mutation
+                        self._pending.move_to_end(mutation.session_id, last=False)
+                self.counters["written"] += len(batch) - len(retry) - len(dropped)
+                self.counters["dropped"] += len(dropped)
+                self._inflight = {}
+                self._cond.notify_all()
+            if retry:
+                time.sleep(self.retry_interval)
+
+    def _write(self, batch):
+        """Ghi một lô. Trả về (các thay đổi cần ghi lại, các thay đổi bị bỏ)."""
+        try:
+            self.write_fn(batch)
+            return [], []
+        except Exception as e:
+            self.last_error = repr(e)
+            if self.retryable(e):
+                return batch, []
+            if len(batch) == 1:
+                mutation = batch[0]
+                mutation.attempts += 1
+                return ([], batch) if mutation.attempts >= self.max_attempts else (batch, [])
+        # Lỗi không phải do mất kết nối: ghi riêng từng thay đổi để tách thay đổi hỏng khỏi lô
+        retry, dropped = [], []
+        for mutation in batch:
+            mutation_retry, mutation_dropped = self._write([mutation])
+            retry += mutation_retry
+            dropped += mutation_dropped
+        return retry, dropped
+
+    def stats(self):
+        with self._cond:
+            return dict(self.counters, pending=len(self._pending), inflight=len(self._inflight),
+                        last_error=self.last_error)